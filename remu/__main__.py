@@ -18,6 +18,7 @@ import urlparse
 import flask
 import argparse
 import ast
+import json
 import os.path
 import flask_login
 import socketio
@@ -98,11 +99,14 @@ def create_app():
 
             params = {}
             for k, v in query:
+                # Parameters are JSON encoded by RemoteComponent
                 try:
-                    e = ast.literal_eval(v)
-                    params[k] = e
+                    params[k] = json.loads(v)
                 except ValueError:
-                    params[k] = v
+                    try:
+                        params[k] = ast.literal_eval(v)
+                    except ValueError:
+                        params[k] = v
         else:
             method = path
             params = None
@@ -145,19 +149,46 @@ def create_sio():
     def connected(sid, environ):
         l.debug("New client connected to front-end")
 
+    @sio.on('watch')
+    def watch(sid, ticket):
+        """
+        Subscribe the client to the progress of its checkout.
+        """
+        sio.enter_room(sid, ticket)
+
     return sio
 
-def sio_counts(sio):
+def sio_counts(sio, state=None):
     """
-    Task which regularly emits session counts to the end-users.
+    Task which regularly emits session counts to the end-users. The counts are
+    read from the cluster state when the manager is running locally.
     """
     while True:
-        data = db.session_to_workshop_count()
+        data = {}
+        counts = state.session_counts() if state else db.session_counts()
         for w in db.get_all_workshops():
-            data[w['name']] = w['max_instances'] - data[w['name']]
+            total = counts[w['name']]['total'] if w['name'] in counts else 0
+            data[w['name']] = w['max_instances'] - total
         sio.emit('counts', data)
         gevent.sleep(1)
 
+def sio_checkouts(sio, manager):
+    """
+    Task which regularly emits the progress of each checkout to the end-user
+    waiting for it.
+    """
+    while True:
+        progress = manager.checkout_progress() or {}
+        for ticket, status in progress.items():
+            sio.emit('progress', {
+                'status': status['status'],
+                'done': status['done'],
+                'total': status['total'],
+                'position': status.get('position'),
+                'eta': status.get('eta')
+            }, room=ticket)
+        gevent.sleep(1)
+
 def parse_arguments():
     """
     Parse command-line arguments through Python's argparse.
@@ -260,6 +291,12 @@ if not any([args.manager, args.server, args.nginx, args.web]):
 # Establish a connection to mongod for the module that require it.
 if args.manager or args.web:
     import mongoengine
+    import remu.instrument
+
+    # Command monitoring must be registered prior to connecting
+    if remu.instrument.enabled():
+        remu.instrument.register_listener()
+
     mongoengine.connect(
         db=config['DATABASE']['name'],
         host=config['DATABASE']['address'],
@@ -299,6 +336,11 @@ if args.manager:
     manager = Manager(server, nginx, monitor)
     modules.append(manager)
 
+# Push the machine states of the local units to the manager as they change
+if args.server and float(config['REMU'].get('event_interval', 0)) > 0:
+    target = manager or RemoteComponent(config['MANAGER']['address'], config['MANAGER']['port'], [Manager])
+    monitor.start_watch(target, float(config['REMU']['event_interval']))
+
 # Create our flask application
 application = create_app()
 
@@ -309,7 +351,8 @@ if args.web:
     sockio = create_sio()
     wrap = socketio.Middleware(sockio, application)
 
-    counts = gevent.spawn(sio_counts, sockio)
+    counts = gevent.spawn(sio_counts, sockio, manager.state if manager else None)
+    checkouts = gevent.spawn(sio_checkouts, sockio, application.config['MANAGER'])
 
 try:
     l.info("+------------------------------------------------------+")
@@ -336,6 +379,7 @@ except (KeyboardInterrupt, SystemExit):
     # Stop emitting to clients
     try:
         counts.kill()
+        checkouts.kill()
     except Exception:
         pass
 
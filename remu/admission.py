@@ -0,0 +1,120 @@
+"""
+Admission control of checkouts made while the cluster is at capacity.
+Checkouts which cannot be placed wait in a FIFO waitlist per workshop and
+are admitted as capacity frees up.
+"""
+import collections
+import logging
+import time
+
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+
+class AdmissionController(object):
+    """
+    Per-workshop FIFO waitlists served round robin across the workshops, so
+    a long waitlist for one workshop does not starve the others.
+
+    The wait of a checkout is estimated from the rate at which sessions of
+    its workshop were released (recycled or stopped) over a sliding window,
+    plus the time it takes to build a unit.
+    """
+    def __init__(self, size=200, window=1800.0):
+        self.size = size
+        self.window = window
+        self.waitlists = collections.OrderedDict()
+        self._releases = {}
+
+        # Workshop served last, the next round starts after it
+        self._last = None
+
+    def __len__(self):
+        return sum(len(waitlist) for waitlist in self.waitlists.values())
+
+    def waiting(self, workshop):
+        return bool(self.waitlists.get(workshop))
+
+    def enqueue(self, workshop, ticket, front=False):
+        """
+        Add a checkout to the waitlist of the workshop. Returns false if the
+        waitlist is full.
+        """
+        waitlist = self.waitlists.setdefault(workshop, collections.deque())
+
+        if front:
+            waitlist.appendleft(ticket)
+            return True
+
+        if len(waitlist) >= self.size:
+            return False
+
+        waitlist.append(ticket)
+        return True
+
+    def remove(self, ticket):
+        for waitlist in self.waitlists.values():
+            if ticket in waitlist:
+                waitlist.remove(ticket)
+                return True
+        return False
+
+    def admit(self, has_capacity):
+        """
+        Returns the workshop and ticket of the next checkout to admit, or None.
+        The workshops are visited round robin starting after the one served
+        last, and the head of each waitlist is admitted if has_capacity(workshop)
+        is true.
+        """
+        workshops = list(self.waitlists)
+        if self._last in workshops:
+            i = workshops.index(self._last) + 1
+            workshops = workshops[i:] + workshops[:i]
+
+        for workshop in workshops:
+            if self.waitlists[workshop] and has_capacity(workshop):
+                self._last = workshop
+                return workshop, self.waitlists[workshop].popleft()
+
+        return None
+
+    def record_release(self, workshop, now=None):
+        if now is None:
+            now = time.time()
+        self._releases.setdefault(workshop, collections.deque()).append(now)
+
+    def release_rate(self, workshop, now=None):
+        """
+        Returns the sessions of the workshop released per second over the window.
+        """
+        if now is None:
+            now = time.time()
+
+        releases = self._releases.get(workshop)
+        if not releases:
+            return 0.0
+
+        while releases and releases[0] < now - self.window:
+            releases.popleft()
+
+        return len(releases) / float(self.window)
+
+    def positions(self, build_time, now=None):
+        """
+        Returns a dictionary mapping every waiting ticket to its position in
+        the waitlist of its workshop and the estimated wait in seconds. The
+        wait is None when no session of the workshop was released recently.
+        build_time - function mapping a workshop name to its build time
+        """
+        result = {}
+
+        for workshop, waitlist in self.waitlists.items():
+            rate = self.release_rate(workshop, now)
+            build = build_time(workshop)
+
+            for i, ticket in enumerate(waitlist):
+                eta = (i + 1) / rate + build if rate else None
+                result[ticket] = (i + 1, eta)
+
+        return result
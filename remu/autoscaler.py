@@ -0,0 +1,83 @@
+"""
+Demand tracking for the warm pool of available workshop units. The Manager
+records every checkout and every unit build; the autoscaler turns those into
+the number of available units each workshop should keep.
+"""
+import collections
+import logging
+import math
+import time
+
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+
+class Autoscaler(object):
+    """
+    Predicts the checkouts of each workshop during the time it takes to
+    build a unit.
+
+    The arrival rate is the number of checkouts in a sliding window divided
+    by the window length. The build time starts at the configured estimate
+    and follows the measured builds as an exponentially weighted average.
+    """
+    def __init__(self, window=600.0, build_time=120.0, smoothing=0.3):
+        self.window = window
+        self.build_time = build_time
+        self.smoothing = smoothing
+        self._arrivals = {}
+        self._build_times = {}
+
+    def record_checkout(self, workshop, now=None):
+        if now is None:
+            now = time.time()
+        self._arrivals.setdefault(workshop, collections.deque()).append(now)
+
+    def record_build(self, workshop, seconds):
+        estimate = self._build_times.get(workshop)
+        if estimate is None:
+            self._build_times[workshop] = seconds
+        else:
+            self._build_times[workshop] = estimate + self.smoothing * (seconds - estimate)
+
+    def rate(self, workshop, now=None):
+        """
+        Returns the checkouts per second of the workshop over the window.
+        """
+        if now is None:
+            now = time.time()
+        arrivals = self._arrivals.get(workshop)
+        if not arrivals:
+            return 0.0
+
+        while arrivals and arrivals[0] < now - self.window:
+            arrivals.popleft()
+
+        return len(arrivals) / float(self.window)
+
+    def build_estimate(self, workshop):
+        return self._build_times.get(workshop, self.build_time)
+
+    def target(self, workshop, min_instances, max_instances, active, now=None):
+        """
+        Returns the number of available units to keep for the workshop given
+        its number of active units. The predicted demand during one build is
+        raised to what the minimum instances require and capped by the
+        instances left under the maximum.
+        """
+        demand = int(math.ceil(self.rate(workshop, now) * self.build_estimate(workshop)))
+        return max(0, min(max(demand, min_instances - active), max_instances - active))
+
+
+def create():
+    """
+    Create the autoscaler from the configuration, or None if it is disabled.
+    """
+    settings = config.get('AUTOSCALER', {})
+    if settings.get('enabled', 'true').lower() != 'true':
+        return None
+
+    return Autoscaler(
+        float(settings.get('window', 600)),
+        float(settings.get('build_time', 120)))
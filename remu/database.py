@@ -1,47 +1,90 @@
 """ TODO """
 import logging
+import sys
 import time
+import datetime
 
-from remu.models import Server, Workshop, Session, User, Machine
+from pymongo import UpdateOne, InsertOne
+
+from remu.models import Server, Workshop, Session, User, Machine, Metric
 from remu.settings import config
+from remu.util import TTLCache
+import remu.instrument
 
 l = logging.getLogger(config["REMU"]["logger"])
 
+# Retention (seconds) of the metric samples for each resolution. Raw samples
+# are folded into 1 and 15 minute rollups as they are written.
+METRIC_RETENTION = {
+    0: int(config.get('METRICS', {}).get('raw_retention', 3600)),
+    60: int(config.get('METRICS', {}).get('minute_retention', 86400)),
+    900: int(config.get('METRICS', {}).get('quarter_retention', 2592000))
+}
+
+# Workshop documents rarely change, so lookups are memoized. The cache is
+# cleared whenever a workshop is inserted, updated or removed.
+_workshop_cache = TTLCache(
+    int(config['REMU'].get('workshop_cache_size', 128)),
+    float(config['REMU'].get('workshop_cache_ttl', 60))
+)
+
 def session_exists(sid):
-    for server in Server.objects():
-        if sid in server.sessions:
-            return True
-    return False
+    """Returns True if a session document exists for the session id."""
+    return Session.objects(sid=sid).only('sid').first() is not None
 
 def get_workshop(**kwargs):
     """Returns the workshop entry corresponding to the workshop name."""
-    return Workshop.objects(**kwargs).first().to_mongo().to_dict()
+    key = tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    workshop = _workshop_cache.get(key)
+
+    if workshop is None:
+        workshop = Workshop.objects(**kwargs).first().to_mongo().to_dict()
+        _workshop_cache.set(key, workshop)
+
+    return dict(workshop)
+
+def _workshop_id(name):
+    """Returns the object id of the named workshop or None if it does not exist."""
+    try:
+        return get_workshop(name=name)['_id']
+    except AttributeError:
+        return None
+
+def workshop_cache_stats():
+    """Returns the hit and miss counters of the workshop cache."""
+    return _workshop_cache.stats()
 
 def get_workshop_from_session(ip, sid):
-    server = Server.objects(ip=ip).first()
-    session = server.sessions[sid]
-    return session.workshop.to_mongo().to_dict()
+    session = Session._get_collection().find_one({'sid': sid, 'server': ip}, ['workshop'])
+    return get_workshop(id=session['workshop'])
 
 def get_server_from_session(sid):
-    for server in Server.objects():
-        if sid in server.sessions:
-            return server.to_mongo().to_dict()
-    return None
+    session = Session.objects(sid=sid).only('server').first()
+    if not session:
+        return None
+    return get_server(session.server)
 
 def get_vrde_machine_names(sid):
-    server = get_server_from_session(sid)
-    return [machine['name'] for machine in server['sessions'][sid]['machines'] if machine['port'] > 1]
+    session = Session.objects(sid=sid).only('machines').first()
+    return [machine.name for machine in session.machines if machine.port > 1]
+
+def get_all_workshops(fields=None):
+    """
+    Returns all workshop entries as a list of dictionaries. If fields are
+    specified, only those fields (and the id) are read from the database.
+    """
+    if fields:
+        workshops = list(Workshop._get_collection().find({}, _projection(fields)))
+    else:
+        workshops = [w.to_mongo().to_dict() for w in Workshop.objects()]
 
-def get_all_workshops():
-    """Returns all workshop entries as a list of dictionaries unless json is True."""
-    workshops = [w.to_mongo().to_dict() for w in Workshop.objects()]
     for w in workshops:
         w['_id'] = str(w['_id'])
     return workshops
 
 def get_vrde_ports(sid):
-    server = get_server_from_session(sid)
-    return [machine['port'] for machine in server['sessions'][sid]['machines'] if machine['port'] > 1]
+    session = Session.objects(sid=sid).only('machines').first()
+    return [machine.port for machine in session.machines if machine.port > 1]
 
 def get_user(username):
     """ TODO """
@@ -52,37 +95,101 @@ def get_server(ip):
     server = Server.objects(ip=ip).first()
     return server.to_mongo().to_dict()
 
-def get_all_servers():
-    """Returns all server entries as a list of dictionaries unless json is True."""
+def get_all_servers(fields=None):
+    """
+    Returns all server entries as a list of dictionaries. If fields are
+    specified, only those fields are read from the database.
+    """
+    if fields:
+        return list(Server._get_collection().find({}, _projection(fields, '_id')))
+
     servers = Server.objects().exclude('id')
     return [s.to_mongo().to_dict() for s in servers]
 
+def get_server_summaries():
+    """
+    Returns a lightweight entry for every server containing its address,
+    hardware usage and session counts, without loading any session documents.
+    """
+    counts = session_counts(by_server=True)
+
+    servers = get_all_servers(fields=['ip', 'port', 'cpu', 'mem', 'hdd'])
+    for server in servers:
+        workshops = counts.get(server['ip'], {})
+        server['sessions'] = sum(c['total'] for c in workshops.values())
+        server['available'] = sum(c['available'] for c in workshops.values())
+
+    return servers
+
 def get_session(ip, sid):
     """ TODO """
-    server = Server.objects(ip=ip).first()
-    return server.sessions[sid].to_mongo().to_dict()
+    session = Session.objects(sid=sid, server=ip).exclude('id').first()
+    return session.to_mongo().to_dict()
+
+def get_all_sessions(ip=None, fields=None):
+    """
+    Returns a dictionary mapping session ids to session entries. If a server
+    is specified, only the sessions belonging to that server are returned.
+    If fields are specified, only those fields are read from the database.
+    """
+    if fields:
+        query = {'server': ip} if ip else {}
+        sessions = Session._get_collection().find(query, _projection(list(fields) + ['sid'], '_id'))
+        return dict((s['sid'], s) for s in sessions)
+
+    sessions = (Session.objects(server=ip) if ip else Session.objects()).exclude('id')
+    return dict((s.sid, s.to_mongo().to_dict()) for s in sessions)
+
+def _projection(fields, *exclude):
+    """Builds a projection document including the fields and excluding the rest."""
+    projection = dict((f, True) for f in fields)
+    for f in exclude:
+        projection[f] = False
+    return projection
 
 def get_available_session(ip, workshop):
     """
     Returns the first available session for the specified workshop.
     """
-    server = Server.objects(ip=ip).first()
+    session = Session.objects(
+        server=ip,
+        workshop=_workshop_id(workshop),
+        available=True
+    ).only('sid').first()
+
+    return session.sid if session else None
+
+def claim_available_session(workshop, ip=None):
+    """
+    Atomically marks an available session for the specified workshop as
+    unavailable. The claim is a single find-and-modify so concurrent callers
+    can never be handed the same session. If no server is specified, then
+    all servers will be considered.
+
+    Returns a tuple of the server ip and session id, or None if there are no
+    available sessions.
+    """
+    query = {
+        'workshop': _workshop_id(workshop),
+        'available': True
+    }
+
+    if ip:
+        query['server'] = ip
+
+    session = Session.objects(**query).only('sid', 'server').modify(set__available=False)
 
-    if server.sessions:
-        for s_id, session in server.sessions.items():
-            if session['available'] and session.workshop['name'] == workshop:
-                return s_id
-    return None
+    if not session:
+        return None
+    return session.server, session.sid
 
 def get_active_sessions():
     """
     Return a dictionary containing all active sessions.
     """
     active = {}
-    for server in get_all_servers():
-        for sid, session in server['sessions'].items():
-            if not session['available']:
-                active[sid] = session
+    for session in Session.objects(available=False).exclude('id'):
+        active[session.sid] = session.to_mongo().to_dict()
     return active
 
 def session_count(ip, check_available=False):
@@ -90,16 +197,9 @@ def session_count(ip, check_available=False):
     Returns the current number of sessions. If check_available is true,
     it will return the current available sessions only.
     """
-    server = Server.objects(ip=ip).first()
-
     if not check_available:
-        return len(server.sessions)
-
-    count = 0
-    for dummy, session in server.sessions.items():
-        if session['available']:
-            count += 1
-    return count
+        return Session.objects(server=ip).count()
+    return Session.objects(server=ip, available=True).count()
 
 def session_count_by_workshop(workshop, ip=None, available=False):
     """
@@ -107,20 +207,64 @@ def session_count_by_workshop(workshop, ip=None, available=False):
     for the specified workshop.  If no server is specified, then
     all servers will be counted.
     """
-    count = 0
-    servers = (Server.objects(ip=ip) if ip else Server.objects())
+    query = {'workshop': _workshop_id(workshop)}
 
-    for server in servers:
-        if not available:
-            for dummy, session in server.sessions.items():
-                if session.workshop.name == workshop:
-                    count += 1
-        else:
-            for s_id, session in server.sessions.items():
-                if session.available and session.workshop.name == workshop:
-                    count += 1
+    if ip:
+        query['server'] = ip
+
+    if available:
+        query['available'] = True
 
-    return count
+    return Session.objects(**query).count()
+
+
+def session_counts(by_server=False):
+    """
+    Returns the total, available and active session counts for each workshop
+    through a single aggregation. Workshops without sessions are omitted.
+
+    The result maps workshop names to a dictionary of counts:
+        {'Pivoting_Attack': {'total': 3, 'available': 1, 'active': 2}}
+
+    If by_server is True, the counts are further grouped by server ip:
+        {'127.0.0.1': {'Pivoting_Attack': {'total': 3, ...}}}
+    """
+    group = {'workshop': '$workshop'}
+    if by_server:
+        group['server'] = '$server'
+
+    pipeline = [
+        {'$group': {
+            '_id': group,
+            'total': {'$sum': 1},
+            'available': {'$sum': {'$cond': ['$available', 1, 0]}}
+        }},
+        {'$lookup': {
+            'from': Workshop._get_collection_name(),
+            'localField': '_id.workshop',
+            'foreignField': '_id',
+            'as': 'workshop'
+        }},
+        {'$unwind': '$workshop'},
+        {'$project': {
+            '_id': 0,
+            'workshop': '$workshop.name',
+            'server': '$_id.server',
+            'total': 1,
+            'available': 1
+        }}
+    ]
+
+    counts = {}
+    for entry in Session._get_collection().aggregate(pipeline):
+        workshops = counts.setdefault(entry['server'], {}) if by_server else counts
+        workshops[entry['workshop']] = {
+            'total': entry['total'],
+            'available': entry['available'],
+            'active': entry['total'] - entry['available']
+        }
+
+    return counts
 
 
 def session_to_workshop_count(available=False):
@@ -128,17 +272,18 @@ def session_to_workshop_count(available=False):
     Obtain a dictionary mapping workshop names to the amount of available
     or unavailable sessions for each workshop.
     """
-    counts = {}
+    counts = dict((w.name, 0) for w in Workshop.objects().only('name'))
+    key = 'available' if available else 'total'
 
-    for w in Workshop.objects():
-        counts[w.name] = session_count_by_workshop(w.name, available=available)
+    for name, count in session_counts().items():
+        counts[name] = count[key]
 
     return counts
 
 
 def update_session(ip, sid, available):
     """
-    Update an existing session in a server document.
+    Update the availability of an existing session document.
     """
 
     if not ip:
@@ -150,10 +295,11 @@ def update_session(ip, sid, available):
         raise Exception
 
     try:
-        server = Server.objects(ip=ip).first()
+        updated = Session.objects(sid=sid, server=ip).update_one(set__available=available)
 
-        server.sessions[sid]['available'] = available
-        server.save()
+        if not updated:
+            l.error("No session entry for sid: %s", sid)
+            raise Exception
 
     except Exception:
         l.exception("Failed to update session %s", sid)
@@ -170,12 +316,16 @@ def update_server(ip, **kwargs):
         raise Exception
 
     try:
-        server = Server.objects(ip=ip).first()
-
+        # Updates bypass document validation so check the fields here
         for k, v in kwargs.items():
-            server[k] = v
+            Server._fields[k].validate(v)
 
-        server.save()
+        updates = dict(('set__' + k, v) for k, v in kwargs.items())
+        updated = Server.objects(ip=ip).update_one(**updates)
+
+        if not updated:
+            l.error("No server entry for ip: %s", ip)
+            raise Exception
 
     except Exception:
         l.exception("Failed to update server %s", ip)
@@ -197,27 +347,105 @@ def update_machines(ip, sid, data):
         raise Exception
 
     try:
-        server = Server.objects(ip=ip).first()
-        machines = server.sessions[sid].machines
+        sessions = Session._get_collection()
+        session = sessions.find_one({'sid': sid, 'server': ip}, ['machines'])
 
-        # We want to replace any hyphens in the dictionary keys
-        # to underscores to match the model
-        for m in data:
-            for k in m:
-                if '-' in k:
-                    m[k.replace('-', '_')] = m.pop(k)
+        if not session:
+            l.error("No session entry for sid: %s", sid)
+            raise Exception
 
-        for i, m in enumerate(machines):
-            for k, v in data[i].items():
-                m[k] = v
-
-        server.save()
+        changes = _machine_changes(session.get('machines', []), data)
+        if changes:
+            sessions.update_one({'_id': session['_id']}, {'$set': changes})
 
     except Exception:
         l.exception("Failed to update machines for %s", sid)
         raise
 
 
+def update_status(ip, status):
+    """
+    Apply a status report from a server node. The hardware usage is set on
+    the server document and the machine states for every reported session
+    are written with a single bulk write containing only the fields that
+    have changed.
+    status - dictionary as returned by PerformanceMonitor.update
+    Returns the number of sessions updated.
+    """
+
+    if not ip:
+        l.error("Cannot update status with no ip address!")
+        raise Exception
+
+    try:
+        update_server(ip, cpu=status['cpu'], mem=status['mem'], hdd=status['hdd'])
+        return update_sessions(ip, status['sessions'])
+
+    except Exception:
+        l.exception("Failed to update status for %s", ip)
+        raise
+
+
+def update_sessions(ip, reported):
+    """
+    Write the reported machine states of the sessions on a server with a
+    single bulk write containing only the fields that have changed.
+    reported - dictionary mapping session ids to lists of machine data
+    Returns the number of sessions updated.
+    """
+
+    if not ip:
+        l.error("Cannot update sessions with no ip address!")
+        raise Exception
+
+    if not reported:
+        return 0
+
+    try:
+        sessions = Session._get_collection()
+
+        requests = []
+        query = {'server': ip, 'sid': {'$in': list(reported)}}
+        for session in sessions.find(query, ['sid', 'machines']):
+            changes = _machine_changes(session.get('machines', []), reported[session['sid']])
+            if changes:
+                requests.append(UpdateOne({'_id': session['_id']}, {'$set': changes}))
+
+        if requests:
+            sessions.bulk_write(requests, ordered=False)
+
+        return len(requests)
+
+    except Exception:
+        l.exception("Failed to update sessions for %s", ip)
+        raise
+
+
+def _machine_changes(machines, data):
+    """
+    Compare the stored machines of a session against reported machine data
+    and return the $set paths for the fields that differ.
+    machines - list of machine dictionaries as stored in the session
+    data - list of dictionaries, in the same order as the machines
+    """
+    changes = {}
+
+    for i, (machine, report) in enumerate(zip(machines, data)):
+        for k, v in report.items():
+            # We want to replace any hyphens in the dictionary keys
+            # to underscores to match the model
+            k = k.replace('-', '_')
+
+            if k not in Machine._fields:
+                continue
+
+            Machine._fields[k].validate(v)
+            if machine.get(k) != v:
+                changes['machines.{}.{}'.format(i, k)] = v
+
+    return changes
+
+
 def update_workshop(oid, **kwargs):
     """
     Update a workshop document.
@@ -233,12 +461,14 @@ def update_workshop(oid, **kwargs):
             workshop[k] = v
         workshop.save()
 
+        _workshop_cache.clear()
+
     except Exception:
         l.exception("Failed to update workshop (%s)", oid)
         raise
 
 
-def insert_server(ip, port):
+def insert_server(ip, port, capacity=1.0):
     """
     Insert a new server document.
     """
@@ -248,7 +478,7 @@ def insert_server(ip, port):
         raise Exception
 
     try:
-        server = Server(ip=ip, port=port)
+        server = Server(ip=ip, port=port, capacity=capacity)
         server.save()
 
     except Exception:
@@ -256,7 +486,7 @@ def insert_server(ip, port):
         raise
 
 
-def insert_workshop(name, display, desc, min_units, max_units, enabled):
+def insert_workshop(name, display, desc, min_units, max_units, enabled, footprint=1.0):
     """
     Insert a new workshop document.
     """
@@ -271,18 +501,23 @@ def insert_workshop(name, display, desc, min_units, max_units, enabled):
             description=desc,
             min_instances=min_units,
             max_instances=max_units,
-            enabled=enabled
+            enabled=enabled,
+            footprint=footprint
         )
         workshop.save()
 
+        _workshop_cache.clear()
+
     except Exception:
         l.exception("Failed inserting workshop %s", name)
         raise
 
 
-def insert_session(ip, sid, name, password):
+def insert_session(ip, sid, name, password, available=True):
     """
-    Embed a new session document into the server document.
+    Insert a new session document for the server. Sessions reserved for a
+    unit which is yet to be built are inserted as unavailable so they cannot
+    be claimed in the meantime.
     """
 
     if not sid:
@@ -294,21 +529,24 @@ def insert_session(ip, sid, name, password):
         raise Exception
 
     try:
+        if not Server.objects(ip=ip).only('ip').first():
+            l.error("No server entry for ip: %s", ip)
+            raise Exception
+
+        if session_exists(sid):
+            l.error("Cannot insert session with duplicate id!")
+            raise Exception
+
         workshop = Workshop.objects(name=name).first()
         session = Session(
+            sid=sid,
+            server=ip,
             workshop=workshop,
             password=password,
-            available=True,
+            available=available,
             start_time=time.time()
         )
-        server = Server.objects(ip=ip).first()
-
-        if sid in server.sessions:
-            l.error("Cannot insert session with duplicate id!")
-            raise Exception
-
-        server.sessions[sid] = session
-        server.save()
+        session.save()
 
     except Exception:
         l.exception("Failed inserting session %s", sid)
@@ -317,7 +555,7 @@ def insert_session(ip, sid, name, password):
 
 def insert_machine(ip, sid, name, port):
     """
-    Embed a new machine into the embedded session document.
+    Embed a new machine into the session document.
     """
 
     if not name:
@@ -325,10 +563,14 @@ def insert_machine(ip, sid, name, port):
         raise Exception
 
     try:
-        server = Server.objects(ip=ip).first()
-        session = server.sessions[sid]
-        session.machines.append(Machine(name=name, port=port))
-        session.save()
+        machine = Machine(name=name, port=port)
+        machine.validate()
+
+        updated = Session.objects(sid=sid, server=ip).update_one(push__machines=machine)
+
+        if not updated:
+            l.error("No session entry for sid: %s", sid)
+            raise Exception
 
     except Exception:
         l.exception("Failed to insert machine %s into %s", name, sid)
@@ -337,7 +579,7 @@ def insert_machine(ip, sid, name, port):
 
 def remove_session(ip, sid):
     """
-    Remove a session for the corresponding server document.
+    Remove a session belonging to the corresponding server document.
     """
 
     if not ip:
@@ -349,9 +591,8 @@ def remove_session(ip, sid):
         raise Exception
 
     try:
-        server = Server.objects(ip=ip).first()
-        del server.sessions[sid]
-        server.save()
+        session = Session.objects(sid=sid, server=ip).first()
+        session.delete()
 
     except Exception:
         l.exception("Failed to remove session %s", sid)
@@ -371,6 +612,8 @@ def remove_workshop(oid):
         workshop = Workshop.objects(id=oid).first()
         workshop.delete()
 
+        _workshop_cache.clear()
+
     except Exception:
         l.exception("Failed to remove workshop %s", oid)
         raise
@@ -388,6 +631,7 @@ def remove_server(ip):
     try:
         server = Server.objects(ip=ip).first()
         server.delete()
+        Session.objects(server=ip).delete()
 
     except AttributeError:
         l.error("No server entry for ip: %s", ip)
@@ -396,3 +640,170 @@ def remove_server(ip):
     except Exception:
         l.exception("Failed to remove server %s", ip)
         raise
+
+
+
+def migrate_sessions():
+    """
+    Move sessions embedded in server documents (the layout used prior to the
+    session collection) into their own session documents.
+
+    The migration is performed one server at a time and is safe to run while
+    the system is serving requests: sessions are upserted by id, so running it
+    again after an interruption will not create duplicates, and the embedded
+    map is only unset once every session of the server has been copied.
+    Returns the number of sessions migrated.
+    """
+    servers = Server._get_collection()
+    sessions = Session._get_collection()
+    migrated = 0
+
+    for server in servers.find({'sessions': {'$exists': True}}, ['ip', 'sessions']):
+        try:
+            for sid, session in server['sessions'].items():
+                session['sid'] = sid
+                session['server'] = server['ip']
+                sessions.update_one({'sid': sid}, {'$setOnInsert': session}, upsert=True)
+                migrated += 1
+
+            servers.update_one({'_id': server['_id']}, {'$unset': {'sessions': ''}})
+            l.info("Migrated %d sessions for server %s", len(server['sessions']), server['ip'])
+
+        except Exception:
+            l.exception("Failed to migrate sessions for server %s", server['ip'])
+            raise
+
+    return migrated
+
+
+
+def insert_metrics(samples):
+    """
+    Store a batch of metric samples and fold them into the rollups of every
+    resolution with a single bulk write.
+    samples - list of dictionaries with the keys:
+        server - ip of the server for host samples, otherwise None
+        workshop - name of the workshop for workshop samples, otherwise None
+        time - unix timestamp of the sample
+        values - dictionary mapping metric names to numbers
+    Returns the number of write operations issued.
+    """
+    if not samples:
+        return 0
+
+    try:
+        requests = []
+        buckets = {}
+
+        for sample in samples:
+            when = datetime.datetime.utcfromtimestamp(sample['time'])
+            values = dict((k, float(v)) for k, v in sample['values'].items())
+
+            requests.append(InsertOne({
+                'server': sample.get('server'),
+                'workshop': sample.get('workshop'),
+                'resolution': 0,
+                'timestamp': when,
+                'expires': when + datetime.timedelta(seconds=METRIC_RETENTION[0]),
+                'samples': 1,
+                'sums': values
+            }))
+
+            # Samples falling into the same bucket are combined first so each
+            # bucket is upserted once per batch
+            for resolution in METRIC_RETENTION:
+                if not resolution:
+                    continue
+
+                start = int(sample['time']) // resolution * resolution
+                key = (resolution, sample.get('server'), sample.get('workshop'), start)
+                bucket = buckets.setdefault(key, {'samples': 0})
+                bucket['samples'] += 1
+                for k, v in values.items():
+                    bucket['sums.' + k] = bucket.get('sums.' + k, 0.0) + v
+
+        for (resolution, server, workshop, start), inc in buckets.items():
+            when = datetime.datetime.utcfromtimestamp(start)
+            requests.append(UpdateOne(
+                {'resolution': resolution, 'server': server, 'workshop': workshop, 'timestamp': when},
+                {
+                    '$inc': inc,
+                    '$setOnInsert': {
+                        'expires': when + datetime.timedelta(seconds=METRIC_RETENTION[resolution])
+                    }
+                },
+                upsert=True
+            ))
+
+        Metric._get_collection().bulk_write(requests, ordered=True)
+        return len(requests)
+
+    except Exception:
+        l.exception("Failed to insert %d metric samples", len(samples))
+        raise
+
+
+def get_server_metrics(window, ip=None, percentiles=(50, 95)):
+    """
+    Returns the average and percentiles of the host metrics over the last
+    window seconds, keyed by server ip and then by metric name:
+        {'127.0.0.1': {'cpu': {'avg': 12.5, 'p50': 10.0, 'p95': 40.0, 'samples': 120}}}
+    If a server is specified, only that server is returned.
+    """
+    query = {'workshop': None}
+    if ip:
+        query['server'] = ip
+    return _query_metrics(query, 'server', window, percentiles)
+
+
+def get_workshop_metrics(window, workshop=None, percentiles=(50, 95)):
+    """
+    Returns the average and percentiles of the cluster wide workshop metrics
+    over the last window seconds, keyed by workshop name and then by metric
+    name in the same format as get_server_metrics.
+    """
+    query = {'server': None}
+    query['workshop'] = workshop if workshop else {'$ne': None}
+    return _query_metrics(query, 'workshop', window, percentiles)
+
+
+def _query_metrics(query, key, window, percentiles):
+    """
+    Summarize the metric documents matching the query. The finest resolution
+    still retained for the whole window is used; percentiles are computed
+    over the bucket averages of that resolution.
+    """
+    resolution = next((r for r in sorted(METRIC_RETENTION) if window <= METRIC_RETENTION[r]),
+                      max(METRIC_RETENTION))
+
+    query['resolution'] = resolution
+    query['timestamp'] = {
+        '$gte': datetime.datetime.utcfromtimestamp(time.time() - window)
+    }
+
+    series = {}
+    for doc in Metric._get_collection().find(query, [key, 'samples', 'sums']):
+        metrics = series.setdefault(doc[key], {})
+        for name, total in doc['sums'].items():
+            metrics.setdefault(name, []).append((total, doc['samples']))
+
+    results = {}
+    for name, metrics in series.items():
+        results[name] = {}
+        for metric, points in metrics.items():
+            averages = sorted(total / count for total, count in points)
+            summary = {
+                'avg': sum(total for total, dummy in points) / sum(count for dummy, count in points),
+                'samples': sum(count for dummy, count in points)
+            }
+            for p in percentiles:
+                # Nearest-rank percentile
+                rank = max(int(-(-p * len(averages) // 100)), 1)
+                summary['p{}'.format(p)] = averages[rank - 1]
+            results[name][metric] = summary
+
+    return results
+
+
+if remu.instrument.enabled():
+    remu.instrument.instrument_module(sys.modules[__name__])
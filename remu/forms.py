@@ -1,9 +1,9 @@
 from flask_wtf import FlaskForm
 from wtforms import (
     StringField, PasswordField, BooleanField, SubmitField,
-    FileField, TextAreaField, MultipleFileField
+    FileField, TextAreaField, MultipleFileField, FloatField
     )
-from wtforms.validators import DataRequired
+from wtforms.validators import DataRequired, InputRequired
 
 class LoginForm(FlaskForm):
     username    = StringField('Username', validators=[DataRequired()])
@@ -14,6 +14,7 @@ class LoginForm(FlaskForm):
 class AddServerForm(FlaskForm):
     address = StringField('Address', validators=[DataRequired()])
     port    = StringField('Port', validators=[DataRequired()])
+    capacity = FloatField('Capacity', default=1.0, validators=[InputRequired()])
     submit  = SubmitField('Save')
 
 class AddWorkshopForm(FlaskForm):
@@ -22,6 +23,7 @@ class AddWorkshopForm(FlaskForm):
     description = TextAreaField('Description', validators=[DataRequired()])
     mini        = StringField('Min Instances', validators=[DataRequired()])
     maxi        = StringField('Max Instances', validators=[DataRequired()])
+    footprint   = FloatField('Footprint', default=1.0, validators=[InputRequired()])
     materials   = MultipleFileField('Materials')
     enabled     = BooleanField('Enabled')
     submit      = SubmitField('Save')
@@ -0,0 +1,165 @@
+"""
+Optional instrumentation of the database layer. Every public function of a
+module can be wrapped to record call counts, errors and a latency histogram.
+When the command listener is registered with pymongo, the database commands
+(round trips) and the documents read and written are attributed to the
+innermost instrumented function that issued them.
+"""
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from pymongo import monitoring
+
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+# Upper bounds (milliseconds) of the latency histogram buckets.
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+_stats = {}
+
+# Name of the instrumented function currently executing. The threading module
+# is patched by gevent so this is local to each greenlet.
+_local = threading.local()
+
+
+def _entry(name):
+    if name not in _stats:
+        _stats[name] = {
+            'calls': 0,
+            'errors': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'histogram': [0] * (len(BUCKETS) + 1),
+            'commands': 0,
+            'docs_read': 0,
+            'docs_written': 0
+        }
+    return _stats[name]
+
+
+def _record(name, elapsed, failed):
+    entry = _entry(name)
+    entry['calls'] += 1
+    entry['errors'] += int(failed)
+    entry['total_ms'] += elapsed
+    entry['max_ms'] = max(entry['max_ms'], elapsed)
+
+    for i, bound in enumerate(BUCKETS):
+        if elapsed <= bound:
+            entry['histogram'][i] += 1
+            break
+    else:
+        entry['histogram'][-1] += 1
+
+
+def instrument(func, name=None):
+    """
+    Wrap a function so each call is recorded under the given name.
+    """
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_local, 'name', None)
+        _local.name = name
+        start = time.time()
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _local.name = outer
+            _record(name, (time.time() - start) * 1000, failed)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_module(module):
+    """
+    Replace every public function defined in the module with an instrumented
+    version. Calls between the functions of the module are recorded as well
+    since they are resolved through the module globals.
+    """
+    for name, func in inspect.getmembers(module, inspect.isfunction):
+        if name.startswith('_') or func.__module__ != module.__name__:
+            continue
+        if getattr(func, 'instrumented', False):
+            continue
+        setattr(module, name, instrument(func, name))
+
+
+def stats():
+    """
+    Returns the recorded statistics as a dictionary keyed by function name.
+    The histogram is keyed by the upper bound of each bucket in milliseconds.
+    """
+    labels = ['<={}ms'.format(b) for b in BUCKETS] + ['>{}ms'.format(BUCKETS[-1])]
+
+    result = {}
+    for name, entry in _stats.items():
+        result[name] = dict(entry)
+        result[name]['histogram'] = dict(zip(labels, entry['histogram']))
+        result[name]['avg_ms'] = entry['total_ms'] / entry['calls'] if entry['calls'] else 0.0
+    return result
+
+
+def reset():
+    _stats.clear()
+
+
+class CommandListener(monitoring.CommandListener):
+    """
+    Attributes database commands and their documents to the instrumented
+    function that issued them.
+    """
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        name = getattr(_local, 'name', None)
+        if name:
+            self._pending[(event.connection_id, event.request_id)] = (name, event.command_name)
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if not pending:
+            return
+
+        name, command = pending
+        entry = _entry(name)
+        entry['commands'] += 1
+
+        reply = event.reply
+        if 'cursor' in reply:
+            batch = reply['cursor'].get('firstBatch', reply['cursor'].get('nextBatch', []))
+            entry['docs_read'] += len(batch)
+        elif command in ('insert', 'update', 'delete'):
+            entry['docs_written'] += reply.get('n', 0)
+        elif command == 'findAndModify' and reply.get('value') is not None:
+            entry['docs_read'] += 1
+            entry['docs_written'] += 1
+
+    def failed(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending:
+            _entry(pending[0])['commands'] += 1
+
+
+def enabled():
+    return config['DATABASE'].get('instrument', 'false').lower() == 'true'
+
+
+def register_listener():
+    """
+    Register the command listener with pymongo. This must be called before
+    the connection to the database is established.
+    """
+    monitoring.register(CommandListener())
+    l.info("Database instrumentation enabled")
@@ -1,4 +1,5 @@
 import zipfile
+import io
 import os
 import logging
 import time
@@ -15,6 +16,8 @@ except ImportError:
 
 import remu.forms as forms
 import remu.database as db
+import remu.instrument
+from remu.remote import RemoteComponent
 from remu.settings import config
 
 
@@ -43,16 +46,27 @@ def index():
     if "sid" in session:
         # Start_workshop returns a list so we take the first element, split
         # the name by '_' and take the first part (i.e. session_port)
+        ids = session["sid"]
         sid = ids[0].split("_")[0]
 
         if not db.session_exists(sid):
             # If the session has been recycled, clear the cookie
             session.pop("sid", None)
+            sid = None
 
-    return render_template("index.html", workshops=workshops, sid=sid)
+    ticket = None
+    if "ticket" in session:
+        manager = current_app.config['MANAGER']
+        if manager.checkout_status(ticket=session["ticket"]):
+            ticket = session["ticket"]
+        else:
+            # The checkout has expired
+            session.pop("ticket", None)
+
+    return render_template("index.html", workshops=workshops, sid=sid, ticket=ticket)
 
 
-def build_rdp_files(ids, os_type):
+def build_rdp_files(ids, os_type, workshop):
     # We need the address for nginx
     addr = "{}:{}".format(config["NGINX"]["address"], config["NGINX"]["port"])
 
@@ -70,15 +84,9 @@ def build_rdp_files(ids, os_type):
         mem_zip = io.BytesIO()
 
         with zipfile.ZipFile(mem_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-            for sid, machine_name in zip(ids, machines):
-                filename = machine_name + '.rdp'
-
-                mem_file = io.StringIO(filename)
-                mem_file.write(render_template('rdp.jnj2', address=addr, session=sid))
-
-                zf.writestr(filename, mem_file.getvalue())
-
-                mem_file.close()
+            for i, sid in enumerate(ids):
+                filename = "{}_{}.rdp".format(workshop, i + 1)
+                zf.writestr(filename, render_template(template, address=addr, session=sid).encode('utf-8'))
 
         mem_zip.seek(0)
 
@@ -86,9 +94,7 @@ def build_rdp_files(ids, os_type):
         return (zip_name, mem_zip)
 
     filename = workshop + '.rdp'
-    mem_file = io.StringIO(filename)
-    mem_file.write(render_template('rdp.jnj2', address=addr, session=ids[0]))
-    mem_file.seek(0)
+    mem_file = io.BytesIO(render_template(template, address=addr, session=ids[0]).encode('utf-8'))
 
     return (filename, mem_file)
 
@@ -100,21 +106,52 @@ def checkout(os_type, workshop):
         flash("You've already started a workshop! Try the reconnect button or wait for your session to be recycled.")
         return redirect(url_for('user.index'))
 
+    if "ticket" in session:
+        flash("Your workshop is being prepared, it will download once it is ready.")
+        return redirect(url_for('user.index'))
+
     # Get handle to manager module
     manager = current_app.config['MANAGER']
 
-    ids = manager.start_workshop(workshop=workshop)
+    # The unit is built in the background, the progress is pushed to the
+    # end-user over socket.io and the RDP file is downloaded once it is ready
+    queued = manager.checkout(workshop=workshop)
+
+    if not queued:
+        l.error("Unable to queue a checkout for %s", workshop)
+        flash("Too many workshops are being prepared! Please try again in a few minutes.")
+        return redirect(url_for('user.index'))
+
+    session["ticket"] = queued[0]
+    session["os_type"] = os_type
+    session["workshop"] = workshop
+
+    return redirect(url_for('user.index'))
+
+
+@user_bp.route('/download')
+def download():
+    if "ticket" not in session:
+        return redirect(url_for('user.index'))
+
+    manager = current_app.config['MANAGER']
+    status = manager.checkout_status(ticket=session["ticket"])
+
+    if status and status['status'] not in ('ready', 'failed'):
+        return redirect(url_for('user.index'))
+
+    session.pop("ticket", None)
 
-    if not ids:
+    if not status or not status['ids']:
         l.error("Something weird happened. No IDs provided for checkout")
         flash("Error starting workshop! Please contact the adminstrator.")
         return redirect(url_for('user.index'))
 
     # Store ids in a cookie managed by Flask
-    session["sid"] = ids
+    session["sid"] = status['ids']
 
     try:
-        name, file = build_rdp_files(ids, os_type)
+        name, file = build_rdp_files(status['ids'], session["os_type"], session["workshop"])
         return send_file(file, attachment_filename=name, as_attachment=True)
 
     except Exception:
@@ -129,14 +166,14 @@ def fetch_document(workshop, filename):
     return send_from_directory(materials, filename, as_attachment=True)
 
 
-@user_bp.route('/reconnect/<path:workshop>')
-def reconnect(workshop):
+@user_bp.route('/reconnect')
+def reconnect():
     if "sid" not in session:
         flash("No session ID found!")
         return redirect(url_for('user.index'))
 
     ids = session["sid"]
-    name, file = build_rdp_files(ids, os_type)
+    name, file = build_rdp_files(ids, session["os_type"], session["workshop"])
 
     return send_file(file, attachment_filename=name, as_attachment=True)
 
@@ -149,8 +186,12 @@ Admin interface
 @login_required
 def home():
     # Not the most optimal but we should clean up the data a bit for display
-    data = db.get_all_servers()
+    data = db.get_all_servers(fields=['ip', 'port', 'cpu', 'mem', 'hdd'])
+    sessions = db.get_all_sessions(fields=['server', 'workshop', 'available', 'start_time', 'machines'])
     for server in data:
+        server['sessions'] = dict(
+            (sid, s) for sid, s in sessions.items() if s['server'] == server['ip'])
+
         for sid, s in server['sessions'].items():
             # Get workshop name by object id
             workshop = db.get_workshop(id=str(s["workshop"]))
@@ -165,7 +206,10 @@ def home():
                 machine['name'] = machine['name'][:machine['name'].rfind('_')]
                 machine['port'] = ("-" if machine['port'] == 1 else machine['port'])
 
-    return render_template('home.html', server_data=data, counts=db.session_to_workshop_count())
+    manager = current_app.config['MANAGER']
+
+    return render_template('home.html', server_data=data, counts=db.session_to_workshop_count(),
+                           metrics=db.get_server_metrics(3600), warmup=manager.warmup_status())
 
 @admin_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -190,14 +234,14 @@ def logout():
 @admin_bp.route('/servers', methods=['GET', 'POST'])
 @login_required
 def servers():
-    return render_template('servers.html', server_data=db.get_all_servers())
+    return render_template('servers.html', server_data=db.get_server_summaries())
 
 @admin_bp.route('/servers/add', methods=['GET', 'POST'])
 @login_required
 def add_server():
     form = forms.AddServerForm()
     if form.validate_on_submit():
-        db.insert_server(form.address.data, form.port.data)
+        db.insert_server(form.address.data, form.port.data, form.capacity.data)
         return redirect(url_for('admin.servers'))
     return render_template('add_server.html', form=form)
 
@@ -206,12 +250,14 @@ def add_server():
 def edit_server(address):
     form = forms.AddServerForm()
     if form.validate_on_submit():
-        db.update_server(ip=form.address.data, port=form.port.data)
+        db.update_server(ip=form.address.data, port=form.port.data,
+                         capacity=form.capacity.data)
         return redirect(url_for('admin.servers'))
 
     server = db.get_server(address)
     form.address.data = address
     form.port.data = server['port']
+    form.capacity.data = server.get('capacity', 1.0)
     return render_template('add_server.html', form=form)
 
 @admin_bp.route('/servers/remove/<path:address>', methods=['GET', 'POST'])
@@ -261,7 +307,8 @@ def add_workshop():
             form.description.data,
             form.mini.data,
             form.maxi.data,
-            form.enabled.data
+            form.enabled.data,
+            form.footprint.data
         )
 
         return redirect(url_for('admin.workshops'))
@@ -278,7 +325,8 @@ def edit_workshop(oid):
             description=form.description.data,
             min_instances=form.mini.data,
             max_instances=form.maxi.data,
-            enabled=form.enabled.data
+            enabled=form.enabled.data,
+            footprint=form.footprint.data
         )
         
         if bool(form.materials.data[0]):
@@ -297,6 +345,7 @@ def edit_workshop(oid):
         form.description.data = workshop["description"]
         form.mini.data = workshop["min_instances"]
         form.maxi.data = workshop["max_instances"]
+        form.footprint.data = workshop.get("footprint", 1.0)
         form.enabled.data = workshop["enabled"]
 
         materials = os.path.join(config["REMU"]["workshops"], workshop['name'], "materials")
@@ -326,6 +375,29 @@ def remove_workshop(oid):
     db.remove_workshop(oid)
     return redirect(url_for('admin.workshops'))
 
+@admin_bp.route('/database', methods=['GET', 'POST'])
+@login_required
+def database():
+    manager = current_app.config['MANAGER']
+    data = {'Manager': manager.db_stats()}
+    caches = {'Manager': manager.cache_stats()}
+
+    # The web tier has its own statistics when the manager runs remotely
+    if isinstance(manager, RemoteComponent):
+        data['Web'] = remu.instrument.stats()
+        caches['Web'] = db.workshop_cache_stats()
+
+    return render_template('database.html', data=data, caches=caches,
+                           enabled=remu.instrument.enabled())
+
+@admin_bp.route('/database/reset', methods=['GET', 'POST'])
+@login_required
+def reset_database_stats():
+    manager = current_app.config['MANAGER']
+    manager.db_stats(reset=True)
+    remu.instrument.reset()
+    return redirect(url_for('admin.database'))
+
 @admin_bp.route('/kill_session/<path:sid>', methods=['GET', 'POST'])
 @login_required
 def kill_session(sid):
@@ -1,14 +1,23 @@
 """ TODO """
 import logging
 import gevent
+import gevent.queue
+import gevent.lock
 import bson
 import time
+import random
 
 from remu.settings import config
 import remu.database as db
 import remu.util
 import remu.remote
+import remu.instrument
 import remu.server
+import remu.scheduler
+import remu.autoscaler
+import remu.admission
+from remu.state import ClusterState
+from remu.recycle import RecycleScheduler
 
 l = logging.getLogger(config["REMU"]["logger"])
 
@@ -21,39 +30,155 @@ class Manager():
         self.pm = monitor
         self.servers = {}
 
-        if server:
-            try:
-                db.remove_server("127.0.0.1")
-            except Exception:
-                pass
+        # Metric samples gathered during a monitor tick
+        self.metrics = []
+
+        # Circuit breakers of the servers polled by the monitor service
+        self.breakers = {}
+
+        # Move any sessions still embedded in server documents into the
+        # session collection before the servers are touched.
+        db.migrate_sessions()
+
+        self.state = ClusterState()
+        self.state.reload()
+
+        self.scheduler = remu.scheduler.create(self.state)
+        self.autoscaler = remu.autoscaler.create()
 
-            db.insert_server("127.0.0.1", 9000)
+        # Units are kept across restarts unless the servers remove them on exit
+        self.keep_units = config['REMU'].get('keep_units', 'true').lower() == 'true'
+
+        if server:
+            if "127.0.0.1" not in self.state.servers:
+                self.state.insert_server("127.0.0.1", 9000)
             self.servers["127.0.0.1"] = server
 
         # Create WorkshopManager objects for each server
-        servers = db.get_all_servers()
-        for s in servers:
-            if s["ip"] != "127.0.0.1":
-                self.register_remote_server(s["ip"], s["port"])
+        for s in self.state.servers.values():
+            if s.ip != "127.0.0.1":
+                self.register_remote_server(s.ip, s.port)
 
-        # Start sessions for min instances
-        l.info("Starting minimum instances...")
-        workshops = [w for w in db.get_all_workshops() if w['enabled']]
-        for w in workshops:
-            for dummy in range(w["min_instances"]):
-                self._setup_available_workshop(w["name"])
+        # Adopt the units left on the servers by the previous run
+        self.reconcile()
+
+        # Placement decisions are serialized so concurrent builds see the
+        # sessions reserved by each other
+        self.placement_lock = gevent.lock.Semaphore()
+
+        # Number of units each server is allowed to clone at the same time
+        self.build_slots = {}
+
+        # Number of available units of each workshop being built
+        self.building = {}
+
+        # Start sessions for min instances in the background
+        self.warmup = {'total': 0, 'done': 0, 'failed': 0}
+        self.warmup_thread = gevent.spawn(self._start_min_instances)
+
+        # Checkouts waiting for or being handled by a build worker, keyed by
+        # the ticket handed out to the end-user
+        self.tickets = {}
+        self.build_queue = gevent.queue.Queue(int(config['REMU'].get('build_queue', 64)))
+        self.build_workers = [
+            gevent.spawn(self._build_worker)
+            for dummy in range(int(config['REMU'].get('build_workers', 4)))
+        ]
+
+        # Checkouts made while the cluster is at capacity wait to be admitted
+        self.admission = remu.admission.AdmissionController(
+            int(config['REMU'].get('waitlist_size', 200)))
+        self.admission_thread = gevent.spawn(self.admission_service)
 
         self.monitor_thread = gevent.spawn(self.monitor_service)
 
+        self.autoscale_thread = None
+        if self.autoscaler:
+            self.autoscale_thread = gevent.spawn(self.autoscale_service)
+
     def clean_up(self):
         l.info(" ... Manager cleaning up")
 
-        if "127.0.0.1" in self.servers:
-            db.remove_server("127.0.0.1")
+        if "127.0.0.1" in self.servers and not self.keep_units:
+            self.state.remove_server("127.0.0.1")
 
         # TODO: remove session entries from all remote servers
 
         self.monitor_thread.kill()
+        self.warmup_thread.kill()
+        self.admission_thread.kill()
+        gevent.killall(self.build_workers)
+        if self.autoscale_thread:
+            self.autoscale_thread.kill()
+
+
+    @classmethod
+    def db_stats(cls, reset=False):
+        """
+        Returns the database instrumentation statistics recorded by the
+        manager process, optionally clearing them afterwards.
+        """
+        stats = remu.instrument.stats()
+        if reset:
+            remu.instrument.reset()
+        return stats
+
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        Returns the hit and miss counters of the workshop cache of the
+        manager process.
+        """
+        return db.workshop_cache_stats()
+
+
+    def reconcile(self):
+        """
+        Diff the units on every server against the sessions in the database.
+        Healthy units are adopted, sessions without one are removed, units
+        without a session are removed from their server and the NGINX
+        mappings are rebuilt for the active sessions. Servers which cannot be
+        reached keep their sessions until they are polled.
+        """
+        l.info("Reconciling the cluster state with the servers...")
+
+        jobs = [gevent.spawn(self._reconcile_server, ip) for ip in self.servers]
+        gevent.joinall(jobs)
+
+        active = self.state.get_active_sessions()
+        self.nginx.reset_mappings(sessions=dict(
+            (sid, [s.server, self.state.get_vrde_ports(sid)]) for sid, s in active.items()))
+
+        l.info("Reconciled: %d sessions adopted (%d active), %d units removed",
+               sum(job.value[0] for job in jobs if job.value),
+               len(active),
+               sum(job.value[1] for job in jobs if job.value))
+
+
+    def _reconcile_server(self, ip):
+        server = self.servers[ip]
+
+        try:
+            units = server.list_units()
+        except Exception:
+            l.exception("Unable to list the units of %s", ip)
+            return None
+
+        if units is None:
+            l.error("Unable to list the units of %s", ip)
+            return None
+
+        adopted, discard = self.state.reconcile(ip, units)
+
+        for sid in discard:
+            l.info("Removing unit %s from %s", sid, ip)
+            try:
+                server.remove_unit(sid=sid, force=True)
+            except Exception:
+                l.exception("Unable to remove unit %s from %s", sid, ip)
+
+        return len(adopted), len(discard)
 
 
     def register_remote_server(self, ip, port):
@@ -62,93 +187,352 @@ class Manager():
         l.debug("Registering remote component for %s", ip)
 
 
-    def start_workshop(self, workshop):
+    def checkout(self, workshop):
+        """
+        Queue the start of a new session for a workshop participant.
+        Returns a list holding the ticket to follow the progress of the
+        checkout with, or None if the build queue is full. The ticket is
+        wrapped so it is not read back as a number (or not at all) when the
+        reply of a remote manager is evaluated.
+        """
+        self._expire_tickets()
+
+        ticket = remu.util.rand_str(16)
+        self.tickets[ticket] = {
+            'workshop': workshop,
+            'status': 'queued',
+            'done': 0,
+            'total': 0,
+            'ids': None,
+            'time': time.time()
+        }
+
+        try:
+            self.build_queue.put_nowait(ticket)
+        except gevent.queue.Full:
+            l.error("Build queue is full, unable to checkout a %s workshop", workshop)
+            del self.tickets[ticket]
+            return None
+
+        return [ticket]
+
+
+    def checkout_status(self, ticket):
+        """
+        Returns the progress of a checkout or None if the ticket is unknown.
+        The ids of the VRDE ports are set once the status is ready.
+        """
+        return self.tickets.get(ticket)
+
+
+    def checkout_progress(self):
+        """
+        Returns the progress of every checkout in progress or recently
+        completed, keyed by ticket.
+        """
+        self._expire_tickets()
+        return dict(self.tickets)
+
+
+    def _expire_tickets(self):
+        """
+        Forget the checkouts completed for longer than the ticket ttl, and
+        fail the checkouts which waited for capacity for longer than the
+        waitlist timeout.
+        """
+        now = time.time()
+        expiry = now - float(config['REMU'].get('ticket_ttl', 300))
+        timeout = now - float(config['REMU'].get('waitlist_timeout', 600))
+        for ticket, entry in self.tickets.items():
+            if entry['status'] in ('ready', 'failed') and entry['time'] < expiry:
+                del self.tickets[ticket]
+            elif entry['status'] == 'waiting' and entry['time'] < timeout:
+                l.info("Checkout of a %s workshop gave up waiting for capacity", entry['workshop'])
+                self.admission.remove(ticket)
+                self._progress(ticket, 'failed')
+
+
+    def _progress(self, ticket, status, done=0, total=0):
+        if ticket in self.tickets:
+            self.tickets[ticket].update(status=status, done=done, total=total, time=time.time())
+
+
+    def _build_worker(self):
+        """
+        Handle queued checkouts one at a time.
+        """
+        while True:
+            ticket = self.build_queue.get()
+            entry = self.tickets.get(ticket)
+            if not entry:
+                continue
+
+            # Checkouts wait when they cannot be placed, or when others are
+            # already waiting for the workshop so they do not jump the line
+            workshop = entry['workshop']
+            admitted = entry.pop('admitted', False)
+
+            try:
+                wait = (self.admission.waiting(workshop) and not admitted) or \
+                       not self._has_capacity(workshop)
+            except Exception:
+                l.exception("Checkout of a %s workshop failed", workshop)
+                self._progress(ticket, 'failed')
+                continue
+
+            if wait:
+                if self.admission.enqueue(workshop, ticket, front=admitted):
+                    l.info("Checkout of a %s workshop is waiting for capacity", workshop)
+                    self._progress(ticket, 'waiting')
+                else:
+                    l.error("Waitlist for %s is full", workshop)
+                    self._progress(ticket, 'failed')
+                continue
+
+            try:
+                ids = self.start_workshop(entry['workshop'], ticket)
+            except Exception:
+                l.exception("Checkout of a %s workshop failed", entry['workshop'])
+                ids = None
+
+            entry['ids'] = ids
+            self._progress(ticket, 'ready' if ids else 'failed')
+
+
+    def _has_capacity(self, workshop):
+        """
+        Returns true if a checkout of the workshop can be placed right away.
+        """
+        if self.state.session_count_by_workshop(workshop, available=True):
+            return True
+        return self.load_balance(workshop, False) is not None
+
+
+    def admission_service(self):
+        """
+        Admit the waiting checkouts as capacity frees up and update their
+        positions and estimated waits. At most one checkout per workshop is
+        admitted until a build worker has picked it up, so a single free
+        unit is not handed to several waiting checkouts.
+        """
+        while True:
+            gevent.sleep(1)
+
+            self._expire_tickets()
+            if not len(self.admission):
+                continue
+
+            pending = set(entry['workshop'] for entry in self.tickets.values()
+                          if entry.get('admitted'))
+
+            # Workshops whose capacity could not be checked, the checkout
+            # at the head of their waitlist is admitted only to be failed
+            errors = set()
+
+            def has_capacity(workshop):
+                if workshop in pending:
+                    return False
+                try:
+                    return self._has_capacity(workshop)
+                except Exception:
+                    l.exception("Unable to check the capacity for %s", workshop)
+                    errors.add(workshop)
+                    return True
+
+            admitted = self.admission.admit(has_capacity)
+            while admitted:
+                workshop, ticket = admitted
+
+                if workshop in errors:
+                    errors.discard(workshop)
+                    l.error("Failing a waiting %s checkout", workshop)
+                    self._progress(ticket, 'failed')
+                    admitted = self.admission.admit(has_capacity)
+                    continue
+
+                pending.add(workshop)
+
+                if ticket in self.tickets:
+                    l.info("Admitting a waiting %s checkout", workshop)
+                    self.tickets[ticket]['admitted'] = True
+                    self._progress(ticket, 'queued')
+                    self.build_queue.put(ticket)
+
+                admitted = self.admission.admit(has_capacity)
+
+            if self.autoscaler:
+                build_time = self.autoscaler.build_estimate
+            else:
+                build_time = lambda workshop: float(config.get('AUTOSCALER', {}).get('build_time', 120))
+
+            for ticket, (position, eta) in self.admission.positions(build_time).items():
+                if ticket in self.tickets:
+                    self.tickets[ticket].update(position=position, eta=eta)
+
+
+    def start_workshop(self, workshop, ticket=None):
         """
         Start a new session for a workshop participant.
         Returns a string containing a session id, the VRDE ports for the workshop unit,
-        and the password associated with the session.
+        and the password associated with the session. The progress is recorded
+        under the ticket if one is given.
         """
 
         l.info("Starting a %s workshop", workshop)
 
-        # Call load balancer to get server node and possible existing session
-        server = self.load_balance(workshop)
-        if not server:
-            l.info(" ... no suitable server found!")
-            return None
-        l.info("Load balancer selected: %s", server)
+        if self.autoscaler:
+            self.autoscaler.record_checkout(workshop)
 
-        # Get the session
-        sid = db.get_available_session(server, workshop)
+        # Claim an existing session from any server, otherwise call the
+        # load balancer to select a server for a new session
+        claimed = self.state.claim_available_session(workshop)
 
-        if sid:
-            db.update_session(server, sid, False)
+        if claimed:
+            server, sid = claimed
+            l.info("Claimed available session on: %s", server)
         else:
-            sid = self._create_session(server, workshop)
-            self._build_workshop(server, workshop, sid)
+            with self.placement_lock:
+                server = self.load_balance(workshop, False)
+                if not server:
+                    l.info(" ... no suitable server found!")
+                    return None
+                l.info("Load balancer selected: %s", server)
 
-        l.info("Using session: %s", sid)
+                sid = self._create_session(server, workshop, available=False)
 
-        self.servers[server].start_unit(sid=sid)
+        # The session and its unit are removed if the unit cannot be built
+        # or started, so a failed checkout does not hold on to them
+        try:
+            if not claimed:
+                self._build_workshop(server, workshop, sid, ticket)
+
+            l.info("Using session: %s", sid)
+
+            self._progress(ticket, 'booting')
+            if not self.servers[server].start_unit(sid=sid):
+                l.error("Unable to start unit %s on %s", sid, server)
+                raise Exception
 
-        vrde_ports = db.get_vrde_ports(sid)
+            vrde_ports = self.state.get_vrde_ports(sid)
 
-        # Add entries to NGINX
-        self.nginx.add_mapping(
-            session=sid,
-            server=server,
-            ports=vrde_ports
-        )
+            # Add entries to NGINX
+            self.nginx.add_mapping(
+                session=sid,
+                server=server,
+                ports=vrde_ports
+            )
+        except Exception:
+            self._discard_session(server, sid)
+            raise
 
         return ["{}_{}".format(sid, port) for port in vrde_ports]
 
 
     def _setup_available_workshop(self, workshop):
-        server = self.load_balance(workshop, False)
-        if not server:
-            l.info(" ... no suitable server found!")
-            return None
-        l.info("Load balancer selected: %s", server)
+        self.building[workshop] = self.building.get(workshop, 0) + 1
+        try:
+            return self._build_available_workshop(workshop)
+        finally:
+            self.building[workshop] -= 1
+
+
+    def _build_available_workshop(self, workshop):
+        with self.placement_lock:
+            server = self.load_balance(workshop, False)
+            if not server:
+                l.info(" ... no suitable server found!")
+                return None
+            l.info("Load balancer selected: %s", server)
+
+            # The session is only made available once its unit is built, so
+            # it cannot be claimed while it is being cloned
+            sid = self._create_session(server, workshop, available=False)
 
-        sid = self._create_session(server, workshop)
         l.info("Using session: %s", sid)
 
-        self._build_workshop(server, workshop, sid)
+        try:
+            self._build_workshop(server, workshop, sid)
+        except Exception:
+            self._discard_session(server, sid)
+            raise
 
+        self.state.update_session(server, sid, True)
+        return sid
 
-    @classmethod
-    def load_balance(cls, workshop, check_available=True):
+
+    def _start_min_instances(self):
+        """
+        Build the minimum instances of every enabled workshop which are not
+        covered by the units adopted at startup. All builds are started at
+        once and spread across the servers by the load balancer, while the
+        build slots of each server bound how many run at a time.
+        """
+        l.info("Starting minimum instances...")
+
+        missing = [(w["name"], max(0, w["min_instances"] - self.state.session_count_by_workshop(w["name"])))
+                   for w in db.get_all_workshops() if w['enabled']]
+
+        self.warmup['total'] = sum(count for name, count in missing)
+        jobs = [gevent.spawn(self._warmup_workshop, name)
+                for name, count in missing
+                for dummy in range(count)]
+        gevent.joinall(jobs)
+
+        l.info("Minimum instances started: %d built, %d failed",
+               self.warmup['done'], self.warmup['failed'])
+
+
+    def _warmup_workshop(self, workshop):
+        try:
+            sid = self._setup_available_workshop(workshop)
+        except Exception:
+            l.exception("Failed to start a minimum instance of %s", workshop)
+            sid = None
+
+        self.warmup['done' if sid else 'failed'] += 1
+
+
+    def warmup_status(self):
+        """
+        Returns the progress of the minimum instances started in the background.
+        """
+        return dict(self.warmup)
+
+
+    def _build_slot(self, ip):
+        if ip not in self.build_slots:
+            self.build_slots[ip] = gevent.lock.BoundedSemaphore(
+                int(config['REMU'].get('server_builds', 2)))
+        return self.build_slots[ip]
+
+
+    def load_balance(self, workshop, check_available=True):
         """
         Distributes the creation of workshop units across all server nodes available.
 
         The priority of server selection is as follows:
             1. A server has an available session (i.e. a workshop unit).
-            2. The server with the least amount of running sessions.
+            2. The server chosen by the configured scheduler policy.
         """
 
         l.debug("Load balance for a %s workshop", workshop)
 
-        # Check if any servers have an available session
-        servers = db.get_all_servers()
-        if not bool(servers):
+        placement = self.state.placement
+
+        if not bool(self.state.servers):
             l.error("Attempting to load balance with no servers!")
             return None
 
+        # Check if any servers have an available session
         if check_available:
-            for server in servers:
-                l.debug(" ... checking for available session at server: %s", server["ip"])
-
-                count = db.session_count_by_workshop(workshop, server['ip'], True)
-                l.debug(" ... found %d available", count)
-
-                if count > 0:
-                    return server['ip']
+            ip = placement.server_with_available(workshop)
+            if ip:
+                l.debug(" ... found available session at server: %s", ip)
+                return ip
 
         l.debug(" ... checking if we can spawn a new session")
 
-        instances = 0
-        for server in servers:
-            instances += db.session_count_by_workshop(workshop, server['ip'])
+        instances = placement.workshop_count(workshop)
         l.debug(" ... total instances for %s: %d", workshop, instances)
 
         max_instances = db.get_workshop(name=workshop)['max_instances']
@@ -157,36 +541,13 @@ class Manager():
             l.error("Maximum number of instances met or exceeded.")
             return None
 
-        # Find server with least amount of workshops running
-        l.debug(" ... selecting server with least amount of workshops running")
-        sessions = 9999
-        min_ip = 0
-        for i, server in enumerate(servers):
-            count = db.session_count(server['ip'])
-            l.debug(" ... session count for %s: %d", server['ip'], count)
-            if count < sessions:
-                sessions = count
-                min_ip = i
-                l.debug(" ... setting min_ip to %s", server['ip'])
-
-        # Finally ensure the server has enough resources
-        server = servers[min_ip]
-        try:
-            if server['mem'] < float(config['REMU']['mem_limit']) and \
-               server['hdd'] < float(config['REMU']['hdd_limit']):
-                return server['ip']
-        except KeyError:
-            l.warn(" ... making decision without hardware check!")
-            return server['ip']
-
-        l.error(" ... unable to find a suitable server!")
-        return None
+        return self.scheduler.select(workshop)
 
 
-    def _create_session(self, server, workshop):
+    def _create_session(self, server, workshop, available=True):
         session = self._create_session_id()
         password = self._create_password()
-        db.insert_session(server, session, workshop, password)
+        self.state.insert_session(server, session, workshop, password, available)
         return session
 
 
@@ -201,93 +562,367 @@ class Manager():
         return remu.util.rand_str(int(config['REMU']['pass_len']))
 
 
-    def _build_workshop(self, ip, workshop, session_id):
+    def _build_workshop(self, ip, workshop, session_id, ticket=None):
         """ TODO """
         server = self.servers[ip]
-        session = db.get_session(ip, session_id)
 
-        server.clone_unit(workshop=workshop, session_id=session_id)
+        poller = gevent.spawn(self._poll_clone, server, session_id, ticket) if ticket else None
+
+        try:
+            with self._build_slot(ip):
+                start = time.time()
+                if not server.clone_unit(workshop=workshop, session_id=session_id):
+                    l.error("Unable to clone a %s unit on %s", workshop, ip)
+                    raise Exception
+        finally:
+            if poller:
+                poller.kill()
+
+        if self.autoscaler:
+            self.autoscaler.record_build(workshop, time.time() - start)
 
         for machine in server.unit_to_str(sid=session_id):
-            db.insert_machine(ip, session_id, machine['name'], machine['port'])
+            self.state.insert_machine(ip, session_id, machine['name'], machine['port'])
+
+
+    def _discard_session(self, ip, session_id):
+        """
+        Remove a session whose unit could not be built, along with whatever
+        part of the unit was left on the server.
+        """
+        l.info("Discarding session %s on %s", session_id, ip)
+        self.state.remove_session(ip, session_id)
+        self._remove_unit(ip, session_id)
+
+
+    def _remove_unit(self, ip, session_id):
+        """
+        Force the removal of whatever is left of a unit on a server. Errors
+        are logged rather than raised.
+        """
+        try:
+            if not self.servers[ip].remove_unit(sid=session_id, force=True):
+                l.error("Unable to remove unit %s from %s", session_id, ip)
+        except Exception:
+            l.exception("Unable to remove unit %s from %s", session_id, ip)
+
+
+    def _poll_clone(self, server, session_id, ticket):
+        """
+        Record the number of machines cloned for the checkout until killed.
+        """
+        self._progress(ticket, 'cloning')
+
+        while True:
+            status = server.clone_status(sid=session_id)
+            if status:
+                self._progress(ticket, 'cloning', status[0], status[1])
+            gevent.sleep(1)
 
 
     def stop_workshop(self, session_id):
         l.info("Stopping session: %s", session_id)
 
-        server_data = db.get_server_from_session(session_id)
-        ip = server_data['ip']
+        ip = self.state.get_session(session_id).server
 
         server = self.servers[ip]
         server.stop_unit(sid=session_id)
         workshop = db.get_workshop_from_session(ip, session_id)
-        db.remove_session(ip, session_id)
+        self.state.remove_session(ip, session_id)
         self.nginx.remove_mapping(session=session_id)
+        self.admission.record_release(workshop['name'])
 
         # Get the current number of sessions for the workshop
-        instances = db.session_count_by_workshop(ip, workshop['name'])
+        instances = self.state.session_count_by_workshop(workshop['name'])
         l.info("Current # of instances for %s: %d", workshop['name'], instances)
 
         # Ensure the minimum amount of sessions are met
         if instances < workshop['min_instances']:
-            new_sid = self._create_session(ip, workshop['name'])
-            server.restore_unit(sid=session_id, new_sid=new_sid)
-            for machine in server.unit_to_str(sid=new_sid):
-                db.insert_machine(ip, new_sid, machine['name'], machine['port'])
+            new_sid = self._create_session(ip, workshop['name'], available=False)
+            try:
+                if not server.restore_unit(sid=session_id, new_sid=new_sid):
+                    l.error("Unable to restore unit %s on %s", session_id, ip)
+                    raise Exception
+                for machine in server.unit_to_str(sid=new_sid):
+                    self.state.insert_machine(ip, new_sid, machine['name'], machine['port'])
+            except Exception:
+                # The machines may be left under either session id
+                self._discard_session(ip, new_sid)
+                self._remove_unit(ip, session_id)
+                raise
+            self.state.update_session(ip, new_sid, True)
         else:
             # Remove machine
             server.remove_unit(sid=session_id)
 
 
-    def _status_update(self, ip):
+    def vrde_events(self, sessions):
+        """
+        Apply the machine states pushed by a server node for the sessions
+        which changed since its last push.
+        sessions - dictionary mapping session ids to lists of machine data
+        Returns the number of sessions applied.
+        """
+        by_server = {}
+        for sid, machines in sessions.items():
+            session = self.state.get_session(sid)
+            if session:
+                by_server.setdefault(session.server, {})[sid] = machines
+
+        for ip, reported in by_server.items():
+            self.state.update_sessions(ip, reported)
+
+        return sum(len(reported) for reported in by_server.values())
+
+
+    def _status_update(self, ip, sessions=True):
         l.debug("Getting status update for %s", ip)
 
+        start = time.time()
         if ip == "127.0.0.1":
-            status = self.pm.update()
+            status = self.pm.update(sessions=sessions)
         else:
-            status = self.servers[ip].update()
+            status = self.servers[ip].update(sessions=sessions)
+        latency = (time.time() - start) * 1000
+
+        if not status:
+            l.error("No status update received from %s", ip)
+            raise Exception
 
-        db.update_server(ip, cpu=status["cpu"], mem=status["mem"], hdd=status["hdd"])
         l.debug(" ... update: %s", str(status))
+        self.state.update_status(ip, status)
+
+        self.metrics.append({
+            'server': ip,
+            'workshop': None,
+            'time': time.time(),
+            'values': {
+                'cpu': status['cpu'],
+                'mem': status['mem'],
+                'hdd': status['hdd'],
+                'poll_ms': latency
+            }
+        })
+
+
+    def _breaker(self, ip):
+        if ip not in self.breakers:
+            self.breakers[ip] = remu.util.CircuitBreaker(
+                int(config['REMU'].get('breaker_threshold', 3)),
+                float(config['REMU'].get('breaker_cooldown', 120)))
+        return self.breakers[ip]
+
+
+    def _poll_server(self, ip, delay, timeout, sessions=True):
+        """
+        Update the status of a server after the given delay. The update is
+        abandoned after timeout seconds and failures are counted by the
+        circuit breaker of the server.
+        """
+        gevent.sleep(delay)
+        breaker = self._breaker(ip)
+
+        try:
+            with gevent.Timeout(timeout):
+                self._status_update(ip, sessions)
+            breaker.success()
+            return
+
+        except gevent.Timeout:
+            l.error("Status update for %s timed out after %.1f seconds", ip, timeout)
+        except Exception:
+            l.exception("Status update for %s failed", ip)
+
+        breaker.failure()
+        if breaker.state == 'open':
+            l.error("Not polling %s for %d seconds after %d failures",
+                    ip, breaker.cooldown, breaker.failures)
+
+
+    def _record_metrics(self):
+        """
+        Add the cluster wide workshop samples to the metrics gathered during
+        the status updates and write them as a single batch.
+        """
+        now = time.time()
+        counts = self.state.session_counts()
+        connected = self.state.connected_counts()
+
+        for workshop, count in counts.items():
+            self.metrics.append({
+                'server': None,
+                'workshop': workshop,
+                'time': now,
+                'values': {
+                    'sessions': count['total'],
+                    'active': count['active'],
+                    'connected': connected.get(workshop, 0)
+                }
+            })
+
+        samples, self.metrics = self.metrics, []
+        try:
+            db.insert_metrics(samples)
+        except Exception:
+            l.exception("Dropping %d metric samples", len(samples))
+
 
-        for sid in status['sessions']:
-            db.update_machines(ip, sid, status['sessions'][sid])
+    def _observe_usage(self, window):
+        """
+        Hand the host metrics rolled up over the window to the scheduler.
+        """
+        try:
+            self.scheduler.observe(db.get_server_metrics(window))
+        except Exception:
+            l.exception("Unable to read the server metrics")
+
+
+    def _trim_available_workshop(self, workshop):
+        """
+        Remove one available unit of the workshop. The unit is claimed first
+        so it cannot be handed out while it is being removed.
+        """
+        claimed = self.state.claim_available_session(workshop)
+        if not claimed:
+            return
+
+        ip, sid = claimed
+        l.info("Trimming available session %s on %s", sid, ip)
+
+        try:
+            removed = self.servers[ip].remove_unit(sid=sid)
+        except Exception:
+            l.exception("Unable to remove unit %s from %s", sid, ip)
+            removed = False
+
+        # A unit which could not be removed keeps its claimed session, so it
+        # is recycled by the monitor service which tries to remove it again
+        if not removed:
+            l.error("Keeping session %s of the unit left on %s", sid, ip)
+            return
+
+        self.state.remove_session(ip, sid)
+
+
+    def autoscale_service(self):
+        """
+        Keep the number of available units of each enabled workshop at the
+        demand predicted by the autoscaler. Missing units are built in the
+        background, while surplus units are removed one per interval so a
+        short lull does not tear down the whole pool.
+        """
+        interval = int(config.get('AUTOSCALER', {}).get('interval', 15))
+
+        while True:
+            gevent.sleep(interval)
+
+            for w in db.get_all_workshops(fields=['name', 'enabled', 'min_instances', 'max_instances']):
+                if w['enabled']:
+                    self._autoscale_workshop(w)
+
+
+    def _autoscale_workshop(self, w):
+        """
+        Start the builds missing from the target of the workshop, or trim one
+        of its surplus available units.
+        """
+        # Units being built are reserved unavailable, but count towards the
+        # available units rather than the active ones
+        name = w['name']
+        total = self.state.session_count_by_workshop(name)
+        available = self.state.session_count_by_workshop(name, available=True)
+        building = self.building.get(name, 0)
+        target = self.autoscaler.target(
+            name, w['min_instances'], w['max_instances'], total - available - building)
+
+        if available + building < target:
+            l.info("Autoscaler: %s has %d available and %d building, target %d",
+                   name, available, building, target)
+            for dummy in range(target - available - building):
+                gevent.spawn(self._setup_available_workshop, name)
+        elif available > target:
+            l.info("Autoscaler: %s has %d available, target %d", name, available, target)
+            try:
+                self._trim_available_workshop(name)
+            except Exception:
+                l.exception("Failed to trim an available %s session", name)
+
+
+    def _schedule_recycling(self, recycle, now):
+        """
+        Schedule or cancel the recycling of the sessions changed since the
+        last tick. Active sessions without a VRDE connection are idle.
+        """
+        building = set()
+
+        for sid in self.state.pop_changes():
+            session = self.state.get_session(sid)
+            if session and not session.machines:
+                # Units still being built are looked at again once they are
+                building.add(sid)
+            elif session and not session.available and not session.connected:
+                if sid not in recycle:
+                    l.debug("Adding to recycle, sid: %s", sid)
+                recycle.idle(sid, now)
+            elif sid in recycle:
+                l.debug("Session is now active, removing from recycle: %s", sid)
+                recycle.cancel(sid)
+
+        self.state.changes.update(building)
+
+
+    def _recycle(self, recycle, now):
+        """
+        Stop the sessions which have been idle for longer than the delay. A
+        session which fails to stop is scheduled again.
+        """
+        for sid in recycle.due(now):
+            try:
+                self.stop_workshop(sid)
+            except Exception:
+                l.exception("Failed to recycle session: %s", sid)
+                if self.state.get_session(sid):
+                    recycle.idle(sid, now)
 
 
     def monitor_service(self):
         # Sessions to be recycled after the timeout interval
-        recycle = {}
-        delay = int(config['REMU']['recycle_delay'])
+        recycle = RecycleScheduler(int(config['REMU']['recycle_delay']))
         interval = int(config['REMU']['polling_interval'])
+        timeout = float(config['REMU'].get('poll_timeout', 10))
+        jitter = float(config['REMU'].get('poll_jitter', 5))
+
+        # Machine states are pushed by the servers as they change, so the
+        # sessions are only polled as a safety net every resync interval
+        resync = float(config['REMU'].get('resync_interval', interval))
+        last_resync = 0
+
+        # The scheduler reads the rolled up host usage at every resync
+        window = float(config.get('SCHEDULER', {}).get('usage_window', 300))
 
         while True:
             gevent.sleep(interval)
 
-            l.info("Sessions up for recycling: %s", str(recycle.keys()))
-            # Update the status of the system
-            jobs = [gevent.spawn(self._status_update(ip)) for ip in self.servers]
+            full = time.time() >= last_resync + resync
+            if full:
+                last_resync = time.time()
+
+            l.info("Sessions up for recycling: %d", len(recycle))
+            # Update the status of the system. Every server is polled at the
+            # same time, each after a random delay so the requests are spread
+            # out, which bounds the tick by the jitter and timeout.
+            jobs = [
+                gevent.spawn(self._poll_server, ip, random.uniform(0, jitter), timeout, full)
+                for ip in list(self.servers) if self._breaker(ip).allow()
+            ]
             gevent.joinall(jobs)
-
-            # Get active sessions
-            active = db.get_active_sessions()
-            l.debug("Current active sessions: %s", str(active.keys()))
-
-            if active:
-                # Check for active sessions with no active vrde connections
-                for sid, session in active.items():
-                    if not any([machine['vrde_active'] for machine in session['machines']]):
-                        if sid not in recycle:
-                            l.debug("Adding to recycle, sid: %s", sid)
-                            recycle[sid] = time.time()
-                    else:
-                        if sid in recycle:
-                            l.debug("Session is now active, removing from recycle: %s", sid)
-                            del recycle[sid]
-
-            # Check if any sessions have exceeded the delay
-            if recycle:
-                for sid, stime in recycle.copy().items():
-                    now = time.time()
-                    if now >= stime + delay:
-                        self.stop_workshop(sid)
-                        del recycle[sid]
+            self._record_metrics()
+            if full:
+                self._observe_usage(window)
+
+            # Only the sessions whose state changed are looked at, then the
+            # sessions which have been idle for longer than the delay are
+            # stopped
+            now = time.time()
+            self._schedule_recycling(recycle, now)
+            self._recycle(recycle, now)
@@ -1,6 +1,7 @@
 from mongoengine import (
-    Document, StringField, BooleanField, IntField, ListField, MapField,
-    EmbeddedDocument, EmbeddedDocumentField, ReferenceField, FloatField
+    Document, StringField, BooleanField, IntField, ListField, DictField,
+    EmbeddedDocument, EmbeddedDocumentField, ReferenceField, FloatField,
+    DateTimeField
     )
 from flask_login import UserMixin
 
@@ -13,6 +14,10 @@ class Workshop(Document):
     min_instances = IntField(min_value=0, required=True)
     max_instances = IntField(min_value=0, required=True)
 
+    # Relative cost of one unit of the workshop used by the scheduler. A
+    # unit of a workshop with a footprint of 2.0 counts as two standard units.
+    footprint = FloatField(min_value=0.0, default=1.0)
+
 class Machine(EmbeddedDocument):
     name = StringField()
     port = IntField(min_value=1, max_value=65535)
@@ -20,21 +25,58 @@ class Machine(EmbeddedDocument):
     vrde_active = BooleanField(default=False)
     vrde_enabled = BooleanField(default=False)
 
-class Session(EmbeddedDocument):
-    workshop = ReferenceField(Workshop, required=True)
-    machines = ListField(EmbeddedDocumentField(Machine))
-    password = StringField(required=True)
-    available = BooleanField(required=True)
-    start_time = FloatField()
-
 class Server(Document):
     ip = StringField(unique=True, required=True)
     port = IntField(min_value=1024, max_value=65535, required=True)
-    sessions = MapField(EmbeddedDocumentField(Session))
     cpu = FloatField()
     hdd = FloatField()
     mem = FloatField()
 
+    # Relative size of the server used by the scheduler. A server with a
+    # capacity of 2.0 is expected to host twice the units of a 1.0 server.
+    capacity = FloatField(min_value=0.0, default=1.0)
+
+    # Older deployments embedded the sessions in the server document. Allow
+    # those documents to load until remu.database.migrate_sessions moves them.
+    meta = {'strict': False}
+
+class Session(Document):
+    sid = StringField(unique=True, required=True)
+    server = StringField(required=True)
+    workshop = ReferenceField(Workshop, required=True)
+    machines = ListField(EmbeddedDocumentField(Machine))
+    password = StringField(required=True)
+    available = BooleanField(required=True)
+    start_time = FloatField()
+
+    # The server field holds the ip of the owning server document.
+    meta = {
+        'indexes': [
+            'server',
+            ('workshop', 'available')
+        ]
+    }
+
+class Metric(Document):
+    server = StringField()
+    workshop = StringField()
+    resolution = IntField(min_value=0, required=True)
+    timestamp = DateTimeField(required=True)
+    expires = DateTimeField(required=True)
+    samples = IntField(min_value=1, default=1)
+    sums = DictField()
+
+    # Host samples are stored per server and workshop samples for the whole
+    # cluster. A resolution of 0 marks a raw sample, otherwise the document
+    # is a rollup bucket of that many seconds. Documents are removed by
+    # mongod once the expires date has passed.
+    meta = {
+        'indexes': [
+            ('resolution', 'server', 'workshop', 'timestamp'),
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+
 class User(UserMixin, Document):
     name = StringField()
     password = StringField()
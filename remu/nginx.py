@@ -44,19 +44,8 @@ class Nginx():
             mappings = list(map_conf)
             upstreams = list(upstream_conf)
 
-            for port in ports:
-                session_id = session + "_" + str(port)
-                upstream = remu.util.rand_str(10)
-                address = server + ":" + str(port)
-
-                new_map = session_id + " " + upstream + ";"
-                l.info("New mapping: %s", new_map)
-                mappings.append(new_map + '\n')
-                
-                new_upstream = "upstream " + upstream + " {server " + address + ";}"
-                l.info("New upstream: %s", new_upstream)
-                upstreams.append(new_upstream + '\n')
-                
+            self._append_mapping(mappings, upstreams, session, server, ports)
+
             self.write_conf(map_conf, mappings)
             self.write_conf(upstream_conf, upstreams)
 
@@ -65,6 +54,43 @@ class Nginx():
             return True
         return False
 
+    def reset_mappings(self, sessions):
+        """
+        Replace all mappings with the mappings of the given sessions.
+        sessions - dictionary mapping session ids to the server and the
+                   VRDE ports of each session
+        """
+        with open(self.rdp_maps, 'r+') as map_conf, open(self.rdp_upstreams, 'r+') as upstream_conf:
+            l.info("Resetting mappings for %d sessions", len(sessions))
+            mappings = []
+            upstreams = []
+
+            for session, (server, ports) in sessions.items():
+                self._append_mapping(mappings, upstreams, session, server, ports)
+
+            self.write_conf(map_conf, mappings)
+            self.write_conf(upstream_conf, upstreams)
+
+            self._nginx_call("reload")
+
+            return True
+        return False
+
+    @classmethod
+    def _append_mapping(cls, mappings, upstreams, session, server, ports):
+        for port in ports:
+            session_id = session + "_" + str(port)
+            upstream = remu.util.rand_str(10)
+            address = server + ":" + str(port)
+
+            new_map = session_id + " " + upstream + ";"
+            l.info("New mapping: %s", new_map)
+            mappings.append(new_map + '\n')
+
+            new_upstream = "upstream " + upstream + " {server " + address + ";}"
+            l.info("New upstream: %s", new_upstream)
+            upstreams.append(new_upstream + '\n')
+
     def remove_mapping(self, session):
         """ TODO """
         with open(self.rdp_maps, 'r+') as map_conf, open(self.rdp_upstreams, 'r+') as upstream_conf:
@@ -0,0 +1,159 @@
+"""
+Incrementally maintained session counters used to place workshop units
+without scanning the sessions or querying the database.
+"""
+import heapq
+import logging
+
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+
+class PlacementIndex(object):
+    """
+    Per-server and per-workshop session counters along with a min-heap of
+    servers keyed by their session count (load).
+
+    The heap is updated lazily: every change of a server's load pushes a new
+    entry and entries that no longer match the current load are discarded
+    when they reach the top. Selecting the least loaded server is therefore
+    O(log n) amortized.
+    """
+    def __init__(self):
+        self.load = {}
+        self._heap = []
+
+        # workshop -> [total, available]
+        self._workshops = {}
+
+        # workshop -> {ip: [total, available]}
+        self._servers = {}
+
+        # workshop -> set of ips with an available session
+        self._available = {}
+
+    def clear(self):
+        self.__init__()
+
+    def add_server(self, ip):
+        if ip not in self.load:
+            self.load[ip] = 0
+            heapq.heappush(self._heap, (0, ip))
+
+    def remove_server(self, ip):
+        """
+        Remove a server along with the counts of all of its sessions.
+        """
+        self.load.pop(ip, None)
+
+        for workshop, servers in self._servers.items():
+            counts = servers.pop(ip, None)
+            if counts:
+                self._workshops[workshop][0] -= counts[0]
+                self._workshops[workshop][1] -= counts[1]
+                self._available[workshop].discard(ip)
+
+    def add_session(self, ip, workshop, available):
+        self.add_server(ip)
+        self._adjust(ip, workshop, 1, int(bool(available)))
+
+    def remove_session(self, ip, workshop, available):
+        if ip in self.load:
+            self._adjust(ip, workshop, -1, -int(bool(available)))
+
+    def set_available(self, ip, workshop, available):
+        """
+        Record a change of availability of one session on the server.
+        """
+        self._adjust(ip, workshop, 0, 1 if available else -1)
+
+    def _adjust(self, ip, workshop, total, available):
+        counts = self._workshops.setdefault(workshop, [0, 0])
+        counts[0] += total
+        counts[1] += available
+
+        counts = self._servers.setdefault(workshop, {}).setdefault(ip, [0, 0])
+        counts[0] += total
+        counts[1] += available
+
+        if counts[1] > 0:
+            self._available.setdefault(workshop, set()).add(ip)
+        else:
+            self._available.setdefault(workshop, set()).discard(ip)
+
+        if total:
+            self.load[ip] += total
+            heapq.heappush(self._heap, (self.load[ip], ip))
+
+            # Keep the stale entries from growing the heap without bound
+            if len(self._heap) > 4 * len(self.load) + 16:
+                self._heap = [(load, s) for s, load in self.load.items()]
+                heapq.heapify(self._heap)
+
+    def session_count(self, ip):
+        return self.load.get(ip, 0)
+
+    def workshop_count(self, workshop, ip=None, available=False):
+        """
+        Returns the number of sessions, or available sessions only, for the
+        workshop. If no server is specified, then all servers are counted.
+        """
+        if ip:
+            counts = self._servers.get(workshop, {}).get(ip, [0, 0])
+        else:
+            counts = self._workshops.get(workshop, [0, 0])
+        return counts[1] if available else counts[0]
+
+    def workshop_counts(self, by_server=False):
+        """
+        Returns the total, available and active counts of every workshop in
+        the same format as remu.database.session_counts.
+        """
+        def summary(counts):
+            return {'total': counts[0], 'available': counts[1], 'active': counts[0] - counts[1]}
+
+        if not by_server:
+            return dict((w, summary(c)) for w, c in self._workshops.items() if c[0])
+
+        result = {}
+        for workshop, servers in self._servers.items():
+            for ip, counts in servers.items():
+                if counts[0]:
+                    result.setdefault(ip, {})[workshop] = summary(counts)
+        return result
+
+    def weighted_load(self, footprint):
+        """
+        Returns the load of every server with each session weighted by the
+        footprint of its workshop. The footprint argument is a function
+        mapping a workshop name to its footprint.
+        """
+        loads = dict.fromkeys(self.load, 0.0)
+        for workshop, servers in self._servers.items():
+            weight = footprint(workshop)
+            for ip, counts in servers.items():
+                if ip in loads:
+                    loads[ip] += counts[0] * weight
+        return loads
+
+    def server_with_available(self, workshop):
+        """
+        Returns the ip of a server holding an available session for the
+        workshop, or None.
+        """
+        for ip in self._available.get(workshop, ()):
+            return ip
+        return None
+
+    def least_loaded(self):
+        """
+        Returns the ip of the server with the fewest sessions, or None if
+        there are no servers.
+        """
+        while self._heap:
+            load, ip = self._heap[0]
+            if self.load.get(ip) == load:
+                return ip
+            heapq.heappop(self._heap)
+        return None
@@ -0,0 +1,62 @@
+"""
+Idle deadlines of the active sessions. Sessions without a VRDE connection
+are recycled once they have been idle for the recycle delay.
+"""
+import heapq
+import logging
+
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+
+class RecycleScheduler(object):
+    """
+    Min-heap of sessions keyed by the time they are to be recycled.
+
+    Cancelled or rescheduled sessions leave their old entry in the heap; it
+    is discarded once it reaches the top, so every operation is O(log n)
+    amortized and a tick only touches the sessions that are due.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.deadlines = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, sid):
+        return sid in self.deadlines
+
+    def idle(self, sid, now):
+        """
+        Schedule the session to be recycled after the delay unless it is
+        already scheduled.
+        """
+        if sid in self.deadlines:
+            return
+
+        deadline = now + self.delay
+        self.deadlines[sid] = deadline
+        heapq.heappush(self._heap, (deadline, sid))
+
+        # Keep the stale entries from growing the heap without bound
+        if len(self._heap) > 2 * len(self.deadlines) + 16:
+            self._heap = [(d, s) for s, d in self.deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, sid):
+        self.deadlines.pop(sid, None)
+
+    def due(self, now):
+        """
+        Remove and return the sessions whose deadline has passed.
+        """
+        sessions = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, sid = heapq.heappop(self._heap)
+            if self.deadlines.get(sid) == deadline:
+                del self.deadlines[sid]
+                sessions.append(sid)
+        return sessions
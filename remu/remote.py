@@ -53,7 +53,7 @@ class RemoteComponent():
 
             try:
                 response = ast.literal_eval(r.text)
-            except ValueError:
+            except (ValueError, SyntaxError):
                 response = r.text
 
             return response
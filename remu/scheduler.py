@@ -0,0 +1,163 @@
+"""
+Placement policies used by the Manager to select the server for a new
+workshop unit. A policy is given the cluster state and only decides where a
+unit goes; availability and instance limits are checked by the Manager.
+"""
+import logging
+
+import remu.database as db
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+
+class Scheduler(object):
+    """
+    Base class of the placement policies. Subclasses implement select().
+    """
+    def __init__(self, state):
+        self.state = state
+
+    def select(self, workshop):
+        """
+        Returns the ip of the server the new unit of the workshop should be
+        placed on, or None if no server is suitable.
+        """
+        raise NotImplementedError
+
+    def observe(self, metrics):
+        """
+        Called by the monitor service with the host metrics rolled up over the
+        usage window, in the format returned by db.get_server_metrics().
+        Policies which do not use them ignore the call.
+        """
+        pass
+
+    @classmethod
+    def has_resources(cls, server):
+        """
+        Returns true if the server is below the memory and hard disk limits.
+        Servers which have not reported their status yet are accepted.
+        """
+        if server.mem is None or server.hdd is None:
+            l.warn(" ... making decision without hardware check for %s!", server.ip)
+            return True
+
+        return server.mem < float(config['REMU']['mem_limit']) and \
+               server.hdd < float(config['REMU']['hdd_limit'])
+
+
+class LeastLoadedScheduler(Scheduler):
+    """
+    Selects the server with the fewest sessions, provided it has enough
+    resources left.
+    """
+    def select(self, workshop):
+        ip = self.state.placement.least_loaded()
+        if ip is None:
+            return None
+
+        l.debug(" ... least loaded server: %s (%d sessions)", ip,
+                self.state.placement.session_count(ip))
+
+        if self.has_resources(self.state.get_server(ip)):
+            return ip
+
+        l.error(" ... unable to find a suitable server!")
+        return None
+
+
+class WeightedScheduler(Scheduler):
+    """
+    Scores every server with enough resources and selects the lowest score.
+
+    The score combines the projected load of the server, which is the sum of
+    the footprints of its units plus the new unit divided by the capacity of
+    the server, with the cpu, memory and hard disk usage of the server. The
+    projected load accounts for units placed since the last status update,
+    while the usage accounts for how heavy the units really are on that host.
+
+    The usage is the 95th percentile of the rolled up metrics passed to
+    observe(), so a short spike or lull does not swing the placement. Servers
+    without rolled up metrics are scored on the most recent status update.
+    """
+    def __init__(self, state, load=1.0, cpu=0.5, mem=1.0, hdd=0.25):
+        super(WeightedScheduler, self).__init__(state)
+        self.weights = {'load': load, 'cpu': cpu, 'mem': mem, 'hdd': hdd}
+        self.usage = {}
+
+    def observe(self, metrics):
+        self.usage = dict(
+            (ip, dict((resource, values[resource]['p95'])
+                      for resource in ('cpu', 'mem', 'hdd') if resource in values))
+            for ip, values in metrics.items())
+
+    @classmethod
+    def footprint(cls, workshop):
+        try:
+            return float(db.get_workshop(name=workshop).get('footprint', 1.0))
+        except AttributeError:
+            return 1.0
+
+    def score(self, server, load, footprint):
+        """
+        Returns the score of placing a unit with the given footprint on the
+        server, or None if the server does not accept new units.
+        """
+        if not server.capacity or server.capacity <= 0:
+            return None
+
+        usage = self.usage.get(server.ip, {})
+
+        score = self.weights['load'] * (load + footprint) / server.capacity
+        for resource in ('cpu', 'mem', 'hdd'):
+            value = usage.get(resource, getattr(server, resource))
+            score += self.weights[resource] * (value or 0.0) / 100.0
+        return score
+
+    def select(self, workshop):
+        footprint = self.footprint(workshop)
+        loads = self.state.placement.weighted_load(self.footprint)
+
+        best = None
+        for ip, server in self.state.servers.items():
+            if not self.has_resources(server):
+                l.debug(" ... %s is over its resource limits", ip)
+                continue
+
+            score = self.score(server, loads.get(ip, 0.0), footprint)
+            l.debug(" ... score for %s: %s", ip, score)
+
+            if score is not None and (best is None or score < best[0]):
+                best = (score, ip)
+
+        if best is None:
+            l.error(" ... unable to find a suitable server!")
+            return None
+
+        return best[1]
+
+
+SCHEDULERS = {
+    'least_loaded': LeastLoadedScheduler,
+    'weighted': WeightedScheduler
+}
+
+
+def create(state):
+    """
+    Create the scheduler selected in the configuration.
+    """
+    settings = dict(config.get('SCHEDULER', {}))
+    policy = settings.pop('policy', 'weighted')
+
+    if policy not in SCHEDULERS:
+        l.error("Unknown scheduler policy: %s", policy)
+        raise Exception
+
+    if policy == 'weighted':
+        weights = dict((k[:-len('_weight')], float(v)) for k, v in settings.items()
+                       if k.endswith('_weight'))
+        return WeightedScheduler(state, **weights)
+
+    return SCHEDULERS[policy](state)
@@ -1,6 +1,5 @@
 import logging
 import socket
-import subprocess
 import contextlib
 import virtualbox
 import virtualbox.library as vboxlib
@@ -8,6 +7,9 @@ import os.path
 import psutil
 import platform
 import shutil
+import time
+import gevent
+import gevent.pool
 
 try:
     from os import scandir
@@ -28,9 +30,22 @@ class WorkshopManager():
         with Templates(self.vbox) as t:
             self.workshop_config = t.get_templates()
 
+        # Number of machines cloned and the total for each unit being cloned
+        self.clone_progress = {}
+
+        # Session ids mapped to the group path of their unit, and group paths
+        # mapped to the machines of the unit
+        self.unit_groups = {}
+        self.unit_machines = {}
+        self._index_units()
+
     def clean_up(self):
         l.info(" ... WorkshopManager cleaning up")
 
+        # The units are adopted by the manager when it starts again
+        if config['REMU'].get('keep_units', 'true').lower() == 'true':
+            return
+
         sessions = []
         for g in self.vbox.machine_groups:
             if "Units" in g:
@@ -47,22 +62,28 @@ class WorkshopManager():
                     shutil.rmtree(os.path.join(vm_dir, file.name))
 
 
-    def _set_group(self, machine, group):
+    def _index_units(self):
         """
-        Set the group for a virtual machine.
+        Rebuild the index of the units from the machine groups in VirtualBox.
         """
-     
-        try:
-            out = subprocess.check_call(
-                [config['REMU']['vbox_manage'], "modifyvm", machine, "--groups", group])
-        
-        except OSError:
-            l.exception("Unable to set group for %s. Check VBoxManage path.", machine)
-            raise
-       
-        except subprocess.CalledProcessError:
-            l.exception("VBoxManage unable to set group for %s", machine)
-            raise
+        self.unit_groups = {}
+        self.unit_machines = {}
+
+        for group in self.vbox.machine_groups:
+            if "-Units/" in group:
+                self._index_unit(group.split("/")[-1], group)
+
+
+    def _index_unit(self, sid, group, machines=None):
+        if machines is None:
+            machines = self.vbox.get_machines_by_groups([group,])
+        self.unit_groups[sid] = group
+        self.unit_machines[group] = list(machines)
+
+
+    def _unindex_unit(self, sid):
+        group = self.unit_groups.pop(sid, None)
+        return group, self.unit_machines.pop(group, [])
 
 
     def _get_first_snapshot(self, machine):
@@ -90,28 +111,25 @@ class WorkshopManager():
     @classmethod
     def _delete_machine(cls, machine):
         """
-        Virtualbox will complain about missing hard disks if the snapshots are not deleted
-        prior to removing the machine. Furthermore, deleting a snapshot is not implemented
-        in the virtualbox sdk for some reason so a subprocess call is the next best thing.
+        Unregister a virtual machine and delete its files. Unregistering deletes the
+        snapshots of the machine and returns its hard disks, which are deleted along with
+        its settings. DVD and floppy images are only detached, and the differencing disks
+        of a linked clone are deleted while the template disks they are linked to are kept.
         """
+        name = machine.name
+        settings_dir = os.path.dirname(machine.settings_file_path)
 
         try:
-            output = subprocess.check_call(
-                [config['REMU']['vbox_manage'], "unregistervm", machine.name, "--delete"])
-
-            settings_dir = os.path.dirname(machine.settings_file_path)
-
-            if os.path.exists(settings_dir):
-                shutil.rmtree(settings_dir)
+            media = machine.unregister(vboxlib.CleanupMode.detach_all_return_hard_disks_only)
+            cls._wait(machine.delete_config(media))
 
-        except OSError:
-            l.exception("Unable to delete machine (%s). Check VBoxManage path.", machine)
-            raise
-       
-        except subprocess.CalledProcessError:
-            l.exception("VBoxManage unable to delete machine %s", machine)
+        except Exception:
+            l.exception("Unable to delete machine %s", name)
             raise
 
+        if os.path.exists(settings_dir):
+            shutil.rmtree(settings_dir)
+
 
     def _get_free_port(self):
         """
@@ -127,10 +145,27 @@ class WorkshopManager():
         raise Exception
 
 
-    def _clone_vm(self, machine, group=None):
+    @classmethod
+    def _wait(cls, progress):
         """
-        Create a full clone from the provided virtual machine.  The machine to be cloned
-        must have a snapshot to clone from.
+        Wait for a VirtualBox operation to complete while letting the other
+        greenlets run. Raises an exception if the operation failed.
+        """
+        while not progress.completed:
+            gevent.sleep(0.1)
+
+        if progress.result_code != 0:
+            l.error("VirtualBox operation failed: %s", progress.description)
+            raise Exception
+
+
+    def _clone_vm(self, machine, group=None, linked=True, name=None):
+        """
+        Create a clone of the most recent snapshot of the provided virtual machine.
+        The machine to be cloned must have a snapshot to clone from.  A linked clone
+        only creates differencing disks off the snapshot, so the template's disks are
+        shared by all of its linked clones, while a full clone copies the disks.  The
+        clone is registered once it has completed.
         """
 
         try:
@@ -141,7 +176,7 @@ class WorkshopManager():
             try:
                 session = machine.create_session()
                 progress, snap = session.machine.take_snapshot('Recovered', 'Emergency snap.', True)
-                progress.wait_for_completion()
+                self._wait(progress)
                 session.unlock_machine()
 
                 snapshot = self._get_recent_snapshot(machine)
@@ -151,7 +186,18 @@ class WorkshopManager():
                 l.exception("Unable to recover from missing snapshot while cloning!")
                 raise
 
-        return machine.clone(snapshot.id_p, groups=group)
+        if name is None:
+            name = machine.name + " Clone"
+        groups = group or []
+
+        settings = self.vbox.compose_machine_filename(name, groups[0] if groups else "", "", "")
+        clone = self.vbox.create_machine(settings, name, groups, "", "")
+
+        options = [vboxlib.CloneOptions.link] if linked else []
+        self._wait(snapshot.machine.clone_to(clone, vboxlib.CloneMode.machine_state, options))
+
+        self.vbox.register_machine(clone)
+        return clone
 
 
     def clone_unit(self, workshop, session_id):
@@ -167,11 +213,6 @@ class WorkshopManager():
             l.error("Template for %s was not found!", workshop)
             raise Exception
 
-        # We want to maintain a list of the cloned machines in the event
-        # that virtualbox fails during the cloning process and we can
-        # remove the impartial unit.
-        clones = []
-
         # Group name for the new unit
         unit_path = "/" + workshop + '-Units/' + session_id
 
@@ -181,63 +222,134 @@ class WorkshopManager():
         # Generate a random internal network name
         base_int_net = rand_str(10)
 
-        for machine in self._get_unit_machines(template):
-            clone = self._clone_vm(machine, group=[unit_path,])
+        machines = self._get_unit_machines(template)
+        self.clone_progress[session_id] = [0, len(machines)]
 
-            try:
-                session = clone.create_session(vboxlib.LockType(2))
+        try:
+            return self._clone_machines(machines, session_id, unit_path, wconfig, base_int_net)
+        finally:
+            self.clone_progress.pop(session_id, None)
 
-                # Get the configuration specific to this machine
-                vm_config = next((vm for vm in wconfig["vms"] if vm["name"] == machine.name), None)
 
-                machine_name = machine.name + "_" + session_id
-                session.machine.name = machine_name
-                l.info("Cloned machine: %s", machine_name)
+    def clone_status(self, sid):
+        """
+        Returns the number of machines cloned and the total number of
+        machines of a unit being cloned, or None if it is not being cloned.
+        """
+        return self.clone_progress.get(sid)
 
-                # Get the internal networks defined in the config, if any
-                intnets = [v for k, v in vm_config.items() if 'intnet' in k.lower()]
 
-                if bool(intnets):
-                    # Attach each internal network defined in config
-                    for i, net in enumerate(intnets):
-                        adapter = session.machine.get_network_adapter(i)
-                        adapter.attachment_type = vboxlib.NetworkAttachmentType(3)
-                        adapter.internal_network = net + base_int_net
-                        l.info(" ... intnet: %s", adapter.internal_network)
-                else:
-                    # Otherwise add a default internal network
-                    adapter = session.machine.get_network_adapter(0)
+    def _clone_machines(self, machines, session_id, unit_path, wconfig, base_int_net):
+        """
+        Clone the machines of a unit concurrently, bounded by the clone_workers
+        setting. If any machine fails, the machines left are skipped and all
+        the machines cloned for the unit are removed.
+        """
+        # We want to maintain a list of the cloned machines in the event
+        # that virtualbox fails during the cloning process and we can
+        # remove the impartial unit.
+        clones = []
+        failed = []
+
+        # Linked clones share the disks of the template unless the workshop
+        # asks for full copies (see _clone_vm)
+        linked = wconfig.get("clone-mode", "linked").lower() != "full"
+
+        pool = gevent.pool.Pool(int(config['REMU'].get('clone_workers', 4)))
+        for machine in machines:
+            pool.spawn(self._clone_machine, machine, session_id, unit_path, wconfig,
+                       base_int_net, linked, clones, failed)
+        pool.join()
+
+        if failed:
+            l.error("Unable to clone unit %s (failed: %s)", session_id, ", ".join(failed))
+            self._remove_clones(clones)
+            return False
+
+        self._index_unit(session_id, unit_path)
+        return True
+
+
+    def _clone_machine(self, machine, session_id, unit_path, wconfig, base_int_net,
+                       linked, clones, failed):
+        """
+        Clone, configure and snapshot a single machine of a unit. The clone is
+        added to clones as soon as it is registered and the name of the machine
+        is added to failed if any step fails.
+        """
+        if failed:
+            return
+
+        machine_name = machine.name + "_" + session_id
+        session = None
+
+        try:
+            clone = self._clone_vm(machine, group=[unit_path,], linked=linked, name=machine_name)
+            clones.append(clone)
+            l.info("Cloned machine: %s", machine_name)
+
+            session = clone.create_session(vboxlib.LockType(2))
+
+            # Get the configuration specific to this machine
+            vm_config = next((vm for vm in wconfig["vms"] if vm["name"] == machine.name), None)
+
+            # Get the internal networks defined in the config, if any
+            intnets = [v for k, v in vm_config.items() if 'intnet' in k.lower()]
+
+            if bool(intnets):
+                # Attach each internal network defined in config
+                for i, net in enumerate(intnets):
+                    adapter = session.machine.get_network_adapter(i)
                     adapter.attachment_type = vboxlib.NetworkAttachmentType(3)
-                    adapter.internal_network = base_int_net
-                    l.info(" ... intnet: %s", base_int_net)
+                    adapter.internal_network = net + base_int_net
+                    l.info(" ... intnet: %s", adapter.internal_network)
+            else:
+                # Otherwise add a default internal network
+                adapter = session.machine.get_network_adapter(0)
+                adapter.attachment_type = vboxlib.NetworkAttachmentType(3)
+                adapter.internal_network = base_int_net
+                l.info(" ... intnet: %s", base_int_net)
+
+            # Enable vrde if it's enabled on the machine being cloned
+            if session.machine.vrde_server.enabled:
+                port = str(self._get_free_port())
+                l.info(" ... vrde port: %s", port)
+            else:
+                port = "1"
+                l.info(" ... vrde not enabled")
+            session.machine.vrde_server.set_vrde_property('TCP/Ports', port)
 
-                # Enable vrde if it's enabled on the machine being cloned
-                if session.machine.vrde_server.enabled:
-                    port = str(self._get_free_port())
-                    l.info(" ... vrde port: %s", port)
-                else:
-                    port = "1"
-                    l.info(" ... vrde not enabled")
-                session.machine.vrde_server.set_vrde_property('TCP/Ports', port)
+            session.machine.groups = [unit_path]
+            session.machine.save_settings()
+
+            # Take a snapshot for restoring purposes
+            progress, sid = session.machine.take_snapshot("Original", "Original state of the machine.", True)
+            self._wait(progress)
+
+            session.unlock_machine()
+            session = None
 
-                # Take a snapshot for restoring purposes
-                progress, sid = session.machine.take_snapshot("Original", "Original state of the machine.", True)
-                progress.wait_for_completion()
+            self.clone_progress[session_id][0] += 1
 
+        except Exception:
+            l.exception("Error cloning: %s", machine.name)
+            failed.append(machine.name)
+
+            if session:
                 session.unlock_machine()
 
-                # Lastly, set the group through vboxmanage
-                self._set_group(clone.name, unit_path)
-                clones.append(machine)
 
+    def _remove_clones(self, clones):
+        """
+        Remove the machines cloned for a unit which failed to clone. Only the
+        clones are removed; the differencing disks of linked clones are deleted
+        while the template disks they were linked to are kept.
+        """
+        for clone in clones:
+            try:
+                self._delete_machine(clone)
             except Exception:
-                msg = "Error cloning: {}".format(machine.name)
-                l.exception(msg)
-                for c in clones:
-                    c.remove()
-                return False
-
-        return True
+                l.exception("Unable to remove clone: %s", clone.name)
 
 
     def _get_all_units_by_workshop(self, workshop):
@@ -248,11 +360,8 @@ class WorkshopManager():
             l.error("Cannot get groupings for empty workshop name!")
             raise Exception
 
-        units = []
-        for group in self.vbox.machine_groups:
-            if group.find(workshop + "-Units") >= 0:
-                units.append(group)
-        return units
+        prefix = "/" + workshop + "-Units/"
+        return [g for g in self.unit_groups.values() if g.startswith(prefix)]
 
 
     def _get_unit(self, sid):
@@ -263,21 +372,21 @@ class WorkshopManager():
             l.error("Cannot get a unit path without a sid!")
             raise Exception
 
-        for g in self.vbox.machine_groups:
-            if g.find(sid) >= 0:
-                return g
-
-        return None
+        return self.unit_groups.get(sid)
 
 
     def _get_unit_machines(self, group):
         """
-        Get all machines in a specific unit grouping.
+        Get all machines in a specific unit grouping. The machines of indexed
+        units are returned without querying VirtualBox.
         """
         if not group:
             l.error("Cannot get machines for an empty group name!")
             raise Exception
 
+        if group in self.unit_machines:
+            return list(self.unit_machines[group])
+
         try:
             return self.vbox.get_machines_by_groups([group,])
 
@@ -286,6 +395,33 @@ class WorkshopManager():
             raise
 
 
+    def list_units(self):
+        """
+        Returns a dictionary mapping the session id of every workshop unit on
+        the server to its workshop and the name, port and state of each of its
+        machines.
+        """
+        units = {}
+
+        for sid, group in self.unit_groups.items():
+            idx = group.find("-Units/")
+
+            machines = []
+            for m in self._get_unit_machines(group):
+                machines.append({
+                    'name': m.name,
+                    'port': m.vrde_server.get_vrde_property('TCP/Ports'),
+                    'state': m.state._value
+                })
+
+            units[sid] = {
+                'workshop': group[1:idx],
+                'machines': machines
+            }
+
+        return units
+
+
     def unit_to_str(self, sid):
         """
         Obtain a list of dictionaries containing properties of the
@@ -312,114 +448,158 @@ class WorkshopManager():
             raise
 
 
-    def start_unit(self, sid):
+    def _run_on_machines(self, sid, action, states, operation):
+        """
+        Run an operation on every machine of a unit at the same time and wait
+        for all of them to complete. Nothing is done unless every machine is
+        in one of the given states. Failures are logged for each machine.
+        Returns true if the operation succeeded on every machine.
+        """
         unit = self._get_unit(sid)
-        l.info("Starting unit: %s", unit)
+        l.info("%s unit: %s", action, unit)
 
-        for machine in self._get_unit_machines(unit):
-            if machine.state == vboxlib.MachineState.powered_off or \
-               machine.state == vboxlib.MachineState.saved:
-                l.info(" ... starting machine: %s", machine.name)
-                try:
-                    progress = machine.launch_vm_process(type_p="headless")
-                    progress.wait_for_completion()
-                except Exception:
-                    l.exception("Fatal error starting machine: %s", machine.name)
-                    return False
-            else:
-                l.error("Error starting machine: %s. Machine is not powered off or saved.", machine.name)
+        machines = self._get_unit_machines(unit)
+
+        invalid = [m.name for m in machines if m.state not in states]
+        if invalid:
+            l.error("Error %s unit: %s. Machines in the wrong state: %s",
+                    action.lower(), unit, ", ".join(invalid))
+            return False
+
+        def run(machine):
+            l.info(" ... %s machine: %s", action.lower(), machine.name)
+            try:
+                operation(machine)
+                return True
+            except Exception:
+                l.exception("Fatal error %s machine: %s", action.lower(), machine.name)
                 return False
-        return True
 
+        jobs = [gevent.spawn(run, m) for m in machines]
+        gevent.joinall(jobs)
 
-    def save_unit(self, sid):
-        unit = self._get_unit(sid)
-        l.info("Saving unit: %s", unit)
+        return all(job.value for job in jobs)
 
-        for machine in self._get_unit_machines(unit):
+
+    def start_unit(self, sid):
+        def start(machine):
             if machine.state == vboxlib.MachineState.running:
-                l.info(" ... saving machine: %s", machine.name)
-                try:
-                    session = machine.create_session()
-                    progress = session.machine.save_state()
-                    progress.wait_for_completion()
-                    session.unlock_machine()
-                except Exception:
-                    l.exception("Fatal error saving machine: %s", machine.name)
-                    return False
-            else:
-                l.error("Error saving machine: %s. Machine is not running.", machine.name)
-                return False
-        return True
+                l.info(" ... machine already running: %s", machine.name)
+                return
+
+            # Launching with our own session returns without waiting
+            session = virtualbox.Session()
+            try:
+                self._wait(machine.launch_vm_process(session, "headless"))
+            finally:
+                session.unlock_machine()
+
+        return self._run_on_machines(
+            sid, "Starting",
+            (vboxlib.MachineState.powered_off, vboxlib.MachineState.saved,
+             vboxlib.MachineState.aborted, vboxlib.MachineState.running),
+            start)
+
+
+    def save_unit(self, sid):
+        def save(machine):
+            session = machine.create_session()
+            try:
+                self._wait(session.machine.save_state())
+            finally:
+                session.unlock_machine()
+
+        return self._run_on_machines(sid, "Saving", (vboxlib.MachineState.running,), save)
+
 
     def stop_unit(self, sid):
-        unit = self._get_unit(sid)
-        l.info("Stopping unit: %s", unit)
+        def stop(machine):
+            session = machine.create_session()
+            try:
+                self._wait(session.console.power_down())
+            finally:
+                session.unlock_machine()
+
+        return self._run_on_machines(sid, "Stopping", (vboxlib.MachineState.running,), stop)
 
-        for machine in self._get_unit_machines(unit):
-            if machine.state == vboxlib.MachineState.running:
-                l.info(" ... stopping machine: %s", machine.name)
-                try:
-                    session = machine.create_session()
-                    progress = session.console.power_down()
-                    progress.wait_for_completion()
-                    session.unlock_machine()
-                except Exception:
-                    l.exception("Fatal error stopping machine: %s", machine.name)
-                    return False
-            else:
-                l.error("Error stopping machine: %s. Machine is not running.", machine.name)
-                return False
-        return True
 
     def restore_unit(self, sid, new_sid):
-        unit = self._get_unit(sid)
-        l.info("Restoring unit: %s", unit)
         l.info(" ... new session id: %s", new_sid)
 
-        for machine in self._get_unit_machines(unit):
-            if machine.state == vboxlib.MachineState.powered_off or \
-               machine.state == vboxlib.MachineState.saved:
-                l.info(" ... restoring machine: %s", machine.name)
-                try:
-                    # Obtain snapshot of the original state
-                    snapshot = self._get_first_snapshot(machine)
+        def restore(machine):
+            # Obtain snapshot of the original state
+            snapshot = self._get_first_snapshot(machine)
 
-                    # Restore the machine
-                    session = machine.create_session()
-                    progress = session.machine.restore_snapshot(snapshot)
-                    progress.wait_for_completion()
+            # Restore the machine
+            session = machine.create_session()
+            try:
+                self._wait(session.machine.restore_snapshot(snapshot))
+
+                # Change the machine name
+                name = session.machine.name
+                base_end = name.rfind('_') + 1
+                new_name = name[:base_end] + new_sid
+                session.machine.name = new_name
+                l.debug(" ... new machine name: %s", new_name)
+
+                # Change the session id in the group name
+                group = session.machine.groups[0]
+                base_end = group.rfind('/') + 1
+                group = group[:base_end] + new_sid
+                session.machine.groups = [group]
+                l.debug(" ... new group name: %s", group)
+
+                session.machine.save_settings()
+            finally:
+                session.unlock_machine()
 
-                    # Change the machine name
-                    name = session.machine.name
-                    base_end = name.rfind('_') + 1
-                    new_name = name[:base_end] + new_sid
-                    session.machine.name = new_name
-                    l.debug(" ... new machine name: %s", new_name)
+        restored = self._run_on_machines(
+            sid, "Restoring",
+            (vboxlib.MachineState.powered_off, vboxlib.MachineState.saved),
+            restore)
 
-                    session.machine.save_settings()
-                    session.unlock_machine()
+        if restored:
+            group, machines = self._unindex_unit(sid)
+            self._index_unit(new_sid, group[:group.rfind('/') + 1] + new_sid, machines)
+        else:
+            # Some machines may have been moved to the new group
+            self._index_units()
 
-                    # Change the session id in the group name
-                    group = machine.groups[0]
-                    base_end = group.rfind('/') + 1
-                    group = group[:base_end] + new_sid
-                    l.debug(" ... new group name: %s", group)
-                    self._set_group(machine.name, group)
-                except Exception:
-                    l.exception("Error restoring machine: %s", machine.name)
-                    return False
-            else:
-                l.error("Error restoring machine: %s. Machine is not powered off or saved.", machine.name)
-                return False
-        return True
+        return restored
 
-    def remove_unit(self, sid):
+    def remove_unit(self, sid, force=False):
+        """
+        Remove the machines of a unit. Unless force is true, every machine
+        must be powered off or saved; otherwise running machines are powered
+        off first and machines in any other state are removed as they are.
+        """
         unit = self._get_unit(sid)
         l.info("Removing unit: %s", sid)
 
-        for machine in self._get_unit_machines(unit):
-            if machine.state == vboxlib.MachineState.powered_off or \
+        removed = self._remove_machines(self._get_unit_machines(unit), force)
+
+        if removed:
+            self._unindex_unit(sid)
+        else:
+            # Some machines may have been removed
+            self._index_units()
+
+        return removed
+
+
+    def _remove_machines(self, machines, force):
+        for machine in machines:
+            if force and machine.state == vboxlib.MachineState.running:
+                l.info(" ... powering off machine: %s", machine.name)
+                try:
+                    session = machine.create_session()
+                    self._wait(session.console.power_down())
+                    session.unlock_machine()
+                except Exception:
+                    l.exception("Fatal error stopping machine: %s", machine.name)
+                    return False
+
+            if force or machine.state == vboxlib.MachineState.powered_off or \
                machine.state == vboxlib.MachineState.saved:
                 l.info(" ... removing machine: %s", machine.name)
                 try:
@@ -475,11 +655,25 @@ class PerformanceMonitor():
         else:
             self.mount = '/'
 
+        self._watcher = None
+
+        # Shared sessions of the running machines, keyed by machine id, kept
+        # open to read their VRDE connection
+        self._consoles = {}
+
     def clean_up(self):
         l.info(" ... PerformanceMonitor cleaning up")
+        if self._watcher:
+            self._watcher.kill()
+        for mid in list(self._consoles):
+            self._release_console(mid)
         del self._vbox
 
-    def update(self):
+    def update(self, sessions=True):
+        """
+        Returns the hardware usage of the machine and, unless sessions is
+        false, the machine states of every workshop unit.
+        """
         updates = {}
 
         # Hard disk memory
@@ -492,31 +686,120 @@ class PerformanceMonitor():
         # RAM
         updates["mem"] = psutil.virtual_memory().percent
 
-        updates["sessions"] = {}
-        for g in self._vbox.machine_groups:
-            if "Template" not in g:
-                sid = g.split("/")[-1]
-                updates["sessions"][sid] = []
-                for m in self._vbox.get_machines_by_groups([g]):
-                    updates["sessions"][sid].append(self._get_vm_stats(m))
+        updates["sessions"] = self._get_sessions() if sessions else {}
 
         return updates
 
+    def _get_sessions(self):
+        sessions = {}
+        for sid, machines in self._get_units().items():
+            sessions[sid] = [self._get_vm_stats(m) for m in machines]
+        return sessions
+
+    def _get_units(self, groups=None):
+        """
+        Returns the machines of the workshop units keyed by session id. Only
+        the given groups are listed if any, otherwise every group is. Units
+        with fewer machines than their template are still being cloned and
+        are left out, since their machines are matched by position.
+        """
+        templates = {}
+        units = {}
+        for g in self._vbox.machine_groups if groups is None else groups:
+            if "Template" not in g:
+                machines = self._vbox.get_machines_by_groups([g])
+                if len(machines) >= self._template_size(g, templates):
+                    units[g.split("/")[-1]] = machines
+        return units
+
+    def _template_size(self, group, templates):
+        """
+        Returns the number of machines of the template of a unit group
+        (/<workshop>-Units/<sid>), caching them in templates.
+        """
+        parts = group.split("/")
+        if len(parts) != 3 or not parts[1].endswith("-Units"):
+            return 0
+
+        template = "/" + parts[1][:-len("-Units")] + "-Template"
+        if template not in templates:
+            templates[template] = len(self._vbox.get_machines_by_groups([template]))
+        return templates[template]
+
+    def start_watch(self, manager, interval):
+        """
+        Start pushing the machine states of the sessions which changed to
+        the manager every interval seconds.
+        """
+        self._watcher = gevent.spawn(self._watch, manager, interval)
+
+    def _watch(self, manager, interval):
+        # Number of sessions sent per request to keep the urls short
+        chunk = 20
+        last = {}
+
+        # The machines of every unit are only listed every resync interval,
+        # in between only the groups created or removed since, and the units
+        # which were not completely cloned yet, are looked at
+        resync = float(config['REMU'].get('resync_interval', 300))
+        listed = 0
+        groups = set()
+        units = {}
+
+        while True:
+            gevent.sleep(interval)
+
+            try:
+                current_groups = set(self._vbox.machine_groups)
+
+                if time.time() >= listed + resync:
+                    units = self._get_units(current_groups)
+                    listed = time.time()
+
+                    # Forget the consoles of the machines which are gone
+                    machines = set(m.id_p for unit in units.values() for m in unit)
+                    for mid in set(self._consoles) - machines:
+                        self._release_console(mid)
+                else:
+                    for g in groups - current_groups:
+                        units.pop(g.split("/")[-1], None)
+                    units.update(self._get_units(current_groups - groups))
+
+                # Units still being cloned are listed again on the next tick
+                groups = set(g for g in current_groups
+                             if "Template" in g or g.split("/")[-1] in units)
+
+                current = dict((sid, [self._get_vm_stats(m) for m in machines])
+                               for sid, machines in units.items())
+                changed = [(sid, m) for sid, m in current.items() if last.get(sid) != m]
+
+                for i in range(0, len(changed), chunk):
+                    if manager.vrde_events(sessions=dict(changed[i:i + chunk])) is None:
+                        l.error("Manager did not accept the VRDE events")
+                        raise Exception
+
+                last = current
+
+            except Exception:
+                # The changes are sent again on the next attempt, after the
+                # machines are listed again in case one of them was removed
+                l.exception("Unable to push VRDE events to the manager")
+                listed = 0
+
     def _get_vm_stats(self, machine):
         stats = {}
 
-        session = machine.create_session()
-        stats["state"] = machine.state._value
-        stats["vrde-enabled"] = bool(session.machine.vrde_server.enabled)
+        # The state and VRDE settings are read without locking the machine
+        state = machine.state
+        stats["state"] = state._value
+        stats["vrde-enabled"] = bool(machine.vrde_server.enabled)
 
         # VRDE must be enabled and the machine must be running
-        if session.machine.vrde_server.enabled == 1 and machine.state == vboxlib.MachineState(5):
-            vrde = session.console.vrde_server_info
-            stats["vrde-active"] = bool(vrde.active)
+        if stats["vrde-enabled"] and state == vboxlib.MachineState(5):
+            stats["vrde-active"] = bool(self._console(machine).vrde_server_info.active)
         else:
             stats["vrde-active"] = False
-
-        session.unlock_machine()
+            self._release_console(machine.id_p)
 
         """
         metrics = self._query_metrics(["*"], [machine])
@@ -533,6 +816,31 @@ class PerformanceMonitor():
 
         return stats
 
+    def _console(self, machine):
+        """
+        Returns the console of a running machine. The shared session it is
+        obtained through is kept until the machine stops, so the machine is
+        not locked every time its VRDE connection is read.
+        """
+        session = self._consoles.get(machine.id_p)
+
+        if session is None or session.state != vboxlib.SessionState.locked:
+            session = machine.create_session()
+            self._consoles[machine.id_p] = session
+
+        return session.console
+
+    def _release_console(self, mid):
+        session = self._consoles.pop(mid, None)
+        if session is None:
+            return
+
+        try:
+            if session.state == vboxlib.SessionState.locked:
+                session.unlock_machine()
+        except Exception:
+            l.exception("Unable to unlock the session of machine %s", mid)
+
     def _query_metrics(self, names, objects):
         """
         Retrieves collected metric values as well as some auxiliary
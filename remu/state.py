@@ -0,0 +1,359 @@
+"""
+In-memory model of the cluster (servers, sessions and their machines) kept
+by the Manager so that hot read paths are dictionary lookups rather than
+database queries.
+
+Consistency contract:
+    * MongoDB remains the source of truth. Every mutation is written through
+      to the database first and applied in memory only once the write has
+      succeeded, so a failed write never leaves the memory model ahead of
+      the database.
+    * The process owning the ClusterState (the Manager) is the only writer
+      of sessions and machine states. Changes made to the database by other
+      processes, such as servers added through the admin interface, are not
+      visible until reload() is called.
+    * Session claims are decided by the database (see
+      remu.database.claim_available_session), never by the memory model, so
+      checkouts remain atomic even if the model is stale.
+    * reload() discards the memory model and rebuilds it from the database.
+      It must be called when the Manager starts or restarts.
+"""
+import logging
+
+import remu.database as db
+from remu.placement import PlacementIndex
+from remu.settings import config
+
+l = logging.getLogger(config["REMU"]["logger"])
+
+# VirtualBox machine states reported by the servers
+POWERED_OFF = 1
+SAVED = 2
+RUNNING = 5
+
+
+class MachineState(object):
+    __slots__ = ('name', 'port', 'state', 'vrde_active', 'vrde_enabled')
+
+    def __init__(self, name, port, state=1, vrde_active=False, vrde_enabled=False):
+        self.name = name
+        self.port = port
+        self.state = state
+        self.vrde_active = vrde_active
+        self.vrde_enabled = vrde_enabled
+
+
+class SessionState(object):
+    __slots__ = ('sid', 'server', 'workshop', 'available', 'start_time', 'machines')
+
+    def __init__(self, sid, server, workshop, available, start_time=None):
+        self.sid = sid
+        self.server = server
+        self.workshop = workshop
+        self.available = available
+        self.start_time = start_time
+        self.machines = []
+
+    @property
+    def connected(self):
+        """ True if any machine of the session has an active VRDE connection. """
+        return any(m.vrde_active for m in self.machines)
+
+
+class ServerState(object):
+    __slots__ = ('ip', 'port', 'capacity', 'cpu', 'mem', 'hdd', 'sessions')
+
+    def __init__(self, ip, port, cpu=None, mem=None, hdd=None, capacity=1.0):
+        self.ip = ip
+        self.port = port
+        self.capacity = capacity
+        self.cpu = cpu
+        self.mem = mem
+        self.hdd = hdd
+        self.sessions = set()
+
+
+class ClusterState(object):
+    """ Write-through cache of the servers and sessions in the database. """
+    def __init__(self):
+        self.servers = {}
+        self.sessions = {}
+        self.placement = PlacementIndex()
+
+        # Number of sessions with an active VRDE connection per workshop
+        self.connected = {}
+
+        # Sessions whose availability or VRDE connection changed, or which
+        # were removed, since the last call to pop_changes
+        self.changes = set()
+
+    def reload(self):
+        """
+        Rebuild the memory model from the database.
+        """
+        servers = {}
+        sessions = {}
+
+        for s in db.get_all_servers(fields=['ip', 'port', 'cpu', 'mem', 'hdd', 'capacity']):
+            servers[s['ip']] = ServerState(
+                s['ip'], s['port'], s.get('cpu'), s.get('mem'), s.get('hdd'), s.get('capacity', 1.0))
+
+        workshops = dict((w['_id'], w['name']) for w in db.get_all_workshops(fields=['name']))
+
+        fields = ['server', 'workshop', 'available', 'start_time', 'machines']
+        for sid, s in db.get_all_sessions(fields=fields).items():
+            session = SessionState(
+                sid, s['server'], workshops.get(str(s['workshop'])), s['available'], s.get('start_time'))
+
+            for m in s.get('machines', []):
+                session.machines.append(MachineState(
+                    m['name'], m['port'], m.get('state', 1),
+                    m.get('vrde_active', False), m.get('vrde_enabled', False)))
+
+            sessions[sid] = session
+
+            if s['server'] in servers:
+                servers[s['server']].sessions.add(sid)
+
+        self.servers = servers
+        self.sessions = sessions
+        self.changes = set(sessions)
+
+        self.connected = {}
+        for s in sessions.values():
+            if s.connected:
+                self._count_connected(s.workshop, 1)
+
+        self.placement.clear()
+        for ip in servers:
+            self.placement.add_server(ip)
+        for s in sessions.values():
+            if s.server in servers:
+                self.placement.add_session(s.server, s.workshop, s.available)
+        l.info("Cluster state loaded: %d servers, %d sessions", len(servers), len(sessions))
+
+    def pop_changes(self):
+        """
+        Return and clear the ids of the sessions changed since the last call.
+        """
+        changes, self.changes = self.changes, set()
+        return changes
+
+    def get_server(self, ip):
+        return self.servers.get(ip)
+
+    def get_session(self, sid):
+        return self.sessions.get(sid)
+
+    def session_exists(self, sid):
+        return sid in self.sessions
+
+    def get_active_sessions(self):
+        """
+        Return a dictionary mapping session ids to all active sessions.
+        """
+        return dict((sid, s) for sid, s in self.sessions.items() if not s.available)
+
+    def get_vrde_ports(self, sid):
+        return [m.port for m in self.sessions[sid].machines if m.port > 1]
+
+    def session_count(self, ip, check_available=False):
+        """
+        Returns the current number of sessions on the server. If check_available
+        is true, it will return the current available sessions only.
+        """
+        if not check_available:
+            return self.placement.session_count(ip)
+        return sum(1 for sid in self.servers[ip].sessions if self.sessions[sid].available)
+
+    def session_count_by_workshop(self, workshop, ip=None, available=False):
+        """
+        Returns the current number of sessions, or available sessions only,
+        for the specified workshop. If no server is specified, then all
+        servers will be counted.
+        """
+        return self.placement.workshop_count(workshop, ip, available)
+
+    def session_counts(self, by_server=False):
+        """
+        Returns the total, available and active session counts for each
+        workshop in the same format as remu.database.session_counts.
+        """
+        return self.placement.workshop_counts(by_server)
+
+    def connected_counts(self):
+        """
+        Returns a dictionary mapping each workshop with connected sessions to
+        the number of its sessions with an active VRDE connection.
+        """
+        return dict(self.connected)
+
+    def insert_server(self, ip, port, capacity=1.0):
+        db.insert_server(ip, port, capacity)
+        self.servers[ip] = ServerState(ip, port, capacity=capacity)
+        self.placement.add_server(ip)
+
+    def remove_server(self, ip):
+        db.remove_server(ip)
+
+        server = self.servers.pop(ip, None)
+        if server:
+            for sid in server.sessions:
+                session = self.sessions.pop(sid, None)
+                if session and session.connected:
+                    self._count_connected(session.workshop, -1)
+            self.changes.update(server.sessions)
+        self.placement.remove_server(ip)
+
+    def insert_session(self, ip, sid, workshop, password, available=True):
+        db.insert_session(ip, sid, workshop, password, available)
+
+        session = db.get_session(ip, sid)
+        self.sessions[sid] = SessionState(
+            sid, ip, workshop, session['available'], session.get('start_time'))
+        self.servers[ip].sessions.add(sid)
+        self.placement.add_session(ip, workshop, session['available'])
+
+        # Sessions inserted unavailable are active from the start, they are
+        # recorded so they are recycled if the unit is never connected to
+        if not session['available']:
+            self.changes.add(sid)
+
+    def insert_machine(self, ip, sid, name, port):
+        db.insert_machine(ip, sid, name, port)
+        self.sessions[sid].machines.append(MachineState(name, port))
+
+    def claim_available_session(self, workshop, ip=None):
+        """
+        Claim an available session through the database and mirror the
+        result. Returns a tuple of the server ip and session id, or None.
+        """
+        claimed = db.claim_available_session(workshop, ip)
+
+        if claimed:
+            session = self.sessions.get(claimed[1])
+            if session:
+                if session.available:
+                    self.placement.set_available(session.server, session.workshop, False)
+                session.available = False
+                self.changes.add(session.sid)
+            else:
+                l.warn("Claimed session %s is not in the cluster state", claimed[1])
+
+        return claimed
+
+    def update_session(self, ip, sid, available):
+        db.update_session(ip, sid, available)
+
+        session = self.sessions[sid]
+        if session.available != available:
+            self.placement.set_available(ip, session.workshop, available)
+            self.changes.add(sid)
+        session.available = available
+
+    def remove_session(self, ip, sid):
+        db.remove_session(ip, sid)
+
+        session = self.sessions.pop(sid, None)
+        if ip in self.servers:
+            self.servers[ip].sessions.discard(sid)
+        if session:
+            self.placement.remove_session(ip, session.workshop, session.available)
+            if session.connected:
+                self._count_connected(session.workshop, -1)
+        self.changes.add(sid)
+
+    def update_status(self, ip, status):
+        db.update_status(ip, status)
+
+        server = self.servers[ip]
+        server.cpu = status['cpu']
+        server.mem = status['mem']
+        server.hdd = status['hdd']
+
+        self._apply_sessions(ip, status['sessions'])
+
+    def update_sessions(self, ip, reported):
+        """
+        Apply the machine states of the sessions reported by a server.
+        """
+        db.update_sessions(ip, reported)
+        self._apply_sessions(ip, reported)
+
+    def _apply_sessions(self, ip, reported):
+        for sid, data in reported.items():
+            session = self.sessions.get(sid)
+            if not session or session.server != ip:
+                continue
+
+            connected = session.connected
+
+            for machine, report in zip(session.machines, data):
+                for k, v in report.items():
+                    k = k.replace('-', '_')
+                    if k in MachineState.__slots__:
+                        setattr(machine, k, v)
+
+            if session.connected != connected:
+                self._count_connected(session.workshop, 1 if session.connected else -1)
+                self.changes.add(sid)
+
+    def _count_connected(self, workshop, delta):
+        count = self.connected.get(workshop, 0) + delta
+        if count:
+            self.connected[workshop] = count
+        else:
+            self.connected.pop(workshop, None)
+
+    def reconcile(self, ip, units):
+        """
+        Diff the workshop units found on a server against its sessions. The
+        sessions with a healthy unit are kept and the others are removed.
+        A unit is healthy if it has the machines recorded for its session and
+        they are powered off or saved when the session is available, or
+        running when the session is active.
+        units - dictionary mapping session ids to the workshop and machines
+                of each unit (see remu.server.WorkshopManager.list_units)
+        Returns a tuple of the session ids adopted and of the units which are
+        to be removed from the server.
+        """
+        adopted = {}
+        discard = [sid for sid in units if sid not in self.sessions or self.sessions[sid].server != ip]
+
+        for sid in list(self.servers[ip].sessions):
+            session = self.sessions[sid]
+            unit = units.get(sid)
+
+            # The VRDE connections of the previous run are gone, they are
+            # reported again by the next status update
+            if unit and self._healthy(session, unit):
+                adopted[sid] = [{'state': m['state'], 'vrde_active': False, 'vrde_enabled': False}
+                                for m in self._ordered(session, unit)]
+                continue
+
+            l.info("Removing session %s without a healthy unit on %s", sid, ip)
+            self.remove_session(ip, sid)
+            if unit:
+                discard.append(sid)
+
+        if adopted:
+            self.update_sessions(ip, adopted)
+
+        return list(adopted), discard
+
+    @classmethod
+    def _healthy(cls, session, unit):
+        if unit['workshop'] != session.workshop or not session.machines:
+            return False
+
+        if sorted(m.name for m in session.machines) != sorted(m['name'] for m in unit['machines']):
+            return False
+
+        states = (POWERED_OFF, SAVED) if session.available else (RUNNING,)
+        return all(m['state'] in states for m in unit['machines'])
+
+    @classmethod
+    def _ordered(cls, session, unit):
+        """ The machines of the unit in the order of the machines of the session. """
+        machines = dict((m['name'], m) for m in unit['machines'])
+        return [machines[m.name] for m in session.machines]
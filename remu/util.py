@@ -2,6 +2,8 @@
 import string
 import random
 import logging
+import collections
+import time
 
 def rand_str(length):
     """ TODO """
@@ -9,3 +11,81 @@ def rand_str(length):
     return ''.join(random.SystemRandom().choice(choices) for _ in range(length))
 
 
+
+class TTLCache():
+    """
+    A bounded mapping whose entries expire after ttl seconds. The least
+    recently used entry is evicted once maxsize entries are stored.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        """ Returns the cached value for the key or None if absent or expired. """
+        entry = self._data.pop(key, None)
+
+        if entry is None or entry[1] < time.time():
+            self.misses += 1
+            return None
+
+        # Re-insert to mark the entry as the most recently used
+        self._data[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time() + self.ttl)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class CircuitBreaker():
+    """
+    Tracks the consecutive failures of calls to a remote component. Once
+    threshold failures are reached the breaker opens and calls are refused
+    for cooldown seconds, after which a single trial call is let through.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    def allow(self):
+        """ Returns true if a call may be attempted. """
+        if self.opened is None:
+            return True
+
+        if time.time() >= self.opened + self.cooldown:
+            # Let one trial call through, a failure reopens the breaker
+            self.opened = time.time()
+            return True
+
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.time()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if time.time() >= self.opened + self.cooldown else 'open'
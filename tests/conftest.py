@@ -9,6 +9,19 @@ from remu.importer import Templates
 from remu.server import WorkshopManager
 
 
+def pytest_runtest_setup(item):
+	"""
+	The benchmarks take a while, so they only run when selected with
+	-m benchmark or when REMU_BENCHMARK is set.
+	"""
+	if item.get_closest_marker('benchmark') is None:
+		return
+
+	if 'benchmark' not in item.config.getoption('markexpr') and \
+			not os.environ.get('REMU_BENCHMARK'):
+		pytest.skip('benchmarks run with -m benchmark or REMU_BENCHMARK=1')
+
+
 @pytest.fixture(scope='function')
 def mongo(request):
    db = me.connect('testdb', host='mongomock://localhost')
@@ -27,7 +40,7 @@ def server():
 
 @pytest.fixture(scope='function')
 def workshop():
-	insert_workshop('test', ,'', '', 0, 0, True)
+	insert_workshop('test', '', '', 0, 0, True)
 	return Workshop.objects().first()
 
 
@@ -52,7 +65,8 @@ def workshop_manager(request):
 
 	yield mgr
 
-	mgr.remove_unit('/Test_Workshop-Template')
+	for m in mgr._get_unit_machines('/Test_Workshop-Template'):
+		mgr._delete_machine(m)
 	mgr.clean_up()
 	del mgr
 
@@ -0,0 +1,65 @@
+from remu.admission import AdmissionController
+
+
+class TestAdmissionController:
+
+	def test_admit_fifo(self):
+		admission = AdmissionController()
+		admission.enqueue('w', 'a')
+		admission.enqueue('w', 'b')
+
+		assert admission.admit(lambda w: True) == ('w', 'a')
+		assert admission.admit(lambda w: False) is None
+		assert admission.admit(lambda w: True) == ('w', 'b')
+		assert admission.admit(lambda w: True) is None
+
+	def test_admit_round_robin(self):
+		admission = AdmissionController()
+		for ticket in ['a1', 'a2', 'a3']:
+			admission.enqueue('a', ticket)
+		admission.enqueue('b', 'b1')
+		admission.enqueue('c', 'c1')
+
+		order = [admission.admit(lambda w: True)[1] for dummy in range(5)]
+		assert order == ['a1', 'b1', 'c1', 'a2', 'a3']
+
+	def test_admit_skips_full_workshops(self):
+		admission = AdmissionController()
+		admission.enqueue('a', 'a1')
+		admission.enqueue('b', 'b1')
+
+		assert admission.admit(lambda w: w == 'b') == ('b', 'b1')
+		assert admission.waiting('a')
+		assert not admission.waiting('b')
+
+
+	def test_enqueue_full(self):
+		admission = AdmissionController(size=1)
+		assert admission.enqueue('w', 'a')
+		assert not admission.enqueue('w', 'b')
+
+		# Checkouts put back in front are always accepted
+		assert admission.enqueue('w', 'c', front=True)
+		assert admission.admit(lambda w: True) == ('w', 'c')
+
+	def test_remove_normal(self):
+		admission = AdmissionController()
+		admission.enqueue('w', 'a')
+		assert admission.remove('a')
+		assert not admission.remove('a')
+		assert len(admission) == 0
+
+
+	def test_positions_normal(self):
+		admission = AdmissionController(window=100.0)
+		admission.enqueue('w', 'a')
+		admission.enqueue('w', 'b')
+		admission.enqueue('x', 'c')
+
+		for i in range(10):
+			admission.record_release('w', now=float(i))
+
+		positions = admission.positions(lambda w: 60.0, now=50.0)
+		assert positions['a'] == (1, 70.0)
+		assert positions['b'] == (2, 80.0)
+		assert positions['c'] == (1, None)
@@ -0,0 +1,49 @@
+from remu.autoscaler import Autoscaler, create
+
+
+class TestAutoscaler:
+
+	def test_rate_normal(self):
+		scaler = Autoscaler(window=100.0)
+		for i in range(10):
+			scaler.record_checkout('w', now=1000.0 + i)
+
+		assert scaler.rate('w', now=1010.0) == 0.1
+		assert scaler.rate('w', now=1105.0) == 0.05
+		assert scaler.rate('w', now=1200.0) == 0.0
+		assert scaler.rate('unknown') == 0.0
+
+
+	def test_build_estimate_normal(self):
+		scaler = Autoscaler(build_time=120.0, smoothing=0.5)
+		assert scaler.build_estimate('w') == 120.0
+
+		scaler.record_build('w', 60.0)
+		assert scaler.build_estimate('w') == 60.0
+
+		scaler.record_build('w', 100.0)
+		assert scaler.build_estimate('w') == 80.0
+
+
+	def test_target_normal(self):
+		scaler = Autoscaler(window=60.0, build_time=120.0)
+
+		# No demand keeps the minimum instances
+		assert scaler.target('w', 2, 10, 0, now=0.0) == 2
+		assert scaler.target('w', 2, 10, 1, now=0.0) == 1
+		assert scaler.target('w', 2, 10, 5, now=0.0) == 0
+
+		# 30 checkouts a minute for a two minute build
+		for i in range(30):
+			scaler.record_checkout('w', now=float(i))
+		assert scaler.target('w', 2, 100, 30, now=60.0) == 60
+
+		# Capped by the max instances
+		assert scaler.target('w', 2, 40, 30, now=60.0) == 10
+		assert scaler.target('w', 2, 40, 45, now=60.0) == 0
+
+
+	def test_create_normal(self):
+		scaler = create()
+		assert scaler.window == 600.0
+		assert scaler.build_time == 120.0
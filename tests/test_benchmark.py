@@ -0,0 +1,206 @@
+import pytest
+import json
+import os
+import platform
+import time
+import mongomock.collection
+
+from remu.models import *
+from remu.database import *
+from remu.manager import Manager
+import remu.scheduler
+from remu.state import ClusterState
+
+# Cluster sizes (servers, sessions) used by the scaling benchmarks.
+CLUSTERS = [(1, 100), (10, 1000), (50, 2000), (100, 5000), (200, 10000)]
+
+# Number of times each operation is timed per cluster size.
+REPEATS = 3
+
+# File the scaling results are written to, if any.
+OUTPUT = os.environ.get('REMU_BENCHMARK_OUTPUT')
+
+
+def populate(servers, sessions, workshops):
+	"""
+	Bulk load a cluster of servers with the sessions evenly distributed
+	across the servers and workshops.
+	"""
+	names = ['workshop{}'.format(i) for i in range(workshops)]
+	for name in names:
+		insert_workshop(name, '', '', 0, sessions, True)
+	oids = [w.id for w in Workshop.objects()]
+
+	ips = ['10.0.{}.{}'.format(i // 256, i % 256) for i in range(servers)]
+	for ip in ips:
+		insert_server(ip, 9000)
+
+	docs = []
+	for i in range(sessions):
+		docs.append({
+			'sid': 'sid{}'.format(i),
+			'server': ips[i % servers],
+			'workshop': oids[i % workshops],
+			'machines': [
+				{'name': 'machine', 'port': 1, 'state': 1, 'vrde_active': False, 'vrde_enabled': False},
+				{'name': 'machine', 'port': 1, 'state': 1, 'vrde_active': False, 'vrde_enabled': False}
+			],
+			'password': 'pass',
+			'available': bool(i % 2),
+			'start_time': time.time()
+		})
+
+	# Mongomock checks unique indexes against every stored document on each
+	# insert, so the indexes are rebuilt once the cluster has been loaded.
+	collection = Session._get_collection()
+	collection.drop_indexes()
+	collection.insert_many(docs)
+	Session.ensure_indexes()
+
+	return names
+
+
+def timed(func, *args, **kwargs):
+	start = time.time()
+	result = func(*args, **kwargs)
+	return result, time.time() - start
+
+
+@pytest.fixture(scope='function')
+def round_trips(monkeypatch):
+	"""
+	Count the queries issued against mongomock. Mongomock evaluates every
+	query in process, so wall time alone does not reflect the cost of a
+	round trip to mongod.
+	"""
+	calls = {'count': 0, 'depth': 0}
+
+	def counted(method):
+		def wrapper(*args, **kwargs):
+			# Stages such as $lookup are run through find by mongomock
+			if not calls['depth']:
+				calls['count'] += 1
+
+			calls['depth'] += 1
+			try:
+				return method(*args, **kwargs)
+			finally:
+				calls['depth'] -= 1
+		return wrapper
+
+	for name in ('find', 'aggregate'):
+		monkeypatch.setattr(
+			mongomock.collection.Collection, name,
+			counted(getattr(mongomock.collection.Collection, name)))
+
+	return calls
+
+
+def measure(round_trips, func, *args, **kwargs):
+	start = round_trips['count']
+	result, seconds = timed(func, *args, **kwargs)
+	return result, seconds, round_trips['count'] - start
+
+
+@pytest.mark.benchmark
+@pytest.mark.usefixtures('mongo')
+class TestBenchmark:
+
+	def test_session_counts_speedup(self, round_trips):
+		names = populate(50, 2000, 5)
+
+		def loop():
+			# The per workshop counting done by session_to_workshop_count
+			# prior to the aggregation.
+			counts = {}
+			for name in names:
+				counts[name] = {
+					'total': session_count_by_workshop(name),
+					'available': session_count_by_workshop(name, available=True)
+				}
+			return counts
+
+		expected, loop_time, loop_trips = measure(round_trips, loop)
+		counts, agg_time, agg_trips = measure(round_trips, session_counts)
+
+		print("\nsession_count_by_workshop loop: {:.3f}s / {} queries, "
+			"session_counts: {:.3f}s / {} queries".format(loop_time, loop_trips, agg_time, agg_trips))
+
+		for name in names:
+			assert counts[name]['total'] == expected[name]['total']
+			assert counts[name]['available'] == expected[name]['available']
+		assert agg_trips == 1
+		# The workshop id is cached after the first count of each workshop
+		assert loop_trips == 3 * len(names)
+
+
+class Balancer(Manager):
+	""" Only the cluster state is required by the load balancer. """
+	def __init__(self):
+		self.state = ClusterState()
+		self.state.reload()
+		self.scheduler = remu.scheduler.create(self.state)
+
+
+@pytest.fixture(scope='module')
+def results():
+	"""
+	Collect the scaling results of the module and write them as JSON to
+	REMU_BENCHMARK_OUTPUT once every benchmark has run.
+	"""
+	data = {
+		'time': time.time(),
+		'python': platform.python_version(),
+		'repeats': REPEATS,
+		'results': []
+	}
+
+	yield data['results']
+
+	if not OUTPUT:
+		return
+
+	with open(OUTPUT, 'w') as f:
+		json.dump(data, f, indent=2, sort_keys=True)
+
+
+@pytest.mark.benchmark
+@pytest.mark.usefixtures('mongo')
+class TestScaling:
+
+	@pytest.mark.parametrize('servers,sessions', CLUSTERS)
+	def test_scaling(self, servers, sessions, round_trips, results):
+		names = populate(servers, sessions, 5)
+		ip = Server.objects().first().ip
+
+		manager = Balancer()
+
+		operations = [
+			('load_balance', lambda i: manager.load_balance(names[0])),
+			('get_active_sessions', lambda i: get_active_sessions()),
+			('session_to_workshop_count', lambda i: session_to_workshop_count()),
+			('update_machines', lambda i: update_machines(
+				ip, 'sid0', [{'vrde-active': bool(i % 2)}, {'vrde-active': bool(i % 2)}])),
+			('insert_session', lambda i: insert_session(ip, 'new{}'.format(i), names[0], 'pass'))
+		]
+
+		for name, operation in operations:
+			times = []
+			trips = 0
+			for i in range(REPEATS):
+				dummy, seconds, count = measure(round_trips, operation, i)
+				times.append(seconds)
+				trips += count
+
+			results.append({
+				'operation': name,
+				'servers': servers,
+				'sessions': sessions,
+				'min': min(times),
+				'mean': sum(times) / len(times),
+				'max': max(times),
+				'queries': trips / float(REPEATS)
+			})
+
+			print("\n{:>4} servers {:>6} sessions {:<26} {:.4f}s".format(
+				servers, sessions, name, sum(times) / len(times)))
@@ -1,4 +1,5 @@
 import pytest
+import time
 from remu.models import *
 from remu.database import *
 
@@ -52,7 +53,12 @@ class TestDatabase:
 
 	def test_insert_session_normal(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
-		assert 'sid' in Server.objects().first().sessions
+		assert Session.objects(sid='sid').first().server == server.ip
+
+	def test_insert_session_unavailable(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass', available=False)
+		assert Session.objects(sid='sid').first().available == False
+		assert claim_available_session(workshop.name) is None
 
 	def test_insert_session_wrong_type(self, server, workshop):
 		with pytest.raises(Exception):
@@ -75,8 +81,8 @@ class TestDatabase:
 	def test_insert_machine_normal(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
 		insert_machine(server.ip, 'sid', 'machine', 3000)
-		s = Server.objects().first()
-		assert s.sessions['sid'].machines[0].name == 'machine'
+		s = Session.objects(sid='sid').first()
+		assert s.machines[0].name == 'machine'
 
 	def test_insert_machine_invalid_type(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
@@ -98,6 +104,11 @@ class TestDatabase:
 		remove_server(server.ip)
 		assert not Server.objects(ip=server.ip)
 
+	def test_remove_server_sessions(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		remove_server(server.ip)
+		assert not Session.objects(server=server.ip)
+
 	def test_remove_server_empty_ip(self):
 		with pytest.raises(Exception):
 			remove_server('')
@@ -131,7 +142,7 @@ class TestDatabase:
 	def test_remove_session_normal(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
 		remove_session(server.ip, 'sid')
-		assert 'sid' not in Server.objects().first().sessions
+		assert not Session.objects(sid='sid')
 
 	def test_remove_session_empty_ip(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
@@ -167,12 +178,30 @@ class TestDatabase:
 			update_workshop('fake', name="update")
 
 
+	def test_get_workshop_cached(self, workshop):
+		before = workshop_cache_stats()
+		assert get_workshop(name=workshop.name)['_id'] == workshop.id
+		assert get_workshop(name=workshop.name)['_id'] == workshop.id
+		after = workshop_cache_stats()
+		assert after['misses'] - before['misses'] == 1
+		assert after['hits'] - before['hits'] == 1
+
+	def test_get_workshop_invalidated(self, workshop):
+		get_workshop(id=workshop.id)
+		update_workshop(workshop.id, max_instances=5)
+		assert get_workshop(id=workshop.id)['max_instances'] == 5
+
+		remove_workshop(workshop.id)
+		with pytest.raises(Exception):
+			get_workshop(id=workshop.id)
+
+
 	def test_update_machines_normal(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
 		insert_machine(server.ip, 'sid', 'machine', 3000)
 		update_machines(server.ip, 'sid', [{'vrde-active':True}])
-		s = Server.objects().first()
-		assert s.sessions['sid'].machines[0].vrde_active == True
+		s = Session.objects(sid='sid').first()
+		assert s.machines[0].vrde_active == True
 
 	def test_update_machines_empty_ip(self):
 		with pytest.raises(Exception):
@@ -183,6 +212,43 @@ class TestDatabase:
 			update_machines(server.ip, '', [{'vrde-active':True}])
 
 
+	def test_update_status_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_session(server.ip, 'sid2', workshop.name, 'pass')
+		insert_machine(server.ip, 'sid', 'machine', 3000)
+		insert_machine(server.ip, 'sid2', 'machine', 3001)
+
+		status = {
+			'cpu': 10.0, 'mem': 20.0, 'hdd': 30.0,
+			'sessions': {
+				'sid': [{'state': 5, 'vrde-active': True, 'vrde-enabled': True}],
+				'sid2': [{'state': 1, 'vrde-active': False, 'vrde-enabled': False}],
+				'unknown': [{'state': 5, 'vrde-active': True, 'vrde-enabled': True}]
+			}
+		}
+		assert update_status(server.ip, status) == 1
+		assert update_status(server.ip, status) == 0
+
+		assert Server.objects().first().mem == 20.0
+		s = Session.objects(sid='sid').first()
+		assert s.machines[0].state == 5
+		assert s.machines[0].vrde_active == True
+
+	def test_update_status_empty_ip(self):
+		with pytest.raises(Exception):
+			update_status('', {'cpu': 0.0, 'mem': 0.0, 'hdd': 0.0, 'sessions': {}})
+
+	def test_update_sessions_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_machine(server.ip, 'sid', 'machine', 3000)
+
+		assert update_sessions(server.ip, {}) == 0
+		assert update_sessions(server.ip, {'sid': [{'vrde-active': True}]}) == 1
+		assert update_sessions('10.0.0.1', {'sid': [{'vrde-active': False}]}) == 0
+
+		assert Session.objects(sid='sid').first().machines[0].vrde_active == True
+
+
 	def test_update_server_normal(self, server):
 		update_server(server.ip, port=8080)
 		assert Server.objects().first().port == 8080
@@ -195,8 +261,12 @@ class TestDatabase:
 	def test_update_session_normal(self, server, workshop):
 		insert_session(server.ip, 'sid', workshop.name, 'pass')
 		update_session(server.ip, 'sid', False)
-		s = Server.objects().first()
-		assert s.sessions['sid'].available == False
+		s = Session.objects(sid='sid').first()
+		assert s.available == False
+
+	def test_update_session_invalid_sid(self, server):
+		with pytest.raises(Exception):
+			update_session(server.ip, 'fake', False)
 
 	
 	def test_session_count_by_workshop_normal(self, server, workshop):
@@ -209,5 +279,133 @@ class TestDatabase:
 		assert session_count_by_workshop(workshop.name, available=True) == 2
 
 
+	def test_get_all_servers_fields(self, server):
+		update_server(server.ip, cpu=1.0, mem=2.0, hdd=3.0)
+		assert get_all_servers(fields=['ip', 'mem']) == [{'ip': server.ip, 'mem': 2.0}]
+
+	def test_get_all_sessions_fields(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		assert get_all_sessions(fields=['available']) == {'sid': {'sid': 'sid', 'available': True}}
+
+	def test_get_server_summaries_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_session(server.ip, 'sid2', workshop.name, 'pass')
+		update_session(server.ip, 'sid2', False)
+
+		summary = get_server_summaries()[0]
+		assert summary['ip'] == server.ip
+		assert summary['sessions'] == 2
+		assert summary['available'] == 1
+
+
+	def test_claim_available_session_normal(self, server, workshop):
+		insert_server('other', 9000)
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_session('other', 'sid2', workshop.name, 'pass')
+
+		claimed = [claim_available_session(workshop.name), claim_available_session(workshop.name)]
+		assert sorted(claimed) == [('127.0.0.1', 'sid'), ('other', 'sid2')]
+		assert claim_available_session(workshop.name) is None
+		assert session_count_by_workshop(workshop.name, available=True) == 0
+
+	def test_claim_available_session_by_server(self, server, workshop):
+		insert_server('other', 9000)
+		insert_session('other', 'sid', workshop.name, 'pass')
+		assert claim_available_session(workshop.name, ip=server.ip) is None
+		assert claim_available_session(workshop.name, ip='other') == ('other', 'sid')
+
+
+	def test_get_active_sessions_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_session(server.ip, 'sid2', workshop.name, 'pass')
+		update_session(server.ip, 'sid2', False)
+		assert list(get_active_sessions().keys()) == ['sid2']
+
+
+	def test_get_server_from_session_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		assert get_server_from_session('sid')['ip'] == server.ip
+		assert get_server_from_session('fake') is None
+
+
+	def test_migrate_sessions_normal(self, server, workshop):
+		Server._get_collection().update_one({'ip': server.ip}, {'$set': {'sessions': {
+			'sid': {
+				'workshop': workshop.id,
+				'machines': [{'name': 'machine', 'port': 3000}],
+				'password': 'pass',
+				'available': False
+			}
+		}}})
+
+		assert migrate_sessions() == 1
+		assert migrate_sessions() == 0
+		assert 'sessions' not in Server._get_collection().find_one({'ip': server.ip})
+		assert get_vrde_ports('sid') == [3000]
+		assert session_count(server.ip) == 1
+
+
+	def test_session_counts_normal(self, server, workshop):
+		insert_server('other', 9000)
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_session(server.ip, 'sid2', workshop.name, 'pass')
+		insert_session('other', 'sid3', workshop.name, 'pass')
+		update_session(server.ip, 'sid2', False)
+
+		counts = session_counts()
+		assert counts[workshop.name] == {'total': 3, 'available': 2, 'active': 1}
+
+		counts = session_counts(by_server=True)
+		assert counts[server.ip][workshop.name] == {'total': 2, 'available': 1, 'active': 1}
+		assert counts['other'][workshop.name] == {'total': 1, 'available': 1, 'active': 0}
+
+	def test_session_counts_empty(self, server, workshop):
+		assert session_counts() == {}
+		assert session_to_workshop_count() == {workshop.name: 0}
+
+
 	# def test_session_to_workshop_count(self, server, workshop):
-		
\ No newline at end of file
+		
+
+
+	def test_insert_metrics_normal(self):
+		now = time.time()
+		samples = [
+			{'server': '127.0.0.1', 'workshop': None, 'time': now - i, 'values': {'cpu': float(i)}}
+			for i in range(10)
+		]
+		insert_metrics(samples)
+
+		assert Metric.objects(resolution=0).count() == 10
+		rollup = Metric.objects(resolution=60).first()
+		assert sum(m.samples for m in Metric.objects(resolution=60)) == 10
+		assert rollup.expires > rollup.timestamp
+
+	def test_insert_metrics_empty(self):
+		assert insert_metrics([]) == 0
+
+	def test_get_server_metrics_normal(self):
+		now = time.time()
+		insert_metrics([
+			{'server': '127.0.0.1', 'workshop': None, 'time': now - i, 'values': {'cpu': float(i + 1)}}
+			for i in range(100)
+		])
+		insert_metrics([{'server': None, 'workshop': 'test', 'time': now, 'values': {'sessions': 3}}])
+
+		metrics = get_server_metrics(3600)
+		assert list(metrics.keys()) == ['127.0.0.1']
+		assert metrics['127.0.0.1']['cpu']['avg'] == 50.5
+		assert metrics['127.0.0.1']['cpu']['p50'] == 50.0
+		assert metrics['127.0.0.1']['cpu']['p95'] == 95.0
+		assert metrics['127.0.0.1']['cpu']['samples'] == 100
+
+	def test_get_workshop_metrics_rollup(self):
+		now = time.time()
+		insert_metrics([
+			{'server': None, 'workshop': 'test', 'time': now - i, 'values': {'sessions': 4}}
+			for i in range(5)
+		])
+
+		metrics = get_workshop_metrics(7200)
+		assert metrics['test']['sessions']['avg'] == 4.0
+		assert metrics['test']['sessions']['samples'] == 5
@@ -0,0 +1,57 @@
+import pytest
+
+import remu.instrument as instrument
+
+
+class Event(object):
+	def __init__(self, **kwargs):
+		self.connection_id = ('localhost', 27017)
+		self.request_id = 1
+		self.__dict__.update(kwargs)
+
+
+class TestInstrument:
+
+	def setup_method(self):
+		instrument.reset()
+
+	def test_instrument_normal(self):
+		func = instrument.instrument(lambda x: x, 'func')
+		assert func(1) == 1
+		assert func(2) == 2
+
+		stats = instrument.stats()['func']
+		assert stats['calls'] == 2
+		assert stats['errors'] == 0
+		assert sum(stats['histogram'].values()) == 2
+
+	def test_instrument_error(self):
+		def fail():
+			raise ValueError
+
+		func = instrument.instrument(fail)
+		with pytest.raises(ValueError):
+			func()
+		assert instrument.stats()['fail']['errors'] == 1
+
+	def test_command_listener_normal(self):
+		listener = instrument.CommandListener()
+
+		def query():
+			listener.started(Event(command_name='find'))
+			listener.succeeded(Event(reply={'cursor': {'firstBatch': [{}, {}]}}))
+			listener.started(Event(command_name='update'))
+			listener.succeeded(Event(reply={'n': 1}))
+
+		instrument.instrument(query)()
+
+		stats = instrument.stats()['query']
+		assert stats['commands'] == 2
+		assert stats['docs_read'] == 2
+		assert stats['docs_written'] == 1
+
+	def test_command_listener_uninstrumented(self):
+		listener = instrument.CommandListener()
+		listener.started(Event(command_name='find'))
+		listener.succeeded(Event(reply={'cursor': {'firstBatch': [{}]}}))
+		assert instrument.stats() == {}
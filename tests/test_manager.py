@@ -0,0 +1,491 @@
+import pytest
+import time
+import flask
+import gevent
+import gevent.event
+
+from remu.models import *
+from remu.database import *
+from remu.settings import config
+from remu.manager import Manager
+import remu.remote
+import remu.util
+from remu.interface import user_bp
+from remu.recycle import RecycleScheduler
+
+
+class FakeServer(object):
+	"""
+	Stands in for the WorkshopManager of a server. Units are cloned right
+	away unless a gate is set, in which case every clone waits for it.
+	"""
+	def __init__(self):
+		self.units = {}
+		self.removed = []
+		self.gate = None
+		self.fail = False
+		self.keep = False
+		self.stuck = False
+		self.broken = False
+		self.unreachable = False
+		self.cloning = 0
+		self.max_cloning = 0
+
+	def clone_unit(self, workshop, session_id):
+		self.cloning += 1
+		self.max_cloning = max(self.max_cloning, self.cloning)
+		try:
+			if self.gate:
+				self.gate.wait()
+			if self.fail:
+				return False
+			self.units[session_id] = workshop
+			return True
+		finally:
+			self.cloning -= 1
+
+	def clone_status(self, sid):
+		return None
+
+	def list_units(self):
+		# A remote component returns None when the server cannot be reached
+		if self.unreachable:
+			return None
+		return dict((sid, {'workshop': w, 'machines': [{'name': 'm_' + sid, 'port': '4000', 'state': 1}]})
+					for sid, w in self.units.items())
+
+	def unit_to_str(self, sid):
+		return [{'name': 'm_' + sid, 'port': 4000}]
+
+	def start_unit(self, sid):
+		return True
+
+	def stop_unit(self, sid):
+		if self.stuck:
+			raise Exception
+		return True
+
+	def remove_unit(self, sid, force=False):
+		self.removed.append(sid)
+		if self.keep:
+			return False
+		return self.units.pop(sid, None) is not None
+
+	def restore_unit(self, sid, new_sid):
+		if self.broken:
+			return False
+		self.units[new_sid] = self.units.pop(sid)
+		return True
+
+
+class FakeNginx(object):
+	def add_mapping(self, session, server, ports):
+		pass
+
+	def remove_mapping(self, session):
+		pass
+
+	def reset_mappings(self, sessions):
+		return True
+
+
+class FakeMonitor(object):
+	def update(self, sessions=True):
+		return {'cpu': 0.0, 'mem': 0.0, 'hdd': 0.0, 'sessions': {}}
+
+
+def wait_until(condition, timeout=5):
+	""" Yield to the greenlets of the manager until the condition holds. """
+	with gevent.Timeout(timeout):
+		while not condition():
+			gevent.sleep(0.01)
+
+
+@pytest.fixture(scope='function')
+def fake():
+	return FakeServer()
+
+
+@pytest.fixture(scope='function')
+def start(mongo, fake):
+	"""
+	Returns a function starting a manager on the fake server. The managers
+	are cleaned up and any clone left waiting is released after the test.
+	"""
+	managers = []
+
+	def start():
+		managers.append(Manager(fake, FakeNginx(), FakeMonitor()))
+		return managers[-1]
+
+	yield start
+
+	if fake.gate:
+		fake.gate.set()
+	for mgr in managers:
+		mgr.clean_up()
+
+
+@pytest.fixture(scope='function')
+def client(start):
+	""" Test client of the user pages, backed by a manager on the fake server. """
+	app = flask.Flask(__name__)
+	app.config.update(SECRET_KEY='test', MANAGER=start())
+	app.register_blueprint(user_bp)
+	return app.test_client()
+
+
+def wait_ticket(mgr, ticket):
+	wait_until(lambda: mgr.checkout_status(ticket)['status'] in ('ready', 'failed'))
+	return mgr.checkout_status(ticket)
+
+
+@pytest.mark.usefixtures('mongo')
+class TestCheckout:
+
+	def test_checkout(self, start, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+
+		mgr = start()
+		status = wait_ticket(mgr, mgr.checkout('test')[0])
+
+		assert status['status'] == 'ready'
+		sid = status['ids'][0].split('_')[0]
+		assert status['ids'] == ['{}_4000'.format(sid)]
+		assert fake.units == {sid: 'test'}
+		assert mgr.state.get_session(sid).available is False
+
+
+	@pytest.mark.parametrize('ticket', ['ABC123', '1ABC23', '123456', '1E5'])
+	def test_checkout_remote(self, start, monkeypatch, ticket):
+		mgr = start()
+		monkeypatch.setattr(remu.util, 'rand_str', lambda length: ticket)
+
+		# The reply of a remote manager is the str() of the result
+		class Reply(object):
+			def __init__(self, result):
+				self.text = str(result)
+
+			def raise_for_status(self):
+				pass
+
+		monkeypatch.setattr(remu.remote.requests, 'get',
+							lambda url: Reply(mgr.checkout('test')))
+
+		remote = remu.remote.RemoteComponent('127.0.0.1', 9000, [Manager])
+		assert remote.checkout(workshop='test') == [ticket]
+		assert mgr.checkout_status(ticket)['status'] == 'queued'
+
+
+	def test_checkout_build_failure(self, start, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+		fake.fail = True
+
+		mgr = start()
+		status = wait_ticket(mgr, mgr.checkout('test')[0])
+
+		# The session reserved for the unit is removed along with the unit
+		assert status['status'] == 'failed'
+		assert status['ids'] is None
+		assert mgr.state.session_count_by_workshop('test') == 0
+		assert session_count_by_workshop('test') == 0
+		assert len(fake.removed) == 1
+
+
+	def test_expire_tickets(self, start):
+		mgr = start()
+		old = time.time() - float(config['REMU'].get('ticket_ttl', 300)) - 1
+		for ticket, status, when in [('ready', 'ready', old), ('failed', 'failed', old),
+									 ('queued', 'queued', old), ('recent', 'ready', time.time())]:
+			mgr.tickets[ticket] = {'workshop': 'test', 'status': status, 'ids': None, 'time': when}
+
+		mgr._expire_tickets()
+		assert sorted(mgr.tickets) == ['queued', 'recent']
+
+
+	def test_expire_waiting_ticket(self, start):
+		mgr = start()
+		now = time.time()
+		timeout = float(config['REMU'].get('waitlist_timeout', 600))
+		for ticket, waited in [('waiting', timeout + 1), ('recent', timeout - 1)]:
+			mgr.tickets[ticket] = {'workshop': 'test', 'status': 'waiting', 'ids': None, 'time': now - waited}
+			mgr.admission.enqueue('test', ticket)
+
+		mgr._expire_tickets()
+		assert mgr.checkout_status('waiting')['status'] == 'failed'
+		assert mgr.checkout_status('recent')['status'] == 'waiting'
+		assert len(mgr.admission) == 1
+
+
+	def test_admission_unknown_workshop(self, start):
+		mgr = start()
+		for ticket in ('first', 'second'):
+			mgr.tickets[ticket] = {'workshop': 'missing', 'status': 'waiting', 'ids': None, 'time': time.time()}
+			mgr.admission.enqueue('missing', ticket)
+
+		# Both checkouts are failed, and the admission service keeps running
+		wait_until(lambda: not len(mgr.admission))
+		assert mgr.checkout_status('first')['status'] == 'failed'
+		assert mgr.checkout_status('second')['status'] == 'failed'
+		assert not mgr.admission_thread.dead
+
+
+	def test_download_unknown_ticket(self, client):
+		with client.session_transaction() as session:
+			session['ticket'] = 'unknown'
+
+		response = client.get('/download')
+		assert response.status_code == 302
+
+		with client.session_transaction() as session:
+			assert 'ticket' not in session
+			assert 'sid' not in session
+
+
+	def test_download_expired_ticket(self, client, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+		mgr = client.application.config['MANAGER']
+
+		ticket = mgr.checkout('test')[0]
+		assert wait_ticket(mgr, ticket)['status'] == 'ready'
+		mgr.tickets[ticket]['time'] -= float(config['REMU'].get('ticket_ttl', 300)) + 1
+		mgr._expire_tickets()
+
+		with client.session_transaction() as session:
+			session['ticket'] = ticket
+			session['os_type'] = 'Windows'
+			session['workshop'] = 'test'
+
+		response = client.get('/download')
+		assert response.status_code == 302
+
+		with client.session_transaction() as session:
+			assert 'ticket' not in session
+			assert 'sid' not in session
+
+
+@pytest.mark.usefixtures('mongo')
+class TestWarmup:
+
+	def test_start_min_instances(self, start, fake):
+		insert_workshop('test', '', '', 3, 5, True)
+
+		mgr = start()
+		mgr.warmup_thread.join()
+
+		assert mgr.warmup_status() == {'total': 3, 'done': 3, 'failed': 0}
+		assert mgr.state.session_count_by_workshop('test', available=True) == 3
+		assert len(fake.units) == 3
+
+
+	def test_start_min_instances_adopted(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+		insert_server('127.0.0.1', 9000)
+		for sid in ('a', 'b'):
+			insert_session('127.0.0.1', sid, 'test', 'pass')
+			insert_machine('127.0.0.1', sid, 'm_' + sid, 4000)
+			fake.units[sid] = 'test'
+
+		# The adopted units exceed the minimum instances
+		mgr = start()
+		mgr.warmup_thread.join()
+
+		assert mgr.warmup_status() == {'total': 0, 'done': 0, 'failed': 0}
+		assert sorted(fake.units) == ['a', 'b']
+
+
+	def test_start_unreachable_server(self, start, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+		insert_server('127.0.0.1', 9000)
+		insert_session('127.0.0.1', 'a', 'test', 'pass')
+		insert_machine('127.0.0.1', 'a', 'm_a', 4000)
+		fake.unreachable = True
+
+		# The session is kept until the server can be polled
+		mgr = start()
+		mgr.warmup_thread.join()
+
+		assert 'a' in mgr.state.sessions
+		assert fake.removed == []
+		assert mgr._reconcile_server('127.0.0.1') is None
+
+
+	def test_warmup_unavailable_until_built(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+		fake.gate = gevent.event.Event()
+
+		mgr = start()
+		wait_until(lambda: fake.cloning)
+
+		# The session is reserved, but cannot be claimed while it is cloned
+		assert mgr.state.session_count_by_workshop('test') == 1
+		assert mgr.state.session_count_by_workshop('test', available=True) == 0
+		assert mgr.state.claim_available_session('test') is None
+
+		fake.gate.set()
+		mgr.warmup_thread.join()
+
+		assert mgr.state.session_count_by_workshop('test', available=True) == 1
+
+
+	def test_warmup_failure(self, start, fake):
+		insert_workshop('test', '', '', 2, 5, True)
+		fake.fail = True
+
+		mgr = start()
+		mgr.warmup_thread.join()
+
+		assert mgr.warmup_status() == {'total': 2, 'done': 0, 'failed': 2}
+		assert mgr.state.session_count_by_workshop('test') == 0
+		assert session_count_by_workshop('test') == 0
+		assert len(fake.removed) == 2
+
+
+	def test_stop_restores_unit(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+
+		mgr = start()
+		mgr.warmup_thread.join()
+		sid = wait_ticket(mgr, mgr.checkout('test')[0])['ids'][0].split('_')[0]
+
+		mgr.stop_workshop(sid)
+
+		# The unit is restored under a new available session
+		assert mgr.state.get_session(sid) is None
+		assert mgr.state.session_count_by_workshop('test', available=True) == 1
+		assert len(fake.units) == 1 and sid not in fake.units
+
+
+	def test_stop_failed_restore(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+
+		mgr = start()
+		mgr.warmup_thread.join()
+		sid = wait_ticket(mgr, mgr.checkout('test')[0])['ids'][0].split('_')[0]
+		fake.broken = True
+
+		with pytest.raises(Exception):
+			mgr.stop_workshop(sid)
+
+		# Neither the stopped session nor the one reserved for the restore
+		# are left behind, and the unit is removed
+		assert mgr.state.session_count_by_workshop('test') == 0
+		assert session_count_by_workshop('test') == 0
+		assert fake.units == {}
+
+
+	def test_build_slots(self, start, fake):
+		slots = int(config['REMU'].get('server_builds', 2))
+		insert_workshop('test', '', '', slots + 2, slots + 2, True)
+		fake.gate = gevent.event.Event()
+
+		mgr = start()
+		wait_until(lambda: fake.cloning == slots)
+		gevent.sleep(0.1)
+		assert fake.cloning == slots
+
+		fake.gate.set()
+		mgr.warmup_thread.join()
+
+		assert fake.max_cloning == slots
+		assert mgr.warmup_status()['done'] == slots + 2
+
+
+@pytest.mark.usefixtures('mongo')
+class TestAutoscale:
+
+	def test_autoscale_counts_builds(self, start, fake):
+		insert_workshop('test', '', '', 2, 5, True)
+		fake.gate = gevent.event.Event()
+
+		mgr = start()
+		wait_until(lambda: mgr.building.get('test') == 2)
+
+		# The builds of the minimum instances cover the predicted demand
+		for i in range(10):
+			mgr.autoscaler.record_checkout('test')
+		assert mgr.autoscaler.target('test', 2, 5, 0) == 2
+
+		mgr._autoscale_workshop(get_workshop(name='test'))
+		gevent.sleep(0.1)
+		assert mgr.building['test'] == 2
+		assert mgr.state.session_count_by_workshop('test') == 2
+
+		fake.gate.set()
+		mgr.warmup_thread.join()
+		assert mgr.building['test'] == 0
+
+
+	def test_trim_available(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+
+		mgr = start()
+		mgr.warmup_thread.join()
+
+		mgr._trim_available_workshop('test')
+		assert mgr.state.session_count_by_workshop('test') == 0
+		assert fake.units == {}
+
+
+	def test_trim_keeps_unremoved_unit(self, start, fake):
+		insert_workshop('test', '', '', 1, 5, True)
+
+		mgr = start()
+		mgr.warmup_thread.join()
+		fake.keep = True
+
+		mgr._trim_available_workshop('test')
+
+		# The session stays claimed so it is recycled later on
+		assert mgr.state.session_count_by_workshop('test') == 1
+		assert mgr.state.session_count_by_workshop('test', available=True) == 0
+		assert len(fake.units) == 1
+
+
+@pytest.mark.usefixtures('mongo')
+class TestRecycle:
+
+	def test_recycle_unconnected_checkout(self, start, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+		delay = int(config['REMU']['recycle_delay'])
+
+		mgr = start()
+		recycle = RecycleScheduler(delay)
+
+		# The unit is only scheduled once it is built
+		fake.gate = gevent.event.Event()
+		ticket = mgr.checkout('test')[0]
+		wait_until(lambda: fake.cloning)
+		mgr._schedule_recycling(recycle, time.time())
+		assert len(recycle) == 0
+
+		fake.gate.set()
+		sid = wait_ticket(mgr, ticket)['ids'][0].split('_')[0]
+
+		now = time.time()
+		mgr._schedule_recycling(recycle, now)
+		assert recycle.due(now + delay - 1) == []
+		assert recycle.due(now + delay) == [sid]
+
+
+	def test_recycle_failed_stop(self, start, fake):
+		insert_workshop('test', '', '', 0, 5, True)
+		delay = int(config['REMU']['recycle_delay'])
+
+		mgr = start()
+		recycle = RecycleScheduler(delay)
+		sid = wait_ticket(mgr, mgr.checkout('test')[0])['ids'][0].split('_')[0]
+
+		now = time.time()
+		mgr._schedule_recycling(recycle, now)
+		fake.stuck = True
+		mgr._recycle(recycle, now + delay)
+
+		# The session is kept and tried again after another delay
+		assert mgr.state.get_session(sid)
+		assert sid in recycle
+
+		fake.stuck = False
+		mgr._recycle(recycle, now + 2 * delay)
+		assert mgr.state.get_session(sid) is None
+		assert sid not in fake.units
@@ -0,0 +1,82 @@
+from remu.placement import PlacementIndex
+
+
+class TestPlacementIndex:
+
+	def test_least_loaded_normal(self):
+		index = PlacementIndex()
+		index.add_server('1.1.1.1')
+		index.add_server('2.2.2.2')
+
+		index.add_session('1.1.1.1', 'w', True)
+		assert index.least_loaded() == '2.2.2.2'
+
+		index.add_session('2.2.2.2', 'w', True)
+		index.add_session('2.2.2.2', 'w', False)
+		assert index.least_loaded() == '1.1.1.1'
+
+		index.remove_session('2.2.2.2', 'w', True)
+		index.remove_session('2.2.2.2', 'w', False)
+		assert index.least_loaded() == '2.2.2.2'
+
+	def test_least_loaded_no_servers(self):
+		index = PlacementIndex()
+		assert index.least_loaded() is None
+
+		index.add_server('1.1.1.1')
+		index.remove_server('1.1.1.1')
+		assert index.least_loaded() is None
+
+	def test_least_loaded_heap_bounded(self):
+		index = PlacementIndex()
+		index.add_server('1.1.1.1')
+		index.add_server('2.2.2.2')
+
+		for dummy in range(1000):
+			index.add_session('1.1.1.1', 'w', True)
+			index.remove_session('1.1.1.1', 'w', True)
+
+		assert len(index._heap) <= 4 * 2 + 16
+		assert index.session_count('1.1.1.1') == 0
+
+
+	def test_server_with_available_normal(self):
+		index = PlacementIndex()
+		index.add_session('1.1.1.1', 'w', False)
+		assert index.server_with_available('w') is None
+
+		index.add_session('2.2.2.2', 'w', True)
+		assert index.server_with_available('w') == '2.2.2.2'
+
+		index.set_available('2.2.2.2', 'w', False)
+		assert index.server_with_available('w') is None
+		assert index.server_with_available('unknown') is None
+
+
+	def test_workshop_counts_normal(self):
+		index = PlacementIndex()
+		index.add_session('1.1.1.1', 'a', True)
+		index.add_session('1.1.1.1', 'a', False)
+		index.add_session('2.2.2.2', 'b', True)
+
+		assert index.workshop_count('a') == 2
+		assert index.workshop_count('a', available=True) == 1
+		assert index.workshop_count('a', '2.2.2.2') == 0
+		assert index.workshop_counts() == {
+			'a': {'total': 2, 'available': 1, 'active': 1},
+			'b': {'total': 1, 'available': 1, 'active': 0}
+		}
+		assert index.workshop_counts(by_server=True) == {
+			'1.1.1.1': {'a': {'total': 2, 'available': 1, 'active': 1}},
+			'2.2.2.2': {'b': {'total': 1, 'available': 1, 'active': 0}}
+		}
+
+	def test_remove_server_counts(self):
+		index = PlacementIndex()
+		index.add_session('1.1.1.1', 'a', True)
+		index.add_session('2.2.2.2', 'a', True)
+		index.remove_server('1.1.1.1')
+
+		assert index.workshop_count('a') == 1
+		assert index.server_with_available('a') == '2.2.2.2'
+		assert index.least_loaded() == '2.2.2.2'
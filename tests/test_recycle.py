@@ -0,0 +1,40 @@
+from remu.recycle import RecycleScheduler
+
+
+class TestRecycleScheduler:
+
+	def test_due_normal(self):
+		recycle = RecycleScheduler(10)
+		recycle.idle('a', 0)
+		recycle.idle('b', 5)
+
+		assert recycle.due(9) == []
+		assert recycle.due(10) == ['a']
+		assert recycle.due(20) == ['b']
+		assert len(recycle) == 0
+
+	def test_idle_keeps_deadline(self):
+		recycle = RecycleScheduler(10)
+		recycle.idle('a', 0)
+		recycle.idle('a', 5)
+
+		assert recycle.due(10) == ['a']
+
+	def test_cancel_normal(self):
+		recycle = RecycleScheduler(10)
+		recycle.idle('a', 0)
+		recycle.cancel('a')
+		assert 'a' not in recycle
+
+		# Idle again after reconnecting and disconnecting
+		recycle.idle('a', 5)
+		assert recycle.due(10) == []
+		assert recycle.due(15) == ['a']
+
+	def test_heap_bounded(self):
+		recycle = RecycleScheduler(10)
+		for i in range(1000):
+			recycle.idle('a', i)
+			recycle.cancel('a')
+
+		assert len(recycle._heap) <= 16
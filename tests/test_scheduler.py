@@ -0,0 +1,123 @@
+import pytest
+import time
+from remu.models import *
+from remu.database import *
+from remu.scheduler import LeastLoadedScheduler, WeightedScheduler, create
+from remu.state import ClusterState, ServerState
+
+# Capacity of the simulated hosts. One unit of capacity holds 20 standard units.
+HOSTS = {'10.0.0.1': 1.0, '10.0.0.2': 2.0, '10.0.0.3': 4.0}
+UNITS_PER_CAPACITY = 20.0
+
+# Workshops placed in turn during the simulation and their footprints.
+WORKSHOPS = [('light', 1.0), ('light', 1.0), ('heavy', 3.0)]
+
+# Number of placements between two status updates of the hosts.
+POLLING = 5
+
+
+def simulate(scheduler_class, placements=60):
+	"""
+	Place units on heterogeneous hosts with the scheduler. The hosts report
+	their usage only every few placements, like the monitor service does.
+	Returns the utilization of each host as a fraction of its capacity.
+	"""
+	state = ClusterState()
+	for ip, capacity in HOSTS.items():
+		state.servers[ip] = ServerState(ip, 9000, capacity=capacity)
+		state.placement.add_server(ip)
+
+	scheduler = scheduler_class(state)
+	used = dict.fromkeys(HOSTS, 0.0)
+
+	for i in range(placements):
+		if i % POLLING == 0:
+			for ip, server in state.servers.items():
+				usage = 100.0 * used[ip] / (HOSTS[ip] * UNITS_PER_CAPACITY)
+				server.cpu = server.mem = usage
+				server.hdd = 10.0
+
+		name, footprint = WORKSHOPS[i % len(WORKSHOPS)]
+		ip = scheduler.select(name)
+		if ip is None:
+			break
+
+		state.placement.add_session(ip, name, False)
+		used[ip] += footprint
+
+	return dict((ip, used[ip] / (HOSTS[ip] * UNITS_PER_CAPACITY)) for ip in HOSTS)
+
+
+@pytest.mark.usefixtures('mongo')
+class TestScheduler:
+
+	def test_weighted_spreads_heterogeneous_hosts(self):
+		for name, footprint in set(WORKSHOPS):
+			insert_workshop(name, '', '', 0, 0, True, footprint)
+
+		weighted = simulate(WeightedScheduler)
+		least_loaded = simulate(LeastLoadedScheduler)
+
+		spread = max(weighted.values()) - min(weighted.values())
+		assert spread < 0.15
+		assert spread < max(least_loaded.values()) - min(least_loaded.values())
+
+		# The smallest host is the first to be overloaded by session counts
+		assert max(weighted.values()) < max(least_loaded.values())
+
+
+	def test_weighted_footprint(self, server):
+		insert_workshop('light', '', '', 0, 0, True, 1.0)
+		insert_workshop('heavy', '', '', 0, 0, True, 4.0)
+		insert_server('10.0.0.2', 9000)
+
+		state = ClusterState()
+		state.reload()
+		state.placement.add_session(server.ip, 'heavy', False)
+		state.placement.add_session('10.0.0.2', 'light', False)
+		state.placement.add_session('10.0.0.2', 'light', False)
+
+		# Fewer sessions, but a heavier footprint
+		assert WeightedScheduler(state).select('light') == '10.0.0.2'
+		assert LeastLoadedScheduler(state).select('light') == server.ip
+
+
+	def test_weighted_resource_limits(self, server):
+		insert_workshop('light', '', '', 0, 0, True)
+
+		state = ClusterState()
+		state.reload()
+		state.get_server(server.ip).mem = 95.0
+		state.get_server(server.ip).hdd = 10.0
+
+		assert WeightedScheduler(state).select('light') is None
+
+
+	def test_weighted_observed_usage(self, server):
+		insert_workshop('light', '', '', 0, 0, True)
+		insert_server('10.0.0.2', 9000)
+
+		state = ClusterState()
+		state.reload()
+		for ip in (server.ip, '10.0.0.2'):
+			state.get_server(ip).cpu = state.get_server(ip).mem = 10.0
+			state.get_server(ip).hdd = 10.0
+		state.get_server('10.0.0.2').mem = 20.0
+
+		scheduler = WeightedScheduler(state)
+		assert scheduler.select('light') == server.ip
+
+		# The first server was idle at its last update, but busy over the window
+		now = time.time()
+		insert_metrics([
+			{'server': server.ip, 'time': now - i, 'values': {'cpu': 80.0, 'mem': 60.0, 'hdd': 10.0}}
+			for i in range(10)
+		])
+		scheduler.observe(get_server_metrics(300))
+		assert scheduler.select('light') == '10.0.0.2'
+
+
+	def test_create_normal(self):
+		scheduler = create(ClusterState())
+		assert isinstance(scheduler, WeightedScheduler)
+		assert scheduler.weights == {'load': 1.0, 'cpu': 0.5, 'mem': 1.0, 'hdd': 0.25}
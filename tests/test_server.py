@@ -1,9 +1,13 @@
 import pytest
+import subprocess
 import time
+import gevent
 
+import virtualbox
 import virtualbox.library as vboxlib
 
-from remu.server import WorkshopManager
+from remu.server import WorkshopManager, PerformanceMonitor
+from remu.settings import config
 
 @pytest.mark.workshop
 @pytest.mark.usefixtures('workshop_manager')
@@ -17,11 +21,6 @@ class TestWorkshopManager:
 		assert name not in machines
 
 
-	def test_set_group(self, machine):
-		self.mgr._set_group(machine.name, '/Test_Set_Group')
-		assert '/Test_Set_Group' in self.mgr.vbox.machine_groups
-
-
 	def test_get_first_snapshot(self, machine):
 		session = machine.create_session()
 
@@ -75,6 +74,26 @@ class TestWorkshopManager:
 
 		self.mgr._delete_machine(clone)
 
+	def test_clone_vm_linked(self):
+		tc = self.mgr.vbox.find_machine('TinyCore')
+		clone = self.mgr._clone_vm(tc)
+
+		# Clones are linked unless a full copy is asked for
+		assert clone is not None
+		assert all(a.medium.parent is not None for a in clone.medium_attachments if a.medium)
+
+		self.mgr._delete_machine(clone)
+		assert self.mgr._get_first_snapshot(tc) is not None
+
+	def test_clone_vm_full(self):
+		tc = self.mgr.vbox.find_machine('TinyCore')
+		clone = self.mgr._clone_vm(tc, linked=False)
+
+		assert clone is not None
+		assert all(a.medium.parent is None for a in clone.medium_attachments if a.medium)
+
+		self.mgr._delete_machine(clone)
+
 	def test_clone_vm_recover_snapshot(self, machine):
 		with pytest.raises(Exception):
 			machine.find_snapshot("")
@@ -92,6 +111,17 @@ class TestWorkshopManager:
 		for m in self.mgr.vbox.get_machines_by_groups([unit]):
 			self.mgr._delete_machine(m)
 
+	def test_clone_unit_all_machines(self):
+		assert self.mgr.clone_unit('Test_Workshop', 'all')
+		assert self.mgr.clone_status('all') is None
+
+		unit = '/Test_Workshop-Units/all'
+		machines = self.mgr.vbox.get_machines_by_groups([unit])
+		assert len(machines) == len(self.mgr._get_unit_machines('/Test_Workshop-Template'))
+
+		for m in machines:
+			self.mgr._delete_machine(m)
+
 	def test_clone_unit_invalid_workshop(self):
 		with pytest.raises(Exception):
 			self.mgr.clone_unit('', 'sid')
@@ -111,6 +141,16 @@ class TestWorkshopManager:
 	def test_get_unit(self, unit):
 		assert self.mgr._get_unit('sid') == '/Test_Workshop-Units/sid'
 
+	def test_get_unit_exact_match(self, unit):
+		assert self.mgr._get_unit('si') == None
+		assert self.mgr._get_unit('Test_Workshop') == None
+
+	def test_index_units(self, unit):
+		self.mgr.unit_groups = {}
+		self.mgr._index_units()
+		assert self.mgr._get_unit('sid') == '/Test_Workshop-Units/sid'
+		assert len(self.mgr.unit_machines['/Test_Workshop-Units/sid']) > 0
+
 	def test_get_unit_invalid_name(self):
 		assert self.mgr._get_unit('fake') == None
 
@@ -199,6 +239,14 @@ class TestWorkshopManager:
 			assert m.state == vboxlib.MachineState.powered_off
 
 
+	@pytest.mark.parametrize('unit', ['not_running'], indirect=True)
+	def test_stop_unit_not_running(self, unit):
+		assert not self.mgr.stop_unit('not_running')
+
+		for m in self.mgr.vbox.get_machines_by_groups(['/Test_Workshop-Units/not_running']):
+			assert m.state == vboxlib.MachineState.powered_off
+
+
 	def test_restore_unit(self):
 		self.mgr.clone_unit('Test_Workshop', 'restore')
 
@@ -228,6 +276,10 @@ class TestWorkshopManager:
 			assert 'after' in m.name
 			assert 'after' in m.groups[0]
 
+		assert self.mgr._get_unit('restore') == None
+		assert self.mgr._get_unit('after') == '/Test_Workshop-Units/after'
+
+		for m in machines:
 			self.mgr._delete_machine(m)
 
 
@@ -240,7 +292,118 @@ class TestWorkshopManager:
 
 		assert 'TinyCore_remove' not in [m.name for m in self.mgr.vbox.machines]
 		assert '/Test_Workshop-Units/remove' not in self.mgr.vbox.machine_groups
+		assert self.mgr._get_unit('remove') == None
 
 
 	def test_get_workshop_list(self):
-		assert len(self.mgr.get_workshop_list()) > 0
\ No newline at end of file
+		assert len(self.mgr.get_workshop_list()) > 0
+
+
+def vbox_manage(*args):
+	subprocess.check_call([config['REMU']['vbox_manage']] + list(args))
+
+
+@pytest.mark.benchmark
+@pytest.mark.workshop
+@pytest.mark.usefixtures('workshop_manager')
+class TestUnitOverhead:
+	"""
+	Per-unit overhead of setting the group of and removing the machines of a
+	unit with a VBoxManage process per machine, as done previously, and
+	through the VirtualBox API.
+	"""
+
+	def test_set_group_overhead(self, unit):
+		group = '/Test_Workshop-Units/sid'
+		machines = self.mgr._get_unit_machines(group)
+
+		start = time.time()
+		for m in machines:
+			vbox_manage('modifyvm', m.name, '--groups', group)
+		forked = time.time() - start
+
+		start = time.time()
+		for m in machines:
+			session = m.create_session()
+			try:
+				session.machine.groups = [group]
+				session.machine.save_settings()
+			finally:
+				session.unlock_machine()
+		api = time.time() - start
+
+		print("\nset group per unit: VBoxManage {:.3f}s, API {:.3f}s".format(forked, api))
+		assert all(m.groups == [group] for m in machines)
+
+	def test_remove_unit_overhead(self):
+		self.mgr.clone_unit('Test_Workshop', 'forked')
+		self.mgr.clone_unit('Test_Workshop', 'api')
+
+		start = time.time()
+		for m in self.mgr._get_unit_machines(self.mgr._get_unit('forked')):
+			vbox_manage('unregistervm', m.name, '--delete')
+		forked = time.time() - start
+		self.mgr._index_units()
+
+		start = time.time()
+		assert self.mgr.remove_unit('api')
+		api = time.time() - start
+
+		print("\nremove per unit: VBoxManage {:.3f}s, API {:.3f}s".format(forked, api))
+
+		machines = [m.name for m in self.mgr.vbox.machines]
+		assert 'TinyCore_forked' not in machines
+		assert 'TinyCore_api' not in machines
+
+
+class FakeMachine(object):
+	def __init__(self, name):
+		self.name = name
+		self.id_p = name
+		self.state = vboxlib.MachineState(1)
+		self.vrde_server = type('VRDEServer', (object,), {'enabled': False})()
+
+
+class FakeVirtualBox(object):
+	""" Machine groups of a server with a two machine template. """
+	def __init__(self):
+		self.groups = {'/Test-Template': [FakeMachine('a'), FakeMachine('b')]}
+		self.system_properties = type('SystemProperties', (object,), {'default_machine_folder': '/'})()
+
+	@property
+	def machine_groups(self):
+		return list(self.groups)
+
+	def get_machines_by_groups(self, groups):
+		return list(self.groups.get(groups[0], []))
+
+
+class FakeManager(object):
+	def __init__(self):
+		self.events = []
+
+	def vrde_events(self, sessions):
+		self.events.append(sessions)
+		return len(sessions)
+
+
+class TestPerformanceMonitor:
+
+	def test_watch_partial_unit(self, monkeypatch):
+		vbox = FakeVirtualBox()
+		monkeypatch.setattr(virtualbox, 'VirtualBox', lambda: vbox)
+
+		monitor = PerformanceMonitor()
+		manager = FakeManager()
+		monitor.start_watch(manager, 0.01)
+
+		# One of the two machines of the unit being cloned is registered
+		vbox.groups['/Test-Units/sid'] = [FakeMachine('a_sid')]
+		gevent.sleep(0.1)
+		assert not any('sid' in e for e in manager.events)
+
+		vbox.groups['/Test-Units/sid'].append(FakeMachine('b_sid'))
+		gevent.sleep(0.1)
+		assert [len(e['sid']) for e in manager.events if 'sid' in e] == [2]
+
+		monitor.clean_up()
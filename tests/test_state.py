@@ -0,0 +1,202 @@
+import pytest
+from remu.models import *
+from remu.database import *
+from remu.state import ClusterState
+
+
+@pytest.fixture(scope='function')
+def state(server, workshop):
+	state = ClusterState()
+	state.reload()
+	return state
+
+
+@pytest.mark.usefixtures('mongo')
+class TestClusterState:
+
+	def test_reload_normal(self, server, workshop):
+		insert_session(server.ip, 'sid', workshop.name, 'pass')
+		insert_machine(server.ip, 'sid', 'machine', 3000)
+
+		state = ClusterState()
+		state.reload()
+
+		assert state.get_server(server.ip).sessions == set(['sid'])
+		assert state.get_session('sid').workshop == workshop.name
+		assert state.get_vrde_ports('sid') == [3000]
+
+
+	def test_insert_session_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'sid', 'machine', 3000)
+
+		assert session_exists('sid')
+		assert state.session_count(server.ip, check_available=True) == 1
+		assert state.session_count_by_workshop(workshop.name) == 1
+		assert state.get_session('sid').machines[0].name == 'machine'
+
+	def test_insert_session_unavailable(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass', available=False)
+
+		assert state.session_count(server.ip, check_available=True) == 0
+		assert state.session_counts() == session_counts()
+		assert state.claim_available_session(workshop.name) is None
+
+		# Recorded so the session is recycled if it is never connected to
+		assert state.pop_changes() == set(['sid'])
+
+	def test_insert_session_failed_write(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		with pytest.raises(Exception):
+			state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		assert state.session_count(server.ip) == 1
+
+
+	def test_claim_available_session_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+
+		assert state.claim_available_session(workshop.name) == (server.ip, 'sid')
+		assert state.claim_available_session(workshop.name) is None
+		assert list(state.get_active_sessions().keys()) == ['sid']
+		assert state.session_counts() == {workshop.name: {'total': 1, 'available': 0, 'active': 1}}
+
+
+	def test_remove_session_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		state.remove_session(server.ip, 'sid')
+
+		assert not session_exists('sid')
+		assert not state.session_exists('sid')
+		assert state.session_count(server.ip) == 0
+
+
+	def test_remove_server_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		state.remove_server(server.ip)
+
+		assert state.get_server(server.ip) is None
+		assert not state.session_exists('sid')
+
+
+	def test_update_status_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'sid', 'machine', 3000)
+		state.update_status(server.ip, {
+			'cpu': 10.0, 'mem': 20.0, 'hdd': 30.0,
+			'sessions': {'sid': [{'state': 5, 'vrde-active': True, 'vrde-enabled': True}]}
+		})
+
+		assert state.get_server(server.ip).mem == 20.0
+		assert state.get_session('sid').machines[0].vrde_active == True
+		assert Session.objects(sid='sid').first().machines[0].vrde_active == True
+
+
+	def test_placement_matches_database(self, state, server, workshop):
+		state.insert_session(server.ip, 'a', workshop.name, 'pass')
+		state.insert_session(server.ip, 'b', workshop.name, 'pass')
+		state.claim_available_session(workshop.name)
+		state.remove_session(server.ip, 'a')
+		state.update_session(server.ip, 'b', True)
+
+		assert state.session_counts() == session_counts()
+		assert state.session_counts(by_server=True) == session_counts(by_server=True)
+		assert state.placement.server_with_available(workshop.name) == server.ip
+		assert state.placement.least_loaded() == server.ip
+
+
+	def test_pop_changes_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'sid', 'machine', 3000)
+		assert state.pop_changes() == set()
+
+		state.claim_available_session(workshop.name)
+		assert state.pop_changes() == set(['sid'])
+
+		status = {'cpu': 0.0, 'mem': 0.0, 'hdd': 0.0, 'sessions': {'sid': [{'vrde-active': True}]}}
+		state.update_status(server.ip, status)
+		assert state.get_session('sid').connected
+		assert state.pop_changes() == set(['sid'])
+
+		# No transition
+		state.update_status(server.ip, status)
+		assert state.pop_changes() == set()
+
+		state.remove_session(server.ip, 'sid')
+		assert state.pop_changes() == set(['sid'])
+
+
+	def test_connected_counts_normal(self, state, server, workshop):
+		for sid in ('a', 'b'):
+			state.insert_session(server.ip, sid, workshop.name, 'pass')
+			state.insert_machine(server.ip, sid, 'machine_' + sid, 3000)
+		assert state.connected_counts() == {}
+
+		sessions = {'a': [{'vrde-active': True}], 'b': [{'vrde-active': True}]}
+		state.update_status(server.ip, {'cpu': 0.0, 'mem': 0.0, 'hdd': 0.0, 'sessions': sessions})
+		assert state.connected_counts() == {workshop.name: 2}
+
+		# Counted once per transition
+		sessions['b'] = [{'vrde-active': False}]
+		state.update_status(server.ip, {'cpu': 0.0, 'mem': 0.0, 'hdd': 0.0, 'sessions': sessions})
+		assert state.connected_counts() == {workshop.name: 1}
+
+		reloaded = ClusterState()
+		reloaded.reload()
+		assert reloaded.connected_counts() == {workshop.name: 1}
+
+		state.remove_session(server.ip, 'a')
+		assert state.connected_counts() == {}
+
+
+	def test_reconcile_normal(self, state, server, workshop):
+		state.insert_session(server.ip, 'a', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'a', 'machine_a', 3000)
+		state.insert_session(server.ip, 'b', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'b', 'machine_b', 3001)
+		state.update_session(server.ip, 'b', False)
+		state.insert_session(server.ip, 'stale', workshop.name, 'pass')
+
+		units = {
+			'a': {'workshop': workshop.name, 'machines': [{'name': 'machine_a', 'port': '3000', 'state': 2}]},
+			'b': {'workshop': workshop.name, 'machines': [{'name': 'machine_b', 'port': '3001', 'state': 5}]},
+			'orphan': {'workshop': workshop.name, 'machines': [{'name': 'machine_o', 'port': '3002', 'state': 1}]}
+		}
+		adopted, discard = state.reconcile(server.ip, units)
+
+		assert sorted(adopted) == ['a', 'b']
+		assert discard == ['orphan']
+		assert not session_exists('stale')
+		assert state.get_session('a').machines[0].state == 2
+		assert state.session_counts() == session_counts()
+
+	def test_reconcile_resets_vrde(self, state, server, workshop):
+		state.insert_session(server.ip, 'sid', workshop.name, 'pass', available=False)
+		state.insert_machine(server.ip, 'sid', 'machine', 3000)
+		state.update_sessions(server.ip, {'sid': [{'state': 5, 'vrde-active': True, 'vrde-enabled': True}]})
+		assert state.get_session('sid').connected
+
+		units = {'sid': {'workshop': workshop.name, 'machines': [{'name': 'machine', 'port': '3000', 'state': 5}]}}
+		adopted, discard = state.reconcile(server.ip, units)
+
+		assert adopted == ['sid']
+		assert not state.get_session('sid').connected
+		assert not state.get_session('sid').machines[0].vrde_enabled
+		machine = get_session(server.ip, 'sid')['machines'][0]
+		assert not machine['vrde_active'] and not machine['vrde_enabled']
+
+	def test_reconcile_unhealthy(self, state, server, workshop):
+		state.insert_session(server.ip, 'a', workshop.name, 'pass')
+		state.insert_machine(server.ip, 'a', 'machine_a', 3000)
+		state.insert_session(server.ip, 'b', workshop.name, 'pass')
+
+		units = {
+			# Available session with running machines
+			'a': {'workshop': workshop.name, 'machines': [{'name': 'machine_a', 'port': '3000', 'state': 5}]},
+			# Build interrupted before the machines were recorded
+			'b': {'workshop': workshop.name, 'machines': [{'name': 'machine_b', 'port': '3001', 'state': 1}]}
+		}
+		adopted, discard = state.reconcile(server.ip, units)
+
+		assert adopted == []
+		assert sorted(discard) == ['a', 'b']
+		assert state.session_count(server.ip) == 0
@@ -0,0 +1,59 @@
+import time
+from remu.util import TTLCache, CircuitBreaker
+
+
+class TestTTLCache:
+
+	def test_get_normal(self):
+		cache = TTLCache(2, 60)
+		cache.set('a', 1)
+		assert cache.get('a') == 1
+		assert cache.get('b') is None
+		assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+	def test_get_expired(self):
+		cache = TTLCache(2, -1)
+		cache.set('a', 1)
+		assert cache.get('a') is None
+
+	def test_set_evicts_least_recent(self):
+		cache = TTLCache(2, 60)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		cache.get('a')
+		cache.set('c', 3)
+		assert cache.get('b') is None
+		assert cache.get('a') == 1
+
+
+class TestCircuitBreaker:
+
+	def test_open_after_threshold(self):
+		breaker = CircuitBreaker(2, 60)
+		breaker.failure()
+		assert breaker.allow()
+		assert breaker.state == 'closed'
+
+		breaker.failure()
+		assert not breaker.allow()
+		assert breaker.state == 'open'
+
+	def test_success_closes(self):
+		breaker = CircuitBreaker(1, 60)
+		breaker.failure()
+		breaker.success()
+		assert breaker.allow()
+		assert breaker.failures == 0
+
+	def test_half_open_trial(self):
+		breaker = CircuitBreaker(1, 60)
+		breaker.failure()
+		breaker.opened = time.time() - 61
+		assert breaker.state == 'half-open'
+
+		# A single trial call is allowed until the cooldown passes again
+		assert breaker.allow()
+		assert not breaker.allow()
+
+		breaker.failure()
+		assert breaker.state == 'open'